@@ -17,11 +17,12 @@ COMPILE_CMD = ("gcc -Wall -g -O2 -shared -fPIC"
 SOURCE_FILES = [
     'pyhelper.c', 'serialqueue.c', 'stepcompress.c', 'itersolve.c',
     'kin_cartesian.c', 'kin_corexy.c', 'kin_delta.c', 'kin_polar.c',
-    'kin_winch.c', 'kin_extruder.c',
+    'kin_winch.c', 'kin_extruder.c', 'lookahead.c', 'stepbatch.c',
 ]
 DEST_LIB = "c_helper.so"
 OTHER_FILES = [
-    'list.h', 'serialqueue.h', 'stepcompress.h', 'itersolve.h', 'pyhelper.h'
+    'list.h', 'serialqueue.h', 'stepcompress.h', 'itersolve.h', 'pyhelper.h',
+    'lookahead.h', 'stepbatch.h',
 ]
 
 defs_stepcompress = """
@@ -56,6 +57,7 @@ defs_itersolve = """
         , double x, double y, double z);
     void itersolve_set_commanded_pos(struct stepper_kinematics *sk, double pos);
     double itersolve_get_commanded_pos(struct stepper_kinematics *sk);
+    void itersolve_set_iterative(struct stepper_kinematics *sk);
 """
 
 defs_kin_cartesian = """
@@ -88,6 +90,32 @@ defs_kin_extruder = """
         , double extra_accel_v, double extra_decel_v);
 """
 
+defs_lookahead = """
+    struct lookahead *lookahead_alloc(void);
+    void lookahead_free(struct lookahead *la);
+    void lookahead_reset(struct lookahead *la);
+    int lookahead_add(struct lookahead *la, double max_start_v2
+        , double delta_v2, double max_smoothed_v2, double smooth_delta_v2
+        , double max_cruise_v2);
+    int lookahead_flush(struct lookahead *la, int leftover, int lazy
+        , double *junctions);
+    void lookahead_remove(struct lookahead *la, int count);
+"""
+
+defs_stepbatch = """
+    struct stepbatch_op {
+        int type, param_pos;
+        void *obj;
+        struct move *m;
+        uint64_t clock;
+    };
+
+    struct stepbatch_pool *stepbatch_pool_alloc(int num_threads);
+    void stepbatch_pool_free(struct stepbatch_pool *sp);
+    int32_t stepbatch_run(struct stepbatch_pool *sp
+        , struct stepbatch_op *ops, int count, double *params);
+"""
+
 defs_serialqueue = """
     #define MESSAGE_MAX 64
     struct pull_queue_message {
@@ -103,6 +131,12 @@ defs_serialqueue = """
     void serialqueue_free_commandqueue(struct command_queue *cq);
     void serialqueue_send(struct serialqueue *sq, struct command_queue *cq
         , uint8_t *msg, int len, uint64_t min_clock, uint64_t req_clock);
+    void serialqueue_encode_and_send(struct serialqueue *sq
+        , struct command_queue *cq, uint32_t *data, int len
+        , uint64_t min_clock, uint64_t req_clock);
+    void serialqueue_send_multi(struct serialqueue *sq
+        , struct command_queue *cq, uint8_t *data, int *lens, int count
+        , uint64_t min_clock, uint64_t req_clock);
     void serialqueue_pull(struct serialqueue *sq
         , struct pull_queue_message *pqm);
     void serialqueue_set_baud_adjust(struct serialqueue *sq
@@ -129,7 +163,7 @@ defs_all = [
     defs_pyhelper, defs_serialqueue, defs_std,
     defs_stepcompress, defs_itersolve,
     defs_kin_cartesian, defs_kin_corexy, defs_kin_delta, defs_kin_polar,
-    defs_kin_winch, defs_kin_extruder
+    defs_kin_winch, defs_kin_extruder, defs_lookahead, defs_stepbatch
 ]
 
 # Return the list of file modification times
@@ -162,20 +196,13 @@ pyhelper_logging_callback = None
 def get_ffi():
     global FFI_main, FFI_lib, pyhelper_logging_callback
     if FFI_lib is None:
-        logging.info("")
-        logging.info("=========================get_ffi()=========================")
-        srcdir = os.path.dirname(os.path.realpath(__file__)) 
-        logging.info("srcdir is : "+srcdir) 
+        srcdir = os.path.dirname(os.path.realpath(__file__))
         check_build_code(srcdir, DEST_LIB, SOURCE_FILES, COMPILE_CMD
                          , OTHER_FILES)
         FFI_main = cffi.FFI()
         for d in defs_all:
             FFI_main.cdef(d)
         FFI_lib = FFI_main.dlopen(os.path.join(srcdir, DEST_LIB))
- 
-        logging.info("FFI_lib is : "+str(FFI_lib))
-        logging.info("=========================get_ffi() END =========================")
-        logging.info("")
         # Setup error logging
         def logging_callback(msg):
             logging.error(FFI_main.string(msg))
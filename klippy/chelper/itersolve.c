@@ -140,8 +140,8 @@ itersolve_find_step(struct stepper_kinematics *sk, struct move *m
 }
 
 // Generate step times for a stepper during a move
-int32_t __visible
-itersolve_gen_steps(struct stepper_kinematics *sk, struct move *m)
+static int32_t
+itersolve_gen_steps_iterative(struct stepper_kinematics *sk, struct move *m)
 {
     struct stepcompress *sc = sk->sc;
     sk_callback calc_position = sk->calc_position;
@@ -207,6 +207,138 @@ itersolve_gen_steps(struct stepper_kinematics *sk, struct move *m)
     return 0;
 }
 
+
+/****************************************************************
+ * Analytic solver
+ ****************************************************************/
+
+// A section of a move during which the stepper moves in one direction
+// with a constant acceleration
+struct linear_span {
+    double time, position, velocity, accel, duration;
+};
+
+// Find the time (relative to the start of the span) at which the
+// stepper reaches the given position
+static inline double
+linear_span_find_step(struct linear_span *ls, double target)
+{
+    double dist = target - ls->position, v = ls->velocity;
+    double disc = v*v + 2. * ls->accel * dist;
+    double sq = disc > 0. ? sqrt(disc) : 0.;
+    // Numerically stable form of the quadratic root
+    double den = v + (dist < 0. ? -sq : sq);
+    double t = den ? 2. * dist / den : 0.;
+    if (t < 0.)
+        return 0.;
+    if (t > ls->duration)
+        return ls->duration;
+    return t;
+}
+
+// Add the steps that occur during a span
+static int32_t
+linear_span_gen_steps(struct stepper_kinematics *sk, struct queue_append *qa
+                      , double mcu_freq, struct linear_span *ls, int *psdir)
+{
+    double half_step = .5 * sk->step_dist, commanded_pos = sk->commanded_pos;
+    double end_pos = ls->position + ((ls->velocity + .5 * ls->accel
+                                      * ls->duration) * ls->duration);
+    if (end_pos == ls->position)
+        return 0;
+    int next_sdir = end_pos > ls->position, sdir = *psdir;
+    double step_dist = next_sdir ? sk->step_dist : -sk->step_dist;
+    if (next_sdir != sdir) {
+        // Only change direction if going past midway point
+        double dist = end_pos - commanded_pos;
+        if (fabs(dist) < half_step + .000000001 || (dist > 0.) != next_sdir)
+            return 0;
+        int ret = queue_append_set_next_step_dir(qa, next_sdir);
+        if (ret)
+            return ret;
+        *psdir = sdir = next_sdir;
+    }
+    for (;;) {
+        double target = commanded_pos + .5 * step_dist;
+        if (sdir ? target > end_pos : target < end_pos)
+            break;
+        double t = ls->time + linear_span_find_step(ls, target);
+        int ret = queue_append(qa, t * mcu_freq);
+        if (ret)
+            return ret;
+        commanded_pos += step_dist;
+    }
+    sk->commanded_pos = commanded_pos;
+    return 0;
+}
+
+// Add the steps of a constant acceleration phase of a move (splitting
+// it where the stepper changes direction)
+static int32_t
+linear_phase_gen_steps(struct stepper_kinematics *sk, struct queue_append *qa
+                       , double mcu_freq, struct linear_span *ls, int *psdir)
+{
+    if (ls->duration <= 0.)
+        return 0;
+    if (ls->accel) {
+        double stop_t = -ls->velocity / ls->accel;
+        if (stop_t > 0. && stop_t < ls->duration) {
+            struct linear_span first = *ls;
+            first.duration = stop_t;
+            int ret = linear_span_gen_steps(sk, qa, mcu_freq, &first, psdir);
+            if (ret)
+                return ret;
+            ls->time += stop_t;
+            ls->position += (ls->velocity + .5 * ls->accel * stop_t) * stop_t;
+            ls->velocity = 0.;
+            ls->duration -= stop_t;
+        }
+    }
+    return linear_span_gen_steps(sk, qa, mcu_freq, ls, psdir);
+}
+
+// Generate step times for a stepper whose position is a linear
+// function of the move distance.  The position is then a quadratic
+// function of time during each phase of the velocity trapezoid and
+// the step times can be calculated directly.
+static int32_t
+itersolve_gen_steps_linear(struct stepper_kinematics *sk, struct move *m)
+{
+    struct stepcompress *sc = sk->sc;
+    double mcu_freq = stepcompress_get_mcu_freq(sc);
+    double ratio = sk->calc_ratio(sk, m);
+    double start_pos = sk->calc_position(sk, m, 0.);
+    int sdir = stepcompress_get_step_dir(sc);
+    struct queue_append qa = queue_append_start(sc, m->print_time, .5);
+    double decel_time = m->accel_t + m->cruise_t;
+    struct linear_span phases[3] = {
+        { 0., start_pos, ratio * m->accel.c1, ratio * 2. * m->accel.c2
+          , m->accel_t },
+        { m->accel_t, start_pos + ratio * m->cruise_start_d
+          , ratio * m->cruise_v, 0., m->cruise_t },
+        { decel_time, start_pos + ratio * m->decel_start_d
+          , ratio * m->decel.c1, ratio * 2. * m->decel.c2
+          , m->move_t - decel_time },
+    };
+    int i;
+    for (i = 0; i < 3; i++) {
+        int ret = linear_phase_gen_steps(sk, &qa, mcu_freq, &phases[i], &sdir);
+        if (ret)
+            return ret;
+    }
+    queue_append_finish(qa);
+    return 0;
+}
+
+// Generate step times for a stepper during a move
+int32_t __visible
+itersolve_gen_steps(struct stepper_kinematics *sk, struct move *m)
+{
+    if (sk->calc_ratio)
+        return itersolve_gen_steps_linear(sk, m);
+    return itersolve_gen_steps_iterative(sk, m);
+}
+
 void __visible
 itersolve_set_stepcompress(struct stepper_kinematics *sk
                            , struct stepcompress *sc, double step_dist)
@@ -236,3 +368,10 @@ itersolve_get_commanded_pos(struct stepper_kinematics *sk)
 {
     return sk->commanded_pos;
 }
+
+// Always use the iterative solver for this stepper
+void __visible
+itersolve_set_iterative(struct stepper_kinematics *sk)
+{
+    sk->calc_ratio = NULL;
+}
@@ -26,16 +26,26 @@ void move_fill(struct move *m, double print_time
                , double start_pos_x, double start_pos_y, double start_pos_z
                , double axes_d_x, double axes_d_y, double axes_d_z
                , double start_v, double cruise_v, double accel);
+void extruder_move_fill(struct move *m, double print_time
+                        , double accel_t, double cruise_t, double decel_t
+                        , double start_pos
+                        , double start_v, double cruise_v, double accel
+                        , double extra_accel_v, double extra_decel_v);
 double move_get_distance(struct move *m, double move_time);
 struct coord move_get_coord(struct move *m, double move_time);
 
 struct stepper_kinematics;
 typedef double (*sk_callback)(struct stepper_kinematics *sk, struct move *m
                               , double move_time);
+typedef double (*sk_ratio_callback)(struct stepper_kinematics *sk
+                                    , struct move *m);
 struct stepper_kinematics {
     double step_dist, commanded_pos;
     struct stepcompress *sc;
     sk_callback calc_position;
+    // Optional - only set when the stepper position is a linear
+    // function of the move distance
+    sk_ratio_callback calc_ratio;
 };
 
 int32_t itersolve_gen_steps(struct stepper_kinematics *sk, struct move *m);
@@ -45,5 +55,6 @@ double itersolve_calc_position_from_coord(struct stepper_kinematics *sk
                                           , double x, double y, double z);
 void itersolve_set_commanded_pos(struct stepper_kinematics *sk, double pos);
 double itersolve_get_commanded_pos(struct stepper_kinematics *sk);
+void itersolve_set_iterative(struct stepper_kinematics *sk);
 
 #endif // itersolve.h
@@ -31,16 +31,38 @@ cart_stepper_z_calc_position(struct stepper_kinematics *sk, struct move *m
     return move_get_coord(m, move_time).z;
 }
 
+static double
+cart_stepper_x_calc_ratio(struct stepper_kinematics *sk, struct move *m)
+{
+    return m->axes_r.x;
+}
+
+static double
+cart_stepper_y_calc_ratio(struct stepper_kinematics *sk, struct move *m)
+{
+    return m->axes_r.y;
+}
+
+static double
+cart_stepper_z_calc_ratio(struct stepper_kinematics *sk, struct move *m)
+{
+    return m->axes_r.z;
+}
+
 struct stepper_kinematics * __visible
 cartesian_stepper_alloc(char axis)
 {
     struct stepper_kinematics *sk = malloc(sizeof(*sk));
     memset(sk, 0, sizeof(*sk));
-    if (axis == 'x')
+    if (axis == 'x') {
         sk->calc_position = cart_stepper_x_calc_position;
-    else if (axis == 'y')
+        sk->calc_ratio = cart_stepper_x_calc_ratio;
+    } else if (axis == 'y') {
         sk->calc_position = cart_stepper_y_calc_position;
-    else if (axis == 'z')
+        sk->calc_ratio = cart_stepper_y_calc_ratio;
+    } else if (axis == 'z') {
         sk->calc_position = cart_stepper_z_calc_position;
+        sk->calc_ratio = cart_stepper_z_calc_ratio;
+    }
     return sk;
 }
@@ -17,12 +17,19 @@ extruder_calc_position(struct stepper_kinematics *sk, struct move *m
     return m->start_pos.x + move_get_distance(m, move_time);
 }
 
+static double
+extruder_calc_ratio(struct stepper_kinematics *sk, struct move *m)
+{
+    return 1.;
+}
+
 struct stepper_kinematics * __visible
 extruder_stepper_alloc(void)
 {
     struct stepper_kinematics *sk = malloc(sizeof(*sk));
     memset(sk, 0, sizeof(*sk));
     sk->calc_position = extruder_calc_position;
+    sk->calc_ratio = extruder_calc_ratio;
     return sk;
 }
 
@@ -0,0 +1,195 @@
+// Move queue "lookahead" junction velocity calculations
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "lookahead.h" // lookahead_alloc
+#include "pyhelper.h" // errorf
+
+// Velocity (squared) limits of each queued move stored as a
+// struct-of-arrays so the backward pass scans contiguous memory.
+struct lookahead {
+    int count, size;
+    double *max_start_v2, *delta_v2, *max_smoothed_v2, *smooth_delta_v2;
+    double *max_cruise_v2;
+};
+
+// Return the smaller of two values using the same comparison as the
+// python min() builtin (so results are bit-for-bit identical)
+static inline double
+py_min(double a, double b)
+{
+    return b < a ? b : a;
+}
+
+struct lookahead * __visible
+lookahead_alloc(void)
+{
+    struct lookahead *la = malloc(sizeof(*la));
+    memset(la, 0, sizeof(*la));
+    return la;
+}
+
+void __visible
+lookahead_free(struct lookahead *la)
+{
+    if (!la)
+        return;
+    free(la->max_start_v2);
+    free(la->delta_v2);
+    free(la->max_smoothed_v2);
+    free(la->smooth_delta_v2);
+    free(la->max_cruise_v2);
+    free(la);
+}
+
+void __visible
+lookahead_reset(struct lookahead *la)
+{
+    la->count = 0;
+}
+
+// Grow the storage arrays
+static int
+lookahead_expand(struct lookahead *la)
+{
+    int size = la->size ? la->size * 2 : 1024;
+    double **arrays[] = {
+        &la->max_start_v2, &la->delta_v2, &la->max_smoothed_v2,
+        &la->smooth_delta_v2, &la->max_cruise_v2
+    };
+    int i;
+    for (i = 0; i < ARRAY_SIZE(arrays); i++) {
+        double *n = realloc(*arrays[i], size * sizeof(double));
+        if (!n) {
+            errorf("lookahead_expand: out of memory");
+            return -1;
+        }
+        *arrays[i] = n;
+    }
+    la->size = size;
+    return 0;
+}
+
+// Append the velocity limits of a move to the end of the queue
+int __visible
+lookahead_add(struct lookahead *la, double max_start_v2, double delta_v2
+              , double max_smoothed_v2, double smooth_delta_v2
+              , double max_cruise_v2)
+{
+    if (la->count >= la->size) {
+        int ret = lookahead_expand(la);
+        if (ret)
+            return ret;
+    }
+    int pos = la->count++;
+    la->max_start_v2[pos] = max_start_v2;
+    la->delta_v2[pos] = delta_v2;
+    la->max_smoothed_v2[pos] = max_smoothed_v2;
+    la->smooth_delta_v2[pos] = smooth_delta_v2;
+    la->max_cruise_v2[pos] = max_cruise_v2;
+    return 0;
+}
+
+// Store the junction velocities for a move
+static inline void
+set_junction(double *junctions, int pos, double start_v2, double cruise_v2
+             , double end_v2)
+{
+    junctions[pos*3] = start_v2;
+    junctions[pos*3 + 1] = cruise_v2;
+    junctions[pos*3 + 2] = end_v2;
+}
+
+// Traverse the queue from last to first move and determine the
+// maximum junction speeds assuming the robot comes to a complete stop
+// after the last move.  This mirrors MoveQueue.flush() in toolhead.py.
+// The (start_v2, cruise_v2, end_v2) of each move that should have
+// set_junction() called is stored in 'junctions' - all other moves
+// have a negative cruise_v2.  Returns the number of moves that may be
+// flushed, or -1 if no moves may be flushed yet (lazy mode only).
+int __visible
+lookahead_flush(struct lookahead *la, int leftover, int lazy
+                , double *junctions)
+{
+    int update_flush_count = lazy, flush_count = la->count;
+    // Delayed moves are always the contiguous run i+1..i+delayed_count
+    int delayed_count = 0;
+    double next_end_v2 = 0., next_smoothed_v2 = 0., peak_cruise_v2 = 0.;
+    int i;
+    for (i = la->count - 1; i >= leftover; i--) {
+        double reachable_start_v2 = next_end_v2 + la->delta_v2[i];
+        double start_v2 = py_min(la->max_start_v2[i], reachable_start_v2);
+        double reachable_smoothed_v2 = (next_smoothed_v2
+                                        + la->smooth_delta_v2[i]);
+        double smoothed_v2 = py_min(la->max_smoothed_v2[i]
+                                    , reachable_smoothed_v2);
+        set_junction(junctions, i, start_v2, -1., next_end_v2);
+        if (smoothed_v2 < reachable_smoothed_v2) {
+            // It's possible for this move to accelerate
+            if (smoothed_v2 + la->smooth_delta_v2[i] > next_smoothed_v2
+                || delayed_count) {
+                // This move can decelerate or this is a full accel
+                // move after a full decel move
+                if (update_flush_count && peak_cruise_v2) {
+                    flush_count = i;
+                    update_flush_count = 0;
+                }
+                peak_cruise_v2 = py_min(la->max_cruise_v2[i], (
+                    smoothed_v2 + reachable_smoothed_v2) * .5);
+                if (delayed_count) {
+                    // Propagate peak_cruise_v2 to any delayed moves
+                    if (!update_flush_count && i < flush_count) {
+                        double mc_v2 = peak_cruise_v2;
+                        int j;
+                        for (j = i + 1; j <= i + delayed_count; j++) {
+                            double ms_v2 = junctions[j*3];
+                            double me_v2 = junctions[j*3 + 2];
+                            mc_v2 = py_min(mc_v2, ms_v2);
+                            set_junction(junctions, j, py_min(ms_v2, mc_v2)
+                                         , mc_v2, py_min(me_v2, mc_v2));
+                        }
+                    }
+                    delayed_count = 0;
+                }
+            }
+            if (!update_flush_count && i < flush_count) {
+                double cruise_v2 = py_min(py_min(
+                    (start_v2 + reachable_start_v2) * .5
+                    , la->max_cruise_v2[i]), peak_cruise_v2);
+                set_junction(junctions, i, py_min(start_v2, cruise_v2)
+                             , cruise_v2, py_min(next_end_v2, cruise_v2));
+            }
+        } else {
+            // Delay calculating this move until peak_cruise_v2 is known
+            delayed_count++;
+        }
+        next_end_v2 = start_v2;
+        next_smoothed_v2 = smoothed_v2;
+    }
+    if (update_flush_count)
+        return -1;
+    return flush_count;
+}
+
+// Remove moves from the start of the queue
+void __visible
+lookahead_remove(struct lookahead *la, int count)
+{
+    if (count >= la->count) {
+        la->count = 0;
+        return;
+    }
+    int remain = la->count - count;
+    memmove(la->max_start_v2, &la->max_start_v2[count], remain*sizeof(double));
+    memmove(la->delta_v2, &la->delta_v2[count], remain*sizeof(double));
+    memmove(la->max_smoothed_v2, &la->max_smoothed_v2[count]
+            , remain*sizeof(double));
+    memmove(la->smooth_delta_v2, &la->smooth_delta_v2[count]
+            , remain*sizeof(double));
+    memmove(la->max_cruise_v2, &la->max_cruise_v2[count]
+            , remain*sizeof(double));
+    la->count = remain;
+}
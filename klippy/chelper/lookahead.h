@@ -0,0 +1,14 @@
+#ifndef LOOKAHEAD_H
+#define LOOKAHEAD_H
+
+struct lookahead *lookahead_alloc(void);
+void lookahead_free(struct lookahead *la);
+void lookahead_reset(struct lookahead *la);
+int lookahead_add(struct lookahead *la, double max_start_v2, double delta_v2
+                  , double max_smoothed_v2, double smooth_delta_v2
+                  , double max_cruise_v2);
+int lookahead_flush(struct lookahead *la, int leftover, int lazy
+                    , double *junctions);
+void lookahead_remove(struct lookahead *la, int count);
+
+#endif // lookahead.h
@@ -973,7 +973,7 @@ serialqueue_send(struct serialqueue *sq, struct command_queue *cq, uint8_t *msg
 }
 
 // Like serialqueue_send() but also builds the message to be sent
-void
+void __visible
 serialqueue_encode_and_send(struct serialqueue *sq, struct command_queue *cq
                             , uint32_t *data, int len
                             , uint64_t min_clock, uint64_t req_clock)
@@ -988,6 +988,27 @@ serialqueue_encode_and_send(struct serialqueue *sq, struct command_queue *cq
     serialqueue_send_batch(sq, cq, &msgs);
 }
 
+// Schedule the transmission of several messages at once.  The
+// messages are stored back to back in 'data' and 'lens' holds the
+// length of each message.
+void __visible
+serialqueue_send_multi(struct serialqueue *sq, struct command_queue *cq
+                       , uint8_t *data, int *lens, int count
+                       , uint64_t min_clock, uint64_t req_clock)
+{
+    struct list_head msgs;
+    list_init(&msgs);
+    int i;
+    for (i=0; i<count; i++) {
+        struct queue_message *qm = message_fill(data, lens[i]);
+        qm->min_clock = min_clock;
+        qm->req_clock = req_clock;
+        list_add_tail(&qm->node, &msgs);
+        data += lens[i];
+    }
+    serialqueue_send_batch(sq, cq, &msgs);
+}
+
 // Return a message read from the serial port (or wait for one if none
 // available)
 void __visible
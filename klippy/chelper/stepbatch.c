@@ -0,0 +1,315 @@
+// Batched step generation
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+
+#include <pthread.h> // pthread_mutex_lock
+#include <stdlib.h> // malloc
+#include <string.h> // memset
+#include "compiler.h" // __visible
+#include "itersolve.h" // itersolve_gen_steps
+#include "pyhelper.h" // errorf
+#include "stepbatch.h" // struct stepbatch_op
+#include "stepcompress.h" // steppersync_flush
+
+
+/****************************************************************
+ * Step generation worker threads
+ ****************************************************************/
+
+// All itersolve_gen_steps() requests for a single stepcompress queue
+struct stepbatch_group {
+    struct stepcompress *sc;
+    int count;
+    struct stepbatch_job {
+        struct stepper_kinematics *sk;
+        struct move *m;
+    } *jobs;
+};
+
+struct stepbatch_pool {
+    int num_threads;
+    pthread_t *threads;
+    pthread_mutex_t lock; // protects variables below
+    pthread_cond_t cond, done_cond;
+    int exit;
+    struct stepbatch_group *groups;
+    int group_count, next_group, pending;
+    int32_t ret;
+};
+
+// Generate the steps for all requests in a group
+static int32_t
+stepbatch_group_run(struct stepbatch_group *g)
+{
+    int i;
+    for (i = 0; i < g->count; i++) {
+        int32_t ret = itersolve_gen_steps(g->jobs[i].sk, g->jobs[i].m);
+        if (ret)
+            return ret;
+    }
+    return 0;
+}
+
+// Claim and run groups until there are none left (pool lock held)
+static void
+stepbatch_pool_work(struct stepbatch_pool *sp)
+{
+    while (sp->next_group < sp->group_count) {
+        struct stepbatch_group *g = &sp->groups[sp->next_group++];
+        pthread_mutex_unlock(&sp->lock);
+        int32_t ret = stepbatch_group_run(g);
+        pthread_mutex_lock(&sp->lock);
+        if (ret && !sp->ret)
+            sp->ret = ret;
+        if (!--sp->pending)
+            pthread_cond_signal(&sp->done_cond);
+    }
+}
+
+static void *
+stepbatch_worker(void *data)
+{
+    struct stepbatch_pool *sp = data;
+    pthread_mutex_lock(&sp->lock);
+    for (;;) {
+        if (sp->exit)
+            break;
+        if (sp->next_group >= sp->group_count) {
+            pthread_cond_wait(&sp->cond, &sp->lock);
+            continue;
+        }
+        stepbatch_pool_work(sp);
+    }
+    pthread_mutex_unlock(&sp->lock);
+    return NULL;
+}
+
+// Run all groups on the pool threads (and the calling thread)
+static int32_t
+stepbatch_pool_run(struct stepbatch_pool *sp, struct stepbatch_group *groups
+                   , int group_count)
+{
+    pthread_mutex_lock(&sp->lock);
+    sp->groups = groups;
+    sp->group_count = sp->pending = group_count;
+    sp->next_group = 0;
+    sp->ret = 0;
+    pthread_cond_broadcast(&sp->cond);
+    stepbatch_pool_work(sp);
+    while (sp->pending)
+        pthread_cond_wait(&sp->done_cond, &sp->lock);
+    int32_t ret = sp->ret;
+    sp->groups = NULL;
+    sp->group_count = sp->next_group = 0;
+    pthread_mutex_unlock(&sp->lock);
+    return ret;
+}
+
+void __visible
+stepbatch_pool_free(struct stepbatch_pool *sp)
+{
+    if (!sp)
+        return;
+    pthread_mutex_lock(&sp->lock);
+    sp->exit = 1;
+    pthread_cond_broadcast(&sp->cond);
+    pthread_mutex_unlock(&sp->lock);
+    int i;
+    for (i = 0; i < sp->num_threads; i++) {
+        int ret = pthread_join(sp->threads[i], NULL);
+        if (ret)
+            report_errno("pthread_join", ret);
+    }
+    pthread_cond_destroy(&sp->done_cond);
+    pthread_cond_destroy(&sp->cond);
+    pthread_mutex_destroy(&sp->lock);
+    free(sp->threads);
+    free(sp);
+}
+
+// Create a pool with 'num_threads' additional step generation threads
+struct stepbatch_pool * __visible
+stepbatch_pool_alloc(int num_threads)
+{
+    struct stepbatch_pool *sp = malloc(sizeof(*sp));
+    if (!sp) {
+        errorf("stepbatch_pool_alloc: out of memory");
+        return NULL;
+    }
+    memset(sp, 0, sizeof(*sp));
+    pthread_mutex_init(&sp->lock, NULL);
+    pthread_cond_init(&sp->cond, NULL);
+    pthread_cond_init(&sp->done_cond, NULL);
+    sp->threads = malloc(num_threads * sizeof(sp->threads[0]));
+    if (!sp->threads) {
+        errorf("stepbatch_pool_alloc: out of memory");
+        stepbatch_pool_free(sp);
+        return NULL;
+    }
+    int i;
+    for (i = 0; i < num_threads; i++) {
+        int ret = pthread_create(&sp->threads[i], NULL, stepbatch_worker, sp);
+        if (ret) {
+            report_errno("pthread_create", ret);
+            stepbatch_pool_free(sp);
+            return NULL;
+        }
+        sp->num_threads++;
+    }
+    return sp;
+}
+
+
+/****************************************************************
+ * Batch processing
+ ****************************************************************/
+
+static void
+stepbatch_fill(struct stepbatch_op *op, struct move *m, double *params)
+{
+    double *p = &params[op->param_pos];
+    if (op->type == SB_MOVE_FILL)
+        move_fill(m, p[0], p[1], p[2], p[3], p[4], p[5], p[6]
+                  , p[7], p[8], p[9], p[10], p[11], p[12]);
+    else
+        extruder_move_fill(m, p[0], p[1], p[2], p[3], p[4], p[5]
+                           , p[6], p[7], p[8], p[9]);
+}
+
+// Run the ops one at a time in the calling thread
+static int32_t
+stepbatch_run_serial(struct stepbatch_op *ops, int count, double *params)
+{
+    int i;
+    for (i = 0; i < count; i++) {
+        struct stepbatch_op *op = &ops[i];
+        int32_t ret = 0;
+        switch (op->type) {
+        case SB_MOVE_FILL:
+        case SB_EXTRUDER_MOVE_FILL:
+            stepbatch_fill(op, op->obj, params);
+            break;
+        case SB_GEN_STEPS:
+            ret = itersolve_gen_steps(op->obj, op->m);
+            break;
+        case SB_STEPPERSYNC_FLUSH:
+            ret = steppersync_flush(op->obj, op->clock);
+            break;
+        default:
+            errorf("stepbatch_run: invalid op type %d", op->type);
+            return -1;
+        }
+        if (ret)
+            return ret;
+    }
+    return 0;
+}
+
+// Generate the steps for each stepcompress queue in parallel.  Every
+// fill op is stored in its own 'struct move' so that the steps of
+// all moves can be generated concurrently, and the steppersync
+// flushes are then run once all steps are known.
+static int32_t
+stepbatch_run_parallel(struct stepbatch_pool *sp, struct stepbatch_op *ops
+                       , int count, double *params)
+{
+    struct move *moves = malloc(count * sizeof(*moves));
+    struct stepbatch_group *groups = malloc(count * sizeof(*groups));
+    struct stepbatch_job *jobs = malloc(count * sizeof(*jobs));
+    struct stepbatch_job *group_jobs = malloc(count * sizeof(*group_jobs));
+    struct move **last_fill = malloc(count * sizeof(*last_fill));
+    int move_count = 0, group_count = 0, pos = 0, i, j;
+    int32_t ret = 0;
+    if (!moves || !groups || !jobs || !group_jobs || !last_fill) {
+        errorf("stepbatch_run: out of memory");
+        ret = -1;
+        goto done;
+    }
+    // Assign private moves and group the step generation requests
+    for (i = 0; i < count; i++) {
+        struct stepbatch_op *op = &ops[i];
+        switch (op->type) {
+        case SB_MOVE_FILL:
+        case SB_EXTRUDER_MOVE_FILL:
+            // Fill the caller's move (it may be used after this batch)
+            // and take a private copy for the worker threads
+            stepbatch_fill(op, op->obj, params);
+            moves[move_count] = *(struct move *)op->obj;
+            last_fill[move_count++] = op->obj;
+            break;
+        case SB_GEN_STEPS: {
+            // Find the most recent fill of this move (or take a copy
+            // if it was filled before this batch)
+            for (j = move_count - 1; j >= 0; j--)
+                if (last_fill[j] == op->m)
+                    break;
+            if (j < 0) {
+                j = move_count++;
+                moves[j] = *op->m;
+                last_fill[j] = op->m;
+            }
+            struct move *m = &moves[j];
+            struct stepper_kinematics *sk = op->obj;
+            for (j = 0; j < group_count; j++)
+                if (groups[j].sc == sk->sc)
+                    break;
+            if (j == group_count) {
+                groups[j].sc = sk->sc;
+                groups[j].count = 0;
+                group_count++;
+            }
+            // Jobs are stored per group in a second pass (below)
+            jobs[i].sk = sk;
+            jobs[i].m = m;
+            break;
+        }
+        case SB_STEPPERSYNC_FLUSH:
+            break;
+        default:
+            errorf("stepbatch_run: invalid op type %d", op->type);
+            ret = -1;
+            goto done;
+        }
+    }
+    // Lay out each group's jobs contiguously (preserving op order)
+    for (j = 0; j < group_count; j++) {
+        struct stepbatch_group *g = &groups[j];
+        g->jobs = &group_jobs[pos];
+        for (i = 0; i < count; i++)
+            if (ops[i].type == SB_GEN_STEPS && jobs[i].sk->sc == g->sc)
+                g->jobs[g->count++] = jobs[i];
+        pos += g->count;
+    }
+    ret = stepbatch_pool_run(sp, groups, group_count);
+    if (ret)
+        goto done;
+    // Flush the step queues
+    for (i = 0; i < count; i++) {
+        struct stepbatch_op *op = &ops[i];
+        if (op->type != SB_STEPPERSYNC_FLUSH)
+            continue;
+        ret = steppersync_flush(op->obj, op->clock);
+        if (ret)
+            break;
+    }
+done:
+    free(last_fill);
+    free(group_jobs);
+    free(jobs);
+    free(groups);
+    free(moves);
+    return ret;
+}
+
+// Run a sequence of recorded move_fill(), extruder_move_fill(),
+// itersolve_gen_steps(), and steppersync_flush() calls with a single
+// call from the host.  Without a pool the ops are run in order, so
+// the result is identical to making the individual calls.
+int32_t __visible
+stepbatch_run(struct stepbatch_pool *sp, struct stepbatch_op *ops, int count
+              , double *params)
+{
+    if (sp)
+        return stepbatch_run_parallel(sp, ops, count, params);
+    return stepbatch_run_serial(ops, count, params);
+}
@@ -0,0 +1,23 @@
+#ifndef STEPBATCH_H
+#define STEPBATCH_H
+
+#include <stdint.h> // uint64_t
+
+// Op codes (these must match the definitions in mcu.py)
+enum {
+    SB_MOVE_FILL, SB_EXTRUDER_MOVE_FILL, SB_GEN_STEPS, SB_STEPPERSYNC_FLUSH,
+};
+
+struct stepbatch_op {
+    int type, param_pos;
+    void *obj;
+    struct move *m;
+    uint64_t clock;
+};
+
+struct stepbatch_pool *stepbatch_pool_alloc(int num_threads);
+void stepbatch_pool_free(struct stepbatch_pool *sp);
+int32_t stepbatch_run(struct stepbatch_pool *sp, struct stepbatch_op *ops
+                      , int count, double *params);
+
+#endif // stepbatch.h
@@ -93,11 +93,26 @@ compress_bisect_add(struct stepcompress *sc)
     uint32_t *qlast = sc->queue_next;
     if (qlast > sc->queue_pos + 65535)
         qlast = sc->queue_pos + 65535;
+    int32_t qcount = qlast - sc->queue_pos;
+
+    // Steps with a constant interval (as is common during long
+    // constant velocity moves) are covered by a single add=0 sequence
+    uint32_t *pos = sc->queue_pos;
+    uint32_t first_interval = *pos - (uint32_t)sc->last_step_clock;
+    for (pos++; pos < qlast; pos++)
+        if (*pos - *(pos-1) != first_interval)
+            break;
+    int32_t const_count = pos - sc->queue_pos;
+    if (const_count >= qcount)
+        return (struct step_move){ first_interval, qcount, 0 };
+
     struct points point = minmax_point(sc, sc->queue_pos);
     int32_t outer_mininterval = point.minp, outer_maxinterval = point.maxp;
     int32_t add = 0, minadd = -0x8000, maxadd = 0x7fff;
     int32_t bestinterval = 0, bestcount = 1, bestadd = 1, bestreach = INT32_MIN;
     int32_t zerointerval = 0, zerocount = 0;
+    if (const_count <= 0x200)
+        const_count = 0;
 
     for (;;) {
         // Find longest valid sequence with the given 'add'
@@ -105,6 +120,15 @@ compress_bisect_add(struct stepcompress *sc)
         int32_t nextmininterval = outer_mininterval;
         int32_t nextmaxinterval = outer_maxinterval, interval = nextmaxinterval;
         int32_t nextcount = 1;
+        if (const_count) {
+            // The valid interval range after a long run of constant
+            // interval steps is known - start the add=0 search after
+            // the run (no other 'add' is tried after such a sequence)
+            int32_t max_error = point.maxp - point.minp;
+            nextmininterval = first_interval - max_error / const_count;
+            nextcount = const_count;
+            const_count = 0;
+        }
         for (;;) {
             nextcount++;
             if (&sc->queue_pos[nextcount-1] >= qlast) {
@@ -10,9 +10,7 @@ DECAY = 1. / 30.
 TRANSMIT_EXTRA = .001
 
 class ClockSync:
-    def __init__(self, reactor): 
-        logging.info("  ")
-        logging.info("====================== mainsync.ClockSync.__init__ START =======================")
+    def __init__(self, reactor):
         self.reactor = reactor
         self.serial = None
         self.get_clock_timer = reactor.register_timer(self._get_clock_event)
@@ -29,8 +27,6 @@ class ClockSync:
         self.clock_avg = self.clock_covariance = 0.
         self.prediction_variance = 0.
         self.last_prediction_time = 0.
-        logging.info("==================== mainsync.ClockSync.__init__ END =====================")
-        logging.info("  ")
     def connect(self, serial):
         self.serial = serial
         self.mcu_freq = serial.msgparser.get_constant_float('CLOCK_FREQ')
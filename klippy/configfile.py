@@ -26,7 +26,7 @@ class ConfigWrapper:
         if (default is not sentinel
             and not self.fileconfig.has_option(self.section, option)):
             return default
-        self.access_tracking[(self.section.lower(), option.lower())] = 1
+        self.access_tracking.add((self.section.lower(), option.lower()))
         try:
             v = parser(self.section, option)
         except self.error as e:
@@ -72,19 +72,26 @@ class ConfigWrapper:
     def has_section(self, section):
         return self.fileconfig.has_section(section)
     def get_prefix_sections(self, prefix):
-        logging.info("================== get_prefix_sections()-[ConfigWrapper] START ==================")
-        logging.info("prefix is:") 
-        logging.info(prefix) 
-        logging.info("self.fileconfig is:")
-        logging.info(self.fileconfig)  
-        logging.info("============== ==== get_prefix_sections()--[ConfigWrapper] END ==================")      
-        logging.info("  ")
         return [self.getsection(s) for s in self.fileconfig.sections()
                 if s.startswith(prefix)]
     def get_prefix_options(self, prefix):
         return [o for o in self.fileconfig.options(self.section)
                 if o.startswith(prefix)]
 
+def copy_fileconfig(fileconfig):
+    new_fileconfig = ConfigParser.RawConfigParser()
+    for section in fileconfig.sections():
+        new_fileconfig.add_section(section)
+        for option, value in fileconfig.items(section):
+            new_fileconfig.set(section, option, value)
+    return new_fileconfig
+
+# Parsed form of each main config file from the last time it was read
+# (kept across a RESTART).  An entry is only used if the contents of
+# the config file, of every included file, and the result of every
+# include glob are unchanged.
+parsed_config_cache = {}
+
 AUTOSAVE_HEADER = """
 #*# <---------------------- SAVE_CONFIG ---------------------->
 #*# DO NOT EDIT THIS BLOCK OR BELOW. The contents are auto-generated.
@@ -95,6 +102,7 @@ class PrinterConfig:
     def __init__(self, printer):
         self.printer = printer
         self.autosave = None
+        self.file_deps = None
         gcode = self.printer.lookup_object('gcode')
         gcode.register_command("SAVE_CONFIG", self.cmd_SAVE_CONFIG,
                                desc=self.cmd_SAVE_CONFIG_help)
@@ -107,6 +115,8 @@ class PrinterConfig:
             msg = "Unable to open config file %s" % (filename,)
             logging.exception(msg)
             raise error(msg)
+        if self.file_deps is not None:
+            self.file_deps[('file', filename)] = data
         return data.replace('\r\n', '\n')
     def _find_autosave_data(self, data):
         regular_data = data
@@ -173,6 +183,8 @@ class PrinterConfig:
             # Empty set is OK if wildcard but not for direct file reference
             raise error("Include file '%s' does not exist" % (include_glob,))
         include_filenames.sort()
+        if self.file_deps is not None:
+            self.file_deps[('glob', include_glob)] = include_filenames
         for include_filename in include_filenames:
             include_data = self._read_config_file(include_filename)
             self._parse_config(include_data, include_filename, fileconfig,
@@ -207,7 +219,7 @@ class PrinterConfig:
     def _build_config_wrapper(self, data, filename):
         fileconfig = ConfigParser.RawConfigParser()
         self._parse_config(data, filename, fileconfig, set())
-        return ConfigWrapper(self.printer, fileconfig, {}, 'printer')
+        return ConfigWrapper(self.printer, fileconfig, set(), 'printer')
     def _build_config_string(self, config):
         sfile = StringIO.StringIO()
         config.fileconfig.write(sfile)
@@ -215,29 +227,72 @@ class PrinterConfig:
     def read_config(self, filename):
         return self._build_config_wrapper(self._read_config_file(filename),
                                           filename)
+    def _check_file_deps(self, file_deps):
+        for (dep_type, name), value in file_deps.items():
+            if dep_type == 'glob':
+                if sorted(glob.glob(name)) != value:
+                    return False
+                continue
+            try:
+                f = open(name, 'rb')
+                data = f.read()
+                f.close()
+            except:
+                return False
+            if data != value:
+                return False
+        return True
+    def _wrap_fileconfig(self, fileconfig):
+        return ConfigWrapper(self.printer, copy_fileconfig(fileconfig),
+                             set(), 'printer')
     def read_main_config(self):
         filename = self.printer.get_start_args()['config_file']
-        data = self._read_config_file(filename)
-        regular_data, autosave_data = self._find_autosave_data(data)
-        regular_config = self._build_config_wrapper(regular_data, filename)
-        autosave_data = self._strip_duplicates(autosave_data, regular_config)
-        self.autosave = self._build_config_wrapper(autosave_data, filename)
-        self._config = self._build_config_wrapper(regular_data + autosave_data,
-                                                  filename)
+        cached = parsed_config_cache.get(filename)
+        if cached is not None and self._check_file_deps(cached[0]):
+            logging.info("Config file %s unchanged - using cached copy",
+                         filename)
+            file_deps, autosave, config = cached
+            self.autosave = self._wrap_fileconfig(autosave)
+            self._config = self._wrap_fileconfig(config)
+            return self._config
+        self.file_deps = file_deps = {}
+        try:
+            data = self._read_config_file(filename)
+            regular_data, autosave_data = self._find_autosave_data(data)
+            regular_config = self._build_config_wrapper(regular_data, filename)
+            autosave_data = self._strip_duplicates(autosave_data,
+                                                   regular_config)
+            self.autosave = self._build_config_wrapper(autosave_data, filename)
+            self._config = self._build_config_wrapper(
+                regular_data + autosave_data, filename)
+        finally:
+            self.file_deps = None
+        parsed_config_cache[filename] = (
+            file_deps, copy_fileconfig(self.autosave.fileconfig),
+            copy_fileconfig(self._config.fileconfig))
         return self._config
     def check_unused_options(self, config):
         fileconfig = config.fileconfig
         objects = dict(self.printer.lookup_objects())
         # Determine all the fields that have been accessed
-        access_tracking = dict(config.access_tracking)
-        for section in self.autosave.fileconfig.sections():
-            for option in self.autosave.fileconfig.options(section):
-                access_tracking[(section.lower(), option.lower())] = 1
-        # Validate that there are no undefined parameters in the config file
-        valid_sections = { s: 1 for s, o in access_tracking }
+        access_tracking = set(config.access_tracking)
+        autosave = self.autosave.fileconfig
+        access_tracking.update([(section.lower(), option.lower())
+                                for section in autosave.sections()
+                                for option in autosave.options(section)])
+        valid_sections = set([s for s, o in access_tracking])
+        valid_sections.update(objects)
+        file_options = set([(section.lower(), option.lower())
+                            for section in fileconfig.sections()
+                            for option in fileconfig.options(section)])
+        if (valid_sections.issuperset([s.lower()
+                                       for s in fileconfig.sections()])
+            and access_tracking.issuperset(file_options)):
+            return
+        # Report the first undefined parameter in the config file
         for section_name in fileconfig.sections():
             section = section_name.lower()
-            if section not in valid_sections and section not in objects:
+            if section not in valid_sections:
                 raise error("Section '%s' is not a valid config section" % (
                     section,))
             for option in fileconfig.options(section_name):
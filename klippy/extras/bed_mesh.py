@@ -499,11 +499,14 @@ class BedMeshCalibrate:
 
 
 class MoveSplitter:
+    SPLIT_MODES = {'distance': 'distance', 'cell': 'cell'}
     def __init__(self, config, gcode):
         self.split_delta_z = config.getfloat(
             'split_delta_z', .025, minval=0.01)
         self.move_check_distance = config.getfloat(
             'move_check_distance', 5., minval=3.)
+        self.split_mode = config.getchoice(
+            'split_mode', self.SPLIT_MODES, 'distance')
         self.z_mesh = None
         self.gcode = gcode
     def initialize(self, mesh):
@@ -519,6 +522,10 @@ class MoveSplitter:
         axes_d = [self.next_pos[i] - self.prev_pos[i] for i in range(4)]
         self.total_move_length = math.sqrt(sum([d*d for d in axes_d[:3]]))
         self.axis_move = [not isclose(d, 0., abs_tol=1e-10) for d in axes_d]
+        self.split_points = []
+        if self.split_mode == 'cell' and (
+                self.axis_move[0] or self.axis_move[1]):
+            self.split_points = self._calc_cell_splits()
     def _calc_z_offset(self, pos):
         z = self.z_mesh.calc_z(pos[0], pos[1])
         return self.z_factor * z + self.z_mesh.mesh_offset
@@ -532,9 +539,105 @@ class MoveSplitter:
             if self.axis_move[i]:
                 self.current_pos[i] = lerp(
                     t, self.prev_pos[i], self.next_pos[i])
+    def _get_position(self, t):
+        return [lerp(t, p, n) if m else p
+                for p, n, m in zip(self.prev_pos, self.next_pos,
+                                   self.axis_move)]
+    def _calc_cell_splits(self):
+        # Find where the move crosses the grid lines of the mesh
+        mesh = self.z_mesh
+        breaks = [0., 1.]
+        for axis, mesh_min, mesh_dist, mesh_cnt in [
+                (0, mesh.mesh_x_min, mesh.mesh_x_dist, mesh.mesh_x_count),
+                (1, mesh.mesh_y_min, mesh.mesh_y_dist, mesh.mesh_y_count)]:
+            if not self.axis_move[axis]:
+                continue
+            start = self.prev_pos[axis]
+            dist = self.next_pos[axis] - start
+            f0 = (start - mesh_min) / mesh_dist
+            f1 = (start + dist - mesh_min) / mesh_dist
+            lo = max(0, int(math.floor(min(f0, f1))) + 1)
+            hi = min(mesh_cnt - 1, int(math.ceil(max(f0, f1))) - 1)
+            for idx in range(lo, hi + 1):
+                t = (mesh_min + idx * mesh_dist - start) / dist
+                if t > 0. and t < 1.:
+                    breaks.append(t)
+        breaks.sort()
+        # Within a cell the z offset is a quadratic function of the
+        # position along the move, so it is fully described by its
+        # value at the start, middle, and end of the cell.  Cells are
+        # subdivided until each piece deviates from a straight line by
+        # less than split_delta_z.
+        delta_z = self.split_delta_z
+        x0, y0 = self.prev_pos[:2]
+        dx, dy = self.next_pos[0] - x0, self.next_pos[1] - y0
+        calc_z = (lambda t: self._calc_z_offset((x0 + dx * t, y0 + dy * t)))
+        z0 = self.z_offset
+        if len(breaks) == 2:
+            # Move within a single cell
+            zm = calc_z(.5)
+            if abs(zm - .5 * (z0 + calc_z(1.))) < delta_z:
+                return []
+        pieces = []
+        for t0, t1 in zip(breaks[:-1], breaks[1:]):
+            if t1 - t0 < 1e-9:
+                continue
+            zm = calc_z(.5 * (t0 + t1))
+            z1 = calc_z(t1)
+            # z(u) = z0 + b*u + c*u**2 for u from 0 to 1
+            c = 2. * (z0 + z1 - 2. * zm)
+            b = z1 - z0 - c
+            count = int(math.sqrt(.25 * abs(c) / delta_z)) + 1
+            for i in range(count):
+                u0, u1 = float(i) / count, float(i + 1) / count
+                um = .5 * (u0 + u1)
+                pieces.append((t0 + (t1 - t0) * u0, t0 + (t1 - t0) * u1,
+                               z0 + (b + c * u0) * u0, z0 + (b + c * um) * um,
+                               z0 + (b + c * u1) * u1))
+            z0 = z1
+        # Emit the fewest splits such that the mesh is within
+        # split_delta_z of the straight line between splits
+        splits = []
+        start = 0
+        while start < len(pieces):
+            end = start + 1
+            while (end < len(pieces)
+                   and self._check_line(pieces[start:end + 1])):
+                end += 1
+            if end < len(pieces):
+                t = pieces[end][0]
+                pos = self._get_position(t)
+                pos[2] += pieces[end][2]
+                splits.append(pos)
+            start = end
+        splits.reverse()
+        return splits
+    def _check_line(self, pieces):
+        # Check the deviation of each piece from the line between the
+        # start of the first piece and the end of the last piece
+        line_t0, line_t1 = pieces[0][0], pieces[-1][1]
+        line_z0, line_z1 = pieces[0][2], pieces[-1][4]
+        slope = (line_z1 - line_z0) / (line_t1 - line_t0)
+        for t0, t1, z0, zm, z1 in pieces:
+            d0 = z0 - line_z0 - slope * (t0 - line_t0)
+            dm = zm - line_z0 - slope * (.5 * (t0 + t1) - line_t0)
+            d1 = z1 - line_z0 - slope * (t1 - line_t0)
+            dev = max(abs(d0), abs(d1))
+            c = 2. * (d0 + d1 - 2. * dm)
+            if c:
+                b = d1 - d0 - c
+                u = -.5 * b / c
+                if u > 0. and u < 1.:
+                    dev = max(dev, abs(d0 + (b + c * u) * u))
+            if dev >= self.split_delta_z:
+                return False
+        return True
     def split(self):
         if not self.traverse_complete:
-            if self.axis_move[0] or self.axis_move[1]:
+            if self.split_points:
+                return self.split_points.pop()
+            if self.split_mode == 'distance' and (
+                    self.axis_move[0] or self.axis_move[1]):
                 # X and/or Y axis move, traverse if necessary
                 while self.distance_checked + self.move_check_distance \
                         < self.total_move_length:
@@ -562,6 +665,7 @@ class MoveSplitter:
 class ZMesh:
     def __init__(self, params):
         self.mesh_z_table = None
+        self.mesh_coeffs = None
         self.probe_params = params
         self.avg_z = 0.
         self.mesh_offset = 0.
@@ -624,6 +728,7 @@ class ZMesh:
             print_func("bed_mesh: Z Mesh not generated")
     def build_mesh(self, z_table):
         self._sample(z_table)
+        self._build_coeffs()
         self.avg_z = (sum([sum(x) for x in self.mesh_z_table]) /
                       sum([len(x) for x in self.mesh_z_table]))
         # Round average to the nearest 100th.  This
@@ -637,18 +742,45 @@ class ZMesh:
             for y_line in self.mesh_z_table:
                 for idx, z in enumerate(y_line):
                     y_line[idx] = z - self.mesh_offset
+            self._build_coeffs()
     def get_x_coordinate(self, index):
         return self.mesh_x_min + self.mesh_x_dist * index
     def get_y_coordinate(self, index):
         return self.mesh_y_min + self.mesh_y_dist * index
+    def _build_coeffs(self):
+        # Store the bilinear interpolation coefficients of each cell
+        # (z = c0 + c1*tx + c2*ty + c3*tx*ty) in a flat table
+        tbl = self.mesh_z_table
+        self.mesh_coeffs = coeffs = []
+        for yidx in range(self.mesh_y_count - 1):
+            row0, row1 = tbl[yidx], tbl[yidx+1]
+            for xidx in range(self.mesh_x_count - 1):
+                z00, z01 = row0[xidx], row0[xidx+1]
+                z10, z11 = row1[xidx], row1[xidx+1]
+                coeffs.append((z00, z01 - z00, z10 - z00,
+                               z11 - z10 - z01 + z00))
     def calc_z(self, x, y):
         if self.mesh_z_table is not None:
-            tbl = self.mesh_z_table
-            tx, xidx = self._get_linear_index(x, 0)
-            ty, yidx = self._get_linear_index(y, 1)
-            z0 = lerp(tx, tbl[yidx][xidx], tbl[yidx][xidx+1])
-            z1 = lerp(tx, tbl[yidx+1][xidx], tbl[yidx+1][xidx+1])
-            return lerp(ty, z0, z1)
+            # Find the cell (and the position within it) for each axis
+            fx = (x - self.mesh_x_min) / self.mesh_x_dist
+            xidx = int(math.floor(fx))
+            if xidx < 0:
+                xidx, tx = 0, 0.
+            elif xidx > self.mesh_x_count - 2:
+                xidx, tx = self.mesh_x_count - 2, 1.
+            else:
+                tx = fx - xidx
+            fy = (y - self.mesh_y_min) / self.mesh_y_dist
+            yidx = int(math.floor(fy))
+            if yidx < 0:
+                yidx, ty = 0, 0.
+            elif yidx > self.mesh_y_count - 2:
+                yidx, ty = self.mesh_y_count - 2, 1.
+            else:
+                ty = fy - yidx
+            c0, c1, c2, c3 = self.mesh_coeffs[
+                yidx * (self.mesh_x_count - 1) + xidx]
+            return c0 + c1 * tx + (c2 + c3 * tx) * ty
         else:
             # No mesh table generated, no z-adjustment
             return 0.
@@ -659,52 +791,41 @@ class ZMesh:
             return mesh_min, mesh_max
         else:
             return 0., 0.
-    def _get_linear_index(self, coord, axis):
-        if axis == 0:
-            # X-axis
-            mesh_min = self.mesh_x_min
-            mesh_cnt = self.mesh_x_count
-            mesh_dist = self.mesh_x_dist
-            cfunc = self.get_x_coordinate
-        else:
-            # Y-axis
-            mesh_min = self.mesh_y_min
-            mesh_cnt = self.mesh_y_count
-            mesh_dist = self.mesh_y_dist
-            cfunc = self.get_y_coordinate
-        t = 0.
-        idx = int(math.floor((coord - mesh_min) / mesh_dist))
-        idx = constrain(idx, 0, mesh_cnt - 2)
-        t = (coord - cfunc(idx)) / mesh_dist
-        return constrain(t, 0., 1.), idx
     def _sample_direct(self, z_table):
         self.mesh_z_table = z_table
     def _sample_lagrange(self, z_table):
         x_mult = self.x_mult
         y_mult = self.y_mult
-        self.mesh_z_table = \
+        self.mesh_z_table = tbl = \
             [[0. if ((i % x_mult) or (j % y_mult))
              else z_table[j/y_mult][i/x_mult]
              for i in range(self.mesh_x_count)]
              for j in range(self.mesh_y_count)]
         xpts, ypts = self._get_lagrange_coords(z_table)
         # Interpolate X coordinates
-        for i in range(self.mesh_y_count):
-            # only interpolate X-rows that have probed coordinates
-            if i % y_mult != 0:
+        for j in range(self.mesh_x_count):
+            if j % x_mult == 0:
                 continue
-            for j in range(self.mesh_x_count):
-                if j % x_mult == 0:
-                    continue
-                x = self.get_x_coordinate(j)
-                self.mesh_z_table[i][j] = self._calc_lagrange(xpts, x, i, 0)
+            terms = self._get_lagrange_terms(xpts, self.get_x_coordinate(j))
+            # only interpolate X-rows that have probed coordinates
+            for i in range(0, self.mesh_y_count, y_mult):
+                row = tbl[i]
+                total = 0.
+                for k, (n, d) in enumerate(terms):
+                    total += row[k*x_mult] * n / d
+                row[j] = total
         # Interpolate Y coordinates
-        for i in range(self.mesh_x_count):
-            for j in range(self.mesh_y_count):
-                if j % y_mult == 0:
-                    continue
-                y = self.get_y_coordinate(j)
-                self.mesh_z_table[j][i] = self._calc_lagrange(ypts, y, i, 1)
+        for j in range(self.mesh_y_count):
+            if j % y_mult == 0:
+                continue
+            terms = self._get_lagrange_terms(ypts, self.get_y_coordinate(j))
+            rows = [tbl[k*y_mult] for k in range(len(terms))]
+            row = tbl[j]
+            for i in range(self.mesh_x_count):
+                total = 0.
+                for k, (n, d) in enumerate(terms):
+                    total += rows[k][i] * n / d
+                row[i] = total
     def _get_lagrange_coords(self, z_table):
         xpts = []
         ypts = []
@@ -713,9 +834,10 @@ class ZMesh:
         for j in range(self.probe_params['y_count']):
             ypts.append(self.get_y_coordinate(j * self.y_mult))
         return xpts, ypts
-    def _calc_lagrange(self, lpts, c, vec, axis=0):
+    def _get_lagrange_terms(self, lpts, c):
+        # Return the numerator and denominator of each basis polynomial
         pt_cnt = len(lpts)
-        total = 0.
+        terms = []
         for i in range(pt_cnt):
             n = 1.
             d = 1.
@@ -724,100 +846,47 @@ class ZMesh:
                     continue
                 n *= (c - lpts[j])
                 d *= (lpts[i] - lpts[j])
-            if axis == 0:
-                # Calc X-Axis
-                z = self.mesh_z_table[vec][i*self.x_mult]
-            else:
-                # Calc Y-Axis
-                z = self.mesh_z_table[i*self.y_mult][vec]
-            total += z * n / d
-        return total
+            terms.append((n, d))
+        return terms
     def _sample_bicubic(self, z_table):
         # should work for any number of probe points above 3x3
         x_mult = self.x_mult
         y_mult = self.y_mult
         c = self.probe_params['tension']
-        self.mesh_z_table = \
+        self.mesh_z_table = tbl = \
             [[0. if ((i % x_mult) or (j % y_mult))
              else z_table[j/y_mult][i/x_mult]
              for i in range(self.mesh_x_count)]
              for j in range(self.mesh_y_count)]
         # Interpolate X values
+        for x in range(self.mesh_x_count):
+            if x % x_mult == 0:
+                continue
+            i0, i1, i2, i3, t = self._get_ctl_pts(x, x_mult, self.mesh_x_count)
+            for y in range(0, self.mesh_y_count, y_mult):
+                row = tbl[y]
+                row[x] = self._cardinal_spline(
+                    (row[i0], row[i1], row[i2], row[i3], t), c)
+        # Interpolate Y values
         for y in range(self.mesh_y_count):
-            if y % y_mult != 0:
+            if y % y_mult == 0:
                 continue
+            i0, i1, i2, i3, t = self._get_ctl_pts(y, y_mult, self.mesh_y_count)
+            r0, r1, r2, r3 = tbl[i0], tbl[i1], tbl[i2], tbl[i3]
+            row = tbl[y]
             for x in range(self.mesh_x_count):
-                if x % x_mult == 0:
-                    continue
-                pts = self._get_x_ctl_pts(x, y)
-                self.mesh_z_table[y][x] = self._cardinal_spline(pts, c)
-        # Interpolate Y values
-        for x in range(self.mesh_x_count):
-            for y in range(self.mesh_y_count):
-                if y % y_mult == 0:
-                    continue
-                pts = self._get_y_ctl_pts(x, y)
-                self.mesh_z_table[y][x] = self._cardinal_spline(pts, c)
-    def _get_x_ctl_pts(self, x, y):
-        # Fetch control points and t for a X value in the mesh
-        x_mult = self.x_mult
-        x_row = self.mesh_z_table[y]
-        last_pt = self.mesh_x_count - 1 - x_mult
-        if x < x_mult:
-            p0 = p1 = x_row[0]
-            p2 = x_row[x_mult]
-            p3 = x_row[2*x_mult]
-            t = x / float(x_mult)
-        elif x > last_pt:
-            p0 = x_row[last_pt - x_mult]
-            p1 = x_row[last_pt]
-            p2 = p3 = x_row[last_pt + x_mult]
-            t = (x - last_pt) / float(x_mult)
-        else:
-            found = False
-            for i in range(x_mult, last_pt, x_mult):
-                if x > i and x < (i + x_mult):
-                    p0 = x_row[i - x_mult]
-                    p1 = x_row[i]
-                    p2 = x_row[i + x_mult]
-                    p3 = x_row[i + 2*x_mult]
-                    t = (x - i) / float(x_mult)
-                    found = True
-                    break
-            if not found:
-                raise BedMeshError(
-                    "bed_mesh: Error finding x control points")
-        return p0, p1, p2, p3, t
-    def _get_y_ctl_pts(self, x, y):
-        # Fetch control points and t for a Y value in the mesh
-        y_mult = self.y_mult
-        last_pt = self.mesh_y_count - 1 - y_mult
-        y_col = self.mesh_z_table
-        if y < y_mult:
-            p0 = p1 = y_col[0][x]
-            p2 = y_col[y_mult][x]
-            p3 = y_col[2*y_mult][x]
-            t = y / float(y_mult)
-        elif y > last_pt:
-            p0 = y_col[last_pt - y_mult][x]
-            p1 = y_col[last_pt][x]
-            p2 = p3 = y_col[last_pt + y_mult][x]
-            t = (y - last_pt) / float(y_mult)
-        else:
-            found = False
-            for i in range(y_mult, last_pt, y_mult):
-                if y > i and y < (i + y_mult):
-                    p0 = y_col[i - y_mult][x]
-                    p1 = y_col[i][x]
-                    p2 = y_col[i + y_mult][x]
-                    p3 = y_col[i + 2*y_mult][x]
-                    t = (y - i) / float(y_mult)
-                    found = True
-                    break
-            if not found:
-                raise BedMeshError(
-                    "bed_mesh: Error finding y control points")
-        return p0, p1, p2, p3, t
+                row[x] = self._cardinal_spline(
+                    (r0[x], r1[x], r2[x], r3[x], t), c)
+    def _get_ctl_pts(self, idx, mult, count):
+        # Fetch control point indexes and t for a value in the mesh
+        last_pt = count - 1 - mult
+        if idx < mult:
+            return 0, 0, mult, 2*mult, idx / float(mult)
+        elif idx > last_pt:
+            return (last_pt - mult, last_pt, last_pt + mult, last_pt + mult,
+                    (idx - last_pt) / float(mult))
+        i = idx - idx % mult
+        return i - mult, i, i + mult, i + 2*mult, (idx - i) / float(mult)
     def _cardinal_spline(self, p, tension):
         t = p[4]
         t2 = t*t
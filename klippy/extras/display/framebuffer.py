@@ -0,0 +1,62 @@
+# Framebuffer change tracking for graphics displays
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+
+# Number of bytes compared at once when searching for changes
+CHUNK_SIZE = 16
+
+# A framebuffer made of equally sized rows.  Drawing code updates the
+# bytearrays in 'rows' and marks the rows it modified as dirty.  Only
+# dirty rows are checked for changes on the next flush.
+class Framebuffer:
+    def __init__(self, count, size, fill=0x00):
+        self.blank = bytearray([fill] * size)
+        self.rows = [bytearray(self.blank) for i in range(count)]
+        # Contents of the display (initially unknown)
+        self.old_rows = [bytearray('~' * size) for i in range(count)]
+        self.dirty = [True] * count
+    def mark_dirty(self, row):
+        self.dirty[row] = True
+    def clear(self):
+        blank = self.blank
+        for i, row in enumerate(self.rows):
+            if row != blank:
+                row[:] = blank
+                self.dirty[i] = True
+    def get_changes(self, max_gap, max_count, align=1):
+        # Return a list of (row, pos, data) with the changed regions of
+        # the dirty rows.  Changes separated by no more than max_gap
+        # unchanged bytes are combined (up to max_count bytes).  The
+        # position and size of each region are a multiple of align.
+        changes = []
+        dirty = self.dirty
+        for row in range(len(dirty)):
+            if not dirty[row]:
+                continue
+            dirty[row] = False
+            new_data = self.rows[row]
+            old_data = self.old_rows[row]
+            if new_data == old_data:
+                continue
+            size = len(new_data)
+            start = end = None
+            for cpos in range(0, size, CHUNK_SIZE):
+                cend = cpos + CHUNK_SIZE
+                if new_data[cpos:cend] == old_data[cpos:cend]:
+                    continue
+                for i in range(cpos, min(cend, size)):
+                    if new_data[i] == old_data[i]:
+                        continue
+                    if (end is not None and i - end <= max_gap
+                        and i + align - start <= max_count):
+                        end = i + 1
+                        continue
+                    if end is not None:
+                        end = min(size, end + (-end % align))
+                        changes.append((row, start, new_data[start:end]))
+                    start = i - (i % align)
+                    end = i + 1
+            end = min(size, end + (-end % align))
+            changes.append((row, start, new_data[start:end]))
+            old_data[:] = new_data
+        return changes
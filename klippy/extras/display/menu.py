@@ -968,6 +968,26 @@ BLINK_FAST_SEQUENCE = (True, True, False, False)
 BLINK_SLOW_SEQUENCE = (True, True, True, True, False, False, False)
 
 
+# Parameters of the printer objects, only evaluated when a menu item
+# looks them up (one evaluation per object for each eventtime)
+class MenuParameters(dict):
+    def __init__(self, manager, eventtime):
+        super(MenuParameters, self).__init__()
+        self._manager = manager
+        self.eventtime = eventtime
+
+    def get(self, name, default=None):
+        if name not in self:
+            if name not in self._manager.objs:
+                return default
+            self[name] = self._manager.get_parameters(name, self.eventtime)
+        return super(MenuParameters, self).get(name, default)
+
+    def load_all(self):
+        for name in list(self._manager.objs.keys()):
+            self.get(name)
+
+
 class MenuManager:
     def __init__(self, config, lcd_chip):
         self.running = False
@@ -986,8 +1006,8 @@ class MenuManager:
         self.pconfig = self.printer.lookup_object('configfile')
         self.gcode = self.printer.lookup_object('gcode')
         self.gcode_queue = []
-        self.parameters = {}
         self.objs = {}
+        self.parameters = MenuParameters(self, None)
         self.root = None
         self._root = config.get('menu_root', '__main')
         self.cols, self.rows = lcd_chip.get_dimensions()
@@ -1240,44 +1260,44 @@ class MenuManager:
         }
 
     def update_parameters(self, eventtime):
-        self.parameters = {}
-        objs = dict(self.objs)
+        if self.parameters.eventtime != eventtime:
+            self.parameters = MenuParameters(self, eventtime)
+
+    def get_parameters(self, name, eventtime):
+        obj = self.objs.get(name)
+        if obj is None:
+            return {'is_enabled': False}
         # getting info this way is more like hack
         # all modules should have special reporting method (maybe get_status)
         # for available parameters
         # Only 2 level dot notation
-        for name in objs.keys():
-            try:
-                if objs[name] is not None:
-                    class_name = str(objs[name].__class__.__name__)
-                    get_status = getattr(objs[name], "get_status", None)
-                    if callable(get_status):
-                        self.parameters[name] = get_status(eventtime)
-                    else:
-                        self.parameters[name] = {}
-
-                    self.parameters[name].update({'is_enabled': True})
-                    # get additional info
-                    if class_name == 'ToolHead':
-                        pos = objs[name].get_position()
-                        self.parameters[name].update({
-                            'xpos': pos[0],
-                            'ypos': pos[1],
-                            'zpos': pos[2],
-                            'epos': pos[3]
-                        })
-                        self.parameters[name].update({
-                            'is_printing': (
-                                self.parameters[name]['status'] == "Printing"),
-                            'is_ready': (
-                                self.parameters[name]['status'] == "Ready"),
-                            'is_idle': (
-                                self.parameters[name]['status'] == "Idle")
-                        })
-                else:
-                    self.parameters[name] = {'is_enabled': False}
-            except Exception:
-                logging.exception("Parameter '%s' update error" % str(name))
+        try:
+            class_name = str(obj.__class__.__name__)
+            get_status = getattr(obj, "get_status", None)
+            if callable(get_status):
+                params = get_status(eventtime)
+            else:
+                params = {}
+
+            params.update({'is_enabled': True})
+            # get additional info
+            if class_name == 'ToolHead':
+                pos = obj.get_position()
+                params.update({
+                    'xpos': pos[0],
+                    'ypos': pos[1],
+                    'zpos': pos[2],
+                    'epos': pos[3]
+                })
+                params.update({
+                    'is_printing': (params['status'] == "Printing"),
+                    'is_ready': (params['status'] == "Ready"),
+                    'is_idle': (params['status'] == "Idle")
+                })
+            return params
+        except Exception:
+            logging.exception("Parameter '%s' update error" % str(name))
+        return None
 
     def stack_push(self, container):
         if not isinstance(container, MenuContainer):
@@ -1577,6 +1597,7 @@ class MenuManager:
     cmd_DO_help = "Menu do things"
 
     def cmd_DO_DUMP(self, params):
+        self.parameters.load_all()
         for key1 in self.parameters:
             if type(self.parameters[key1]) == dict:
                 for key2 in self.parameters[key1]:
@@ -6,7 +6,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import logging
-import icons, font8x14, extras.bus
+import icons, font8x14, framebuffer, extras.bus
 
 BACKGROUND_PRIORITY_CLOCK = 0x7fffffff00000000
 
@@ -15,10 +15,10 @@ TextGlyphs = { 'right_arrow': '\x1a', 'degrees': '\xf8' }
 class DisplayBase:
     def __init__(self, io):
         self.send = io.send
-        # framebuffers
-        self.vram = [bytearray(128) for i in range(8)]
-        self.all_framebuffers = [(self.vram[i], bytearray('~'*128), i)
-                                 for i in range(8)]
+        # framebuffer (one row per display page)
+        self.framebuffer = framebuffer.Framebuffer(8, 128)
+        self.vram = self.framebuffer.rows
+        self.mark_dirty = self.framebuffer.mark_dirty
         # Cache fonts and icons in display byte order
         self.font = [self._swizzle_bits(bytearray(c))
                      for c in font8x14.VGA_FONT]
@@ -28,30 +28,17 @@ class DisplayBase:
             top2, bot2 = self._swizzle_bits(icon)
             self.icons[name] = (top1 + top2, bot1 + bot2)
     def flush(self):
-        # Find all differences in the framebuffers and send them to the chip
-        for new_data, old_data, page in self.all_framebuffers:
-            if new_data == old_data:
-                continue
-            # Find the position of all changed bytes in this framebuffer
-            diffs = [[i, 1] for i, (n, o) in enumerate(zip(new_data, old_data))
-                     if n != o]
-            # Batch together changes that are close to each other
-            for i in range(len(diffs)-2, -1, -1):
-                pos, count = diffs[i]
-                nextpos, nextcount = diffs[i+1]
-                if pos + 5 >= nextpos and nextcount < 16:
-                    diffs[i][1] = nextcount + (nextpos - pos)
-                    del diffs[i+1]
-            # Transmit changes
-            for col_pos, count in diffs:
-                # Set Position registers
-                ra = 0xb0 | (page & 0x0F)
-                ca_msb = 0x10 | ((col_pos >> 4) & 0x0F)
-                ca_lsb = col_pos & 0x0F
-                self.send([ra, ca_msb, ca_lsb])
-                # Send Data
-                self.send(new_data[col_pos:col_pos+count], is_data=True)
-            old_data[:] = new_data
+        # Send all changes in the framebuffer to the chip.  Setting the
+        # position requires two extra messages (a mode change and the
+        # position command) so nearby changes are sent together.
+        for page, col_pos, data in self.framebuffer.get_changes(16, 32):
+            # Set Position registers
+            ra = 0xb0 | (page & 0x0F)
+            ca_msb = 0x10 | ((col_pos >> 4) & 0x0F)
+            ca_lsb = col_pos & 0x0F
+            self.send([ra, ca_msb, ca_lsb])
+            # Send Data
+            self.send(data, is_data=True)
     def _swizzle_bits(self, data):
         # Convert 8x16 data into display col/row order
         bits_top = [0] * 8
@@ -67,6 +54,8 @@ class DisplayBase:
         pix_x = x * 8
         page_top = self.vram[y * 2]
         page_bot = self.vram[y * 2 + 1]
+        self.mark_dirty(y * 2)
+        self.mark_dirty(y * 2 + 1)
         for c in data:
             bits_top, bits_bot = self.font[ord(c)]
             page_top[pix_x:pix_x+8] = bits_top
@@ -75,7 +64,9 @@ class DisplayBase:
     def write_graphics(self, x, y, row, data):
         if x + len(data) > 16:
             data = data[:16 - min(x, 16)]
-        page = self.vram[y * 2 + (row >= 8)]
+        page_idx = y * 2 + (row >= 8)
+        page = self.vram[page_idx]
+        self.mark_dirty(page_idx)
         bit = 1 << (row % 8)
         pix_x = x * 8
         for bits in data:
@@ -91,6 +82,8 @@ class DisplayBase:
             page_idx = y * 2
             self.vram[page_idx][pix_x:pix_x+16] = icon[0]
             self.vram[page_idx + 1][pix_x:pix_x+16] = icon[1]
+            self.mark_dirty(page_idx)
+            self.mark_dirty(page_idx + 1)
             return 2
         char = TextGlyphs.get(glyph_name)
         if char is not None:
@@ -99,9 +92,7 @@ class DisplayBase:
             return 1
         return 0
     def clear(self):
-        zeros = bytearray(128)
-        for page in self.vram:
-            page[:] = zeros
+        self.framebuffer.clear()
     def get_dimensions(self):
         return (16, 4)
 
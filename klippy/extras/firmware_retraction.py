@@ -15,6 +15,7 @@ class FirmwareRetraction:
         self.unretract_length = (self.retract_length
                                  + self.unretract_extra_length)
         self.is_retracted = False
+        self.status_version = 0
         self.gcode = self.printer.lookup_object('gcode')
         self.gcode.register_command('SET_RETRACTION', self.cmd_SET_RETRACTION)
         self.gcode.register_command('GET_RETRACTION', self.cmd_GET_RETRACTION)
@@ -28,6 +29,8 @@ class FirmwareRetraction:
             "unretract_extra_length": self.unretract_extra_length,
             "unretract_speed": self.unretract_speed,
         }
+    def get_status_version(self):
+        return self.status_version
 
     def cmd_SET_RETRACTION(self, params):
         self.retract_length = self.gcode.get_float(
@@ -45,6 +48,7 @@ class FirmwareRetraction:
         self.unretract_length = (self.retract_length
                                  + self.unretract_extra_length)
         self.is_retracted = False
+        self.status_version += 1
 
     def cmd_GET_RETRACTION(self, params):
         msg = ("RETRACT_LENGTH=%.5f RETRACT_SPEED=%.5f "
@@ -9,110 +9,92 @@
 
 
 # uses the plan_arc function from marlin which does steps in mm rather then
-# in degrees. # Coordinates created by this are converted into G1 commands.
+# in degrees. The segments created by this are submitted directly to the
+# g-code move path (see GCodeParser.process_path_move).
 #
-# note: only IJ version available
+# note: both the IJ and R versions are available
 
 import math
-import re
 
 class ArcSupport:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.mm_per_arc_segment = config.getfloat('resolution', 1, above=0.0)
+        self.tolerance = config.getfloat('tolerance', None, above=0.0)
 
         self.gcode = self.printer.lookup_object('gcode')
         self.gcode.register_command("G2", self.cmd_G2, desc=self.cmd_G2_help)
         self.gcode.register_command("G3", self.cmd_G2, desc=self.cmd_G3_help)
 
-    cmd_G2_help = "Counterclockwise rotation move"
-    cmd_G3_help = "Clockwise rotaion move"
+    cmd_G2_help = "Clockwise rotation move"
+    cmd_G3_help = "Counterclockwise rotation move"
 
     def cmd_G2(self, params):
         # set vars
-        currentPos =  self.printer.lookup_object('toolhead').get_position()
+        try:
+            coords = [float(params[axis]) if axis in params else None
+                      for axis in 'XYZEF']
+        except ValueError as e:
+            raise self.gcode.error("Unable to parse move '%s'" % (
+                params['#original'],))
 
-        asX = params.get("X", None)
-        asY = params.get("Y", None)
-        asZ = params.get("Z", None)
-
-        asR = float(params.get("R", 0.))    #radius
-        asI = float(params.get("I", 0.))
-        asJ = float(params.get("J", 0.))
-
-        asE = float(params.get("E", 0.))
-        asF = float(params.get("F", -1))
+        asR = self.gcode.get_float("R", params, 0.)    #radius
+        asI = self.gcode.get_float("I", params, 0.)
+        asJ = self.gcode.get_float("J", params, 0.)
 
         # --------- health checks of code -----------
-        if (asX is None or asY is None):
-            raise self.gcode.error("g2/g3: Coords missing")
-
-        elif asR == 0 and asI == 0 and asJ==0:
+        if asR == 0 and asI == 0 and asJ == 0:
             raise self.gcode.error("g2/g3: neither R nor I and J given")
-
-        elif asR > 0 and (asI !=0 or asJ!=0):
+        if asR != 0 and (asI != 0 or asJ != 0):
             raise self.gcode.error("g2/g3: R, I and J were given. Invalid")
-        else:   # -------- execute conversion -----------
-            coords = []
-            clockwise = params['#command'].lower().startswith("g2")
-            asY = float(asY)
-            asX = float(asX)
-
-            # use radius
-            # if asR > 0:
-                # not sure if neccessary since R barely seems to be used
-
-            # use IJK
-
-            if asI != 0 or asJ!=0:
-                coords = self.planArc(currentPos,
-                            [asX,asY,0.,0.],
-                            [asI, asJ],
-                            clockwise)
-            ###############################
-            # converting coords into G1 codes (lazy aproch)
-            if len(coords)>0:
-
-                # build dict and call cmd_G1
-                for coord in coords:
-                    g1_params = {'X': coord[0], 'Y': coord[1]}
-                    if asZ!=None:
-                        g1_params['Z']= float(asZ)
-                    if asE>0:
-                        g1_params['E']= float(asE)/len(coords)
-                    if asF>0:
-                        g1_params['F']= asF
-
-                    self.gcode.cmd_G1(g1_params)
-
-
-
 
+        # -------- execute conversion -----------
+        clockwise = params['#command'].lower().startswith("g2")
+        def plan(start_pos, end_pos):
+            if asR != 0:
+                offset = self.calcRadiusOffset(start_pos, end_pos, asR,
+                                               clockwise)
+                if offset is None:
+                    # The R form can not describe a full circle
+                    return []
             else:
-                self.gcode.respond_info(
-                    "could not tranlate from '" + params['#original'] + "'")
-
+                offset = [asI, asJ]
+            return self.planArc(start_pos, end_pos, offset, clockwise)
+        self.gcode.process_path_move(coords, params['#original'], plan)
+
+    # Calculate the center of an R form arc (relative to the start
+    # position).  A negative radius selects the arc longer than 180
+    # degrees.
+    def calcRadiusOffset(self, startPos, targetPos, radius, clockwise):
+        dx = targetPos[0] - startPos[0]
+        dy = targetPos[1] - startPos[1]
+        d = math.hypot(dx, dy)
+        if d == 0.:
+            return None
+        # Distance from the midpoint of the chord to the center
+        h = math.sqrt(max(0., radius**2 - (.5 * d)**2)) / d
+        if clockwise ^ (radius < 0.):
+            h = -h
+        return [.5 * dx - h * dy, .5 * dy + h * dx]
 
     # function planArc() originates from marlin plan_arc()
     # https://github.com/MarlinFirmware/Marlin
     #
     # The arc is approximated by generating many small linear segments.
     # The length of each segment is configured in MM_PER_ARC_SEGMENT
-    # Arcs smaller then this value, will be a Line only
-
-    def planArc(
-            self,
-            currentPos,
-            targetPos=[0.,0.,0.,0.],
-            offset=[0.,0.],
-            clockwise=False):
-        # todo: sometimes produces full circles
+    # (and shortened further if needed to stay within the configured
+    # tolerance). Arcs smaller then this value, will be a Line only.
+    # Z and E are interpolated along the arc (helix). The returned
+    # positions exclude the target position.
+
+    def planArc(self, currentPos, targetPos, offset, clockwise=False):
         coords = []
         MM_PER_ARC_SEGMENT = self.mm_per_arc_segment
 
         X_AXIS = 0
         Y_AXIS = 1
         Z_AXIS = 2
+        E_AXIS = 3
 
         # Radius vector from center to current location
         r_P = offset[0]*-1
@@ -124,6 +106,7 @@ class ArcSupport:
         rt_X = targetPos[X_AXIS] - center_P
         rt_Y = targetPos[Y_AXIS] - center_Q
         linear_travel = targetPos[Z_AXIS] - currentPos[Z_AXIS]
+        extrude_travel = targetPos[E_AXIS] - currentPos[E_AXIS]
 
         angular_travel = math.atan2(r_P * rt_Y - r_Q * rt_X,
             r_P * rt_X + r_Q * rt_Y)
@@ -137,42 +120,36 @@ class ArcSupport:
             and currentPos[Y_AXIS] == targetPos[Y_AXIS]):
             angular_travel = math.radians(360)
 
-
         flat_mm = radius * angular_travel
-        mm_of_travel = linear_travel
-        if(mm_of_travel == linear_travel):
-            mm_of_travel = math.hypot(flat_mm, linear_travel)
-        else:
-            mm_of_travel = math.abs(flat_mm)
-
+        mm_of_travel = math.hypot(flat_mm, linear_travel)
 
         if (mm_of_travel < 0.001):
             return coords
 
         segments = int(math.floor(mm_of_travel / (MM_PER_ARC_SEGMENT)))
+        if self.tolerance is not None and self.tolerance < radius:
+            # Limit the distance between each chord and the arc
+            max_theta = 2. * math.acos(1. - self.tolerance / radius)
+            segments = max(segments, int(math.ceil(
+                abs(angular_travel) / max_theta)))
         if(segments<1):
             segments=1
 
-
-        raw = [0.,0.,0.,0.]
-        theta_per_segment = float(angular_travel / segments)
-        linear_per_segment = float(linear_travel / segments)
-
-        # Initialize the linear axis
-        raw[Z_AXIS] = currentPos[Z_AXIS];
-
-
-        for i in range(1,segments+1):
-            cos_Ti = math.cos(i * theta_per_segment)
-            sin_Ti = math.sin(i * theta_per_segment)
-            r_P = -offset[0] * cos_Ti + offset[1] * sin_Ti
-            r_Q = -offset[0] * sin_Ti - offset[1] * cos_Ti
-
-            raw[X_AXIS] = center_P + r_P
-            raw[Y_AXIS] = center_Q + r_Q
-            raw[Z_AXIS] += linear_per_segment
-
-            coords.append([raw[X_AXIS],  raw[Y_AXIS], raw[Z_AXIS] ])
+        theta_per_segment = float(angular_travel) / segments
+        linear_per_segment = float(linear_travel) / segments
+        extrude_per_segment = float(extrude_travel) / segments
+
+        cos = math.cos
+        sin = math.sin
+        z = currentPos[Z_AXIS]
+        e = currentPos[E_AXIS]
+        for i in range(1, segments):
+            cos_Ti = cos(i * theta_per_segment)
+            sin_Ti = sin(i * theta_per_segment)
+            coords.append([center_P + r_P * cos_Ti - r_Q * sin_Ti,
+                           center_Q + r_P * sin_Ti + r_Q * cos_Ti,
+                           z + i * linear_per_segment,
+                           e + i * extrude_per_segment])
 
         return coords
 
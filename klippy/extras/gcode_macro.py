@@ -3,7 +3,7 @@
 # Copyright (C) 2018-2019  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import traceback, logging, ast
+import sys, os, traceback, logging, ast, bisect, hashlib, marshal
 import jinja2
 
 
@@ -11,22 +11,49 @@ import jinja2
 # Template handling
 ######################################################################
 
+# Snapshots of printer object get_status() results shared between
+# template renders.  A snapshot is reused by all renders at the same
+# eventtime.  Objects that implement get_status_version() (returning a
+# value that changes whenever their status changes) have their snapshot
+# reused until that version changes.
+class StatusCache:
+    def __init__(self, printer):
+        self.printer = printer
+        self.snapshots = {}
+    def get_status(self, name, eventtime):
+        snapshot = self.snapshots.get(name)
+        if snapshot is not None:
+            po, snapshot_time, version, status = snapshot
+            if version is None:
+                if snapshot_time == eventtime:
+                    return status
+            elif po.get_status_version() == version:
+                return status
+        po = self.printer.lookup_object(name, None)
+        if po is None or not hasattr(po, 'get_status'):
+            raise KeyError(name)
+        version = None
+        if hasattr(po, 'get_status_version'):
+            version = po.get_status_version()
+        status = dict(po.get_status(eventtime))
+        self.snapshots[name] = (po, eventtime, version, status)
+        return status
+
 # Wrapper for access to printer object get_status() methods
 class GetStatusWrapper:
-    def __init__(self, printer, eventtime=None):
-        self.printer = printer
+    def __init__(self, status_cache, eventtime=None):
+        self.status_cache = status_cache
+        self.printer = status_cache.printer
         self.eventtime = eventtime
         self.cache = {}
     def __getitem__(self, val):
         sval = str(val).strip()
         if sval in self.cache:
             return self.cache[sval]
-        po = self.printer.lookup_object(sval, None)
-        if po is None or not hasattr(po, 'get_status'):
-            raise KeyError(val)
         if self.eventtime is None:
             self.eventtime = self.printer.get_reactor().monotonic()
-        self.cache[sval] = res = dict(po.get_status(self.eventtime))
+        self.cache[sval] = res = self.status_cache.get_status(
+            sval, self.eventtime)
         return res
     def __contains__(self, val):
         try:
@@ -39,46 +66,219 @@ class GetStatusWrapper:
             if self.__contains__(name):
                 yield name
 
+# Find the printer objects a template accesses (as "printer.name" or
+# 'printer["name"]').  Returns None if the template uses the printer
+# variable in any other way.
+def find_printer_keys(tree):
+    nodes = jinja2.nodes
+    keys = set()
+    accesses = 0
+    for node in tree.find_all((nodes.Getattr, nodes.Getitem)):
+        if not isinstance(node.node, nodes.Name) or node.node.name != 'printer':
+            continue
+        if isinstance(node, nodes.Getattr):
+            keys.add(str(node.attr))
+        elif (isinstance(node.arg, nodes.Const)
+              and isinstance(node.arg.value, basestring)):
+            keys.add(str(node.arg.value).strip())
+        else:
+            return None
+        accesses += 1
+    names = [node for node in tree.find_all(nodes.Name)
+             if node.name == 'printer']
+    if len(names) != accesses:
+        return None
+    return keys
+
+# Upper limits (in seconds) of the render time histogram buckets
+RENDER_BUCKETS = [.0001, .001, .01, .1]
+
 # Wrapper around a Jinja2 template
 class TemplateWrapper:
-    def __init__(self, printer, env, name, script):
+    def __init__(self, printer, macro_support, name, script):
         self.printer = printer
         self.name = name
+        self.status_cache = macro_support.status_cache
+        self.reactor = self.printer.get_reactor()
         self.gcode = self.printer.lookup_object('gcode')
         try:
-            self.template = env.from_string(script)
+            self.template, self.printer_keys = macro_support.compile_template(
+                script)
+            # Scripts without any expressions always render the same text
+            self.static_text = None
+            if '{' not in script:
+                self.static_text = str(self.template.render())
         except Exception as e:
             msg = "Error loading template '%s': %s" % (
                  name, traceback.format_exception_only(type(e), e)[-1])
             logging.exception(msg)
             raise printer.config_error(msg)
+        self.reset_render_stats()
     def create_status_wrapper(self, eventtime=None):
-        return GetStatusWrapper(self.printer, eventtime)
+        if self.printer_keys is None:
+            return GetStatusWrapper(self.status_cache, eventtime)
+        # Only the objects the template references are needed
+        status = {}
+        if not self.printer_keys:
+            return status
+        if eventtime is None:
+            eventtime = self.reactor.monotonic()
+        get_status = self.status_cache.get_status
+        for key in self.printer_keys:
+            try:
+                status[key] = get_status(key, eventtime)
+            except KeyError as e:
+                pass
+        return status
     def render(self, context=None):
-        if context is None:
-            context = {'printer': self.create_status_wrapper()}
-        try:
-            return str(self.template.render(context))
-        except Exception as e:
-            msg = "Error evaluating '%s': %s" % (
-                self.name, traceback.format_exception_only(type(e), e)[-1])
-            logging.exception(msg)
-            raise self.gcode.error(msg)
+        starttime = self.reactor.monotonic()
+        if self.static_text is not None:
+            res = self.static_text
+        else:
+            if context is None:
+                context = {'printer': self.create_status_wrapper()}
+            try:
+                res = str(self.template.render(context))
+            except Exception as e:
+                msg = "Error evaluating '%s': %s" % (
+                    self.name, traceback.format_exception_only(type(e), e)[-1])
+                logging.exception(msg)
+                raise self.gcode.error(msg)
+        render_time = self.reactor.monotonic() - starttime
+        self.render_count += 1
+        self.render_time += render_time
+        self.render_max = max(self.render_max, render_time)
+        self.render_hist[bisect.bisect(RENDER_BUCKETS, render_time)] += 1
+        return res
     def run_gcode_from_command(self, context=None):
         self.gcode.run_script_from_command(self.render(context))
+    def get_render_stats(self):
+        if not self.render_count:
+            return None
+        avg = self.render_time / self.render_count
+        hist = " ".join(["<%gms=%d" % (limit * 1000., count)
+                         for limit, count in zip(RENDER_BUCKETS,
+                                                 self.render_hist)])
+        return ("%s: count=%d total=%.3fms avg=%.3fms max=%.3fms"
+                " %s >=%gms=%d" % (
+                    self.name, self.render_count, self.render_time * 1000.,
+                    avg * 1000., self.render_max * 1000., hist,
+                    RENDER_BUCKETS[-1] * 1000., self.render_hist[-1]))
+    def reset_render_stats(self):
+        self.render_count = 0
+        self.render_time = self.render_max = 0.
+        self.render_hist = [0] * (len(RENDER_BUCKETS) + 1)
+
+# Version of the on-disk template cache format (bump when the stored
+# data or the find_printer_keys() logic changes)
+CACHE_VERSION = 1
 
 # Main gcode macro template tracking
 class PrinterGCodeMacro:
     def __init__(self, config):
         self.printer = config.get_printer()
         self.env = jinja2.Environment('{%', '%}', '{', '}')
+        self.status_cache = StatusCache(self.printer)
+        self.templates = []
+        # Optional on-disk cache of compiled templates
+        self.cache_path = config.get('cache_path', None)
+        if self.cache_path is not None:
+            self.cache_path = os.path.expanduser(self.cache_path)
+            try:
+                if not os.path.isdir(self.cache_path):
+                    os.makedirs(self.cache_path)
+            except os.error as e:
+                raise config.error("Unable to create template cache '%s': %s"
+                                   % (self.cache_path, str(e)))
+            self.printer.register_event_handler("klippy:connect",
+                                                self._prune_cache)
+        self.cache_files = set()
+        self.gcode = self.printer.lookup_object('gcode')
+        self.gcode.register_command("MACRO_STATS", self.cmd_MACRO_STATS,
+                                    desc=self.cmd_MACRO_STATS_help)
+    def _load_cached(self, fname):
+        try:
+            f = open(fname, 'rb')
+            try:
+                printer_keys, code = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError) as e:
+            return None
+        return printer_keys, code
+    def _save_cached(self, fname, printer_keys, code):
+        tmpname = "%s.%d.tmp" % (fname, os.getpid())
+        try:
+            f = open(tmpname, 'wb')
+            try:
+                marshal.dump((printer_keys, code), f)
+            finally:
+                f.close()
+            os.rename(tmpname, fname)
+        except (IOError, os.error) as e:
+            logging.warning("Unable to write template cache '%s': %s",
+                            fname, str(e))
+    def _prune_cache(self):
+        # Remove cached templates no longer used by any configured template
+        try:
+            names = os.listdir(self.cache_path)
+        except os.error as e:
+            return
+        for name in names:
+            key, ext = os.path.splitext(name)
+            if (ext != ".jinja" or len(key) != 40 or name in self.cache_files
+                or key.strip("0123456789abcdef")):
+                continue
+            try:
+                os.remove(os.path.join(self.cache_path, name))
+            except os.error as e:
+                logging.warning("Unable to remove template cache '%s': %s",
+                                name, str(e))
+    def compile_template(self, script):
+        # Returns the template and the printer objects it accesses
+        fname = cached = None
+        if self.cache_path is not None:
+            env = self.env
+            key = hashlib.sha1("%d\0%s\0%s\0%s\0%s\0%s\0%s\0%s" % (
+                CACHE_VERSION, sys.version, jinja2.__version__,
+                env.block_start_string, env.block_end_string,
+                env.variable_start_string, env.variable_end_string,
+                script)).hexdigest()
+            self.cache_files.add(key + ".jinja")
+            fname = os.path.join(self.cache_path, key + ".jinja")
+            cached = self._load_cached(fname)
+        if cached is not None:
+            printer_keys, code = cached
+        else:
+            tree = self.env.parse(script)
+            printer_keys = find_printer_keys(tree)
+            code = self.env.compile(tree)
+            if fname is not None:
+                self._save_cached(fname, printer_keys, code)
+        template = self.env.template_class.from_code(
+            self.env, code, self.env.make_globals(None))
+        return template, printer_keys
     def load_template(self, config, option, default=None):
         name = "%s:%s" % (config.get_name(), option)
         if default is None:
             script = config.get(option)
         else:
             script = config.get(option, default)
-        return TemplateWrapper(self.printer, self.env, name, script)
+        template = TemplateWrapper(self.printer, self, name, script)
+        self.templates.append(template)
+        return template
+    cmd_MACRO_STATS_help = "Report the time spent rendering command templates"
+    def cmd_MACRO_STATS(self, params):
+        if self.gcode.get_int('RESET', params, 0):
+            for template in self.templates:
+                template.reset_render_stats()
+            return
+        templates = sorted(self.templates, key=(lambda t: -t.render_time))
+        msgs = [t.get_render_stats() for t in templates]
+        msgs = [msg for msg in msgs if msg is not None]
+        if not msgs:
+            msgs = ["No templates have been rendered"]
+        self.gcode.respond_info("\n".join(msgs))
 
 def load_config(config):
     return PrinterGCodeMacro(config)
@@ -105,6 +305,7 @@ class GCodeMacro:
         self.kwparams = { o[len(prefix):].upper(): config.get(o)
                           for o in config.get_prefix_options(prefix) }
         self.variables = {}
+        self.status_version = 0
         prefix = 'variable_'
         for option in config.get_prefix_options(prefix):
             try:
@@ -116,6 +317,8 @@ class GCodeMacro:
                         option, config.get_name()))
     def get_status(self, eventtime):
         return dict(self.variables)
+    def get_status_version(self):
+        return self.status_version
     cmd_SET_GCODE_VARIABLE_help = "Set the value of a G-Code macro variable"
     def cmd_SET_GCODE_VARIABLE(self, params):
         variable = self.gcode.get_str('VARIABLE', params)
@@ -132,6 +335,7 @@ class GCodeMacro:
             raise self.gcode.error("Unable to parse '%s' as a literal" % (
                 value,))
         self.variables[variable] = literal
+        self.status_version += 1
     cmd_desc = "G-Code macro"
     def cmd(self, params):
         if self.in_script:
@@ -3,22 +3,284 @@
 # Copyright (C) 2018  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, logging
+import os, struct, bisect, hashlib, logging
+
+BATCH_TIME = 0.050
+
+# The g-code cache stores a file as a sequence of records.  A text
+# record is CACHE_TEXT, the length of the line ('<I'), and the line.
+# A move record is a flags byte (CACHE_G0 and a bit for each axis in
+# "XYZEF"), the length of the line ('<H'), a double for each axis
+# present, and the line.
+CACHE_MAGIC = "KGC2"
+CACHE_HEADER_SIZE = len(CACHE_MAGIC) + 20
+CACHE_TEXT = 0x80
+CACHE_G0 = 0x20
+CACHE_RECORDS = {CACHE_TEXT: (struct.Struct('<I'), None, [])}
+for flags in range(CACHE_G0 * 2):
+    axes = [i for i in range(5) if flags & (1 << i)]
+    CACHE_RECORDS[flags] = (struct.Struct('<H' + 'd' * len(axes)),
+                            'G0' if flags & CACHE_G0 else 'G1', axes)
+CACHE_READ_SIZE = 64 * 1024
+CACHE_CHECKPOINT_SIZE = 64 * 1024
+
+# Buffered reader of the records in a g-code cache file
+class GCodeCacheReader:
+    def __init__(self, f):
+        self.f = f
+        self.offset = f.tell()
+        self.data = ""
+        self.pos = 0
+    def close(self):
+        self.f.close()
+    def tell(self):
+        return self.offset + self.pos
+    def _read(self, count):
+        pos = self.pos
+        if pos + count > len(self.data):
+            self.offset += pos
+            self.data = self.data[pos:] + self.f.read(
+                max(count, CACHE_READ_SIZE))
+            pos = 0
+            if count > len(self.data):
+                raise IOError("Truncated g-code cache")
+        self.pos = pos + count
+        return self.data[pos:pos + count]
+    def read_record(self):
+        # Returns (cmd, coords, line) for the next record (cmd is None
+        # for a text record) or None at the end of the cache
+        if self.pos >= len(self.data):
+            self.offset += self.pos
+            self.data = self.f.read(CACHE_READ_SIZE)
+            self.pos = 0
+            if not self.data:
+                return None
+        st, cmd, axes = CACHE_RECORDS[ord(self._read(1))]
+        vals = st.unpack(self._read(st.size))
+        line = self._read(vals[0])
+        if cmd is None:
+            return None, None, line
+        coords = [None] * 5
+        for i, axis in enumerate(axes):
+            coords[axis] = vals[i + 1]
+        return cmd, coords, line
+
+# Reader of the lines of a g-code file (with the same read_record()
+# interface as GCodeCacheReader)
+class GCodeFileReader:
+    def __init__(self, f):
+        self.f = f
+    def read_record(self):
+        line = self.f.readline()
+        if not line:
+            return None
+        return None, None, line
+
+# Pre-parsed version of a g-code file (stored in the cache directory)
+class GCodeCache:
+    def __init__(self, reactor, gcode, filename, cache_dirname):
+        self.reactor = reactor
+        self.gcode = gcode
+        self.filename = filename
+        self.cache_dirname = cache_dirname
+        self.cache_filename = os.path.join(
+            cache_dirname, os.path.basename(filename) + ".cache")
+        self.is_ready = self.is_cancelled = False
+        # Sorted (file position, cache position) pairs of lines that
+        # are about CACHE_CHECKPOINT_SIZE bytes apart in the file
+        self.checkpoints = []
+        self.resume_position = (0, CACHE_HEADER_SIZE)
+    def cancel(self):
+        self.is_cancelled = True
+    def _pause(self, end_time):
+        # Let other reactor users run if the time budget is used
+        curtime = self.reactor.monotonic()
+        if curtime < end_time:
+            return end_time
+        self.reactor.pause(self.reactor.NOW)
+        return self.reactor.monotonic() + BATCH_TIME
+    def _hash(self, f):
+        h = hashlib.sha1()
+        end_time = self.reactor.monotonic() + BATCH_TIME
+        while 1:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            h.update(data)
+            end_time = self._pause(end_time)
+            if self.is_cancelled:
+                return None
+        return h.digest()
+    def _check(self, digest):
+        try:
+            f = open(self.cache_filename, 'rb')
+            header = f.read(CACHE_HEADER_SIZE)
+            f.close()
+        except IOError:
+            return False
+        return header == CACHE_MAGIC + digest
+    def _convert(self, f, digest, cache_file):
+        cache_file.write(CACHE_MAGIC + digest)
+        out = []
+        parse_move = self.gcode.parse_move
+        text_st = CACHE_RECORDS[CACHE_TEXT][0]
+        h = hashlib.sha1()
+        end_time = self.reactor.monotonic() + BATCH_TIME
+        f.seek(0)
+        while 1:
+            line = f.readline()
+            if not line:
+                break
+            h.update(line)
+            move = parse_move(line.strip())
+            if (move is None or len(line) > 0xffff
+                or (move[1][4] is not None and move[1][4] <= 0.)):
+                out.append(chr(CACHE_TEXT) + text_st.pack(len(line)) + line)
+                continue
+            cmd, coords = move
+            flags = sum([1 << i for i, v in enumerate(coords) if v is not None])
+            if cmd == 'G0':
+                flags |= CACHE_G0
+            st, cmd, axes = CACHE_RECORDS[flags]
+            out.append(chr(flags) + st.pack(len(line),
+                                            *[coords[i] for i in axes])
+                       + line)
+            if len(out) >= 1000:
+                cache_file.write("".join(out))
+                out = []
+                end_time = self._pause(end_time)
+                if self.is_cancelled:
+                    return False
+        cache_file.write("".join(out))
+        if h.digest() != digest:
+            logging.info("File %s changed while creating g-code cache",
+                         self.filename)
+            return False
+        return True
+    def _index(self):
+        # Note the position of a line in each CACHE_CHECKPOINT_SIZE
+        # bytes of the file
+        f = open(self.cache_filename, 'rb')
+        f.seek(CACHE_HEADER_SIZE)
+        reader = GCodeCacheReader(f)
+        checkpoints = []
+        fpos = next_checkpoint = 0
+        end_time = self.reactor.monotonic() + BATCH_TIME
+        try:
+            while 1:
+                if fpos >= next_checkpoint:
+                    checkpoints.append((fpos, reader.tell()))
+                    next_checkpoint = fpos + CACHE_CHECKPOINT_SIZE
+                    end_time = self._pause(end_time)
+                    if self.is_cancelled:
+                        return False
+                record = reader.read_record()
+                if record is None:
+                    break
+                fpos += len(record[2])
+        finally:
+            reader.close()
+        self.checkpoints = checkpoints
+        return True
+    def build(self, eventtime):
+        # Verify (or create) the cache file
+        try:
+            f = open(self.filename, 'rb')
+        except:
+            logging.exception("virtual_sdcard cache open")
+            return
+        try:
+            if not os.fstat(f.fileno()).st_size:
+                return
+            digest = self._hash(f)
+            if digest is None:
+                return
+            if not self._check(digest):
+                if os.path.exists(self.cache_filename):
+                    # Don't leave an out of date cache behind
+                    os.unlink(self.cache_filename)
+                elif not os.path.isdir(self.cache_dirname):
+                    os.makedirs(self.cache_dirname)
+                logging.info("Creating g-code cache %s", self.cache_filename)
+                # A cancelled build of the same file may still be running
+                temp_filename = "%s.%d.tmp" % (self.cache_filename, id(self))
+                cache_file = open(temp_filename, 'wb')
+                try:
+                    res = self._convert(f, digest, cache_file)
+                finally:
+                    cache_file.close()
+                if not res:
+                    os.unlink(temp_filename)
+                    return
+                os.rename(temp_filename, self.cache_filename)
+                logging.info("Finished g-code cache %s", self.cache_filename)
+            self.is_ready = self._index()
+        except:
+            logging.exception("virtual_sdcard cache create")
+        finally:
+            f.close()
+    def open(self, file_position):
+        # Return a cache reader positioned at the given file position
+        if not self.is_ready:
+            return None
+        # Start at the last checkpoint (or resume position) at or
+        # before the file position
+        i = bisect.bisect_left(self.checkpoints, (file_position + 1,))
+        fpos, pos = self.checkpoints[i - 1]
+        if fpos < self.resume_position[0] <= file_position:
+            fpos, pos = self.resume_position
+        try:
+            f = open(self.cache_filename, 'rb')
+        except:
+            logging.exception("virtual_sdcard cache open")
+            return None
+        try:
+            f.seek(pos)
+            reader = GCodeCacheReader(f)
+            while fpos < file_position:
+                record = reader.read_record()
+                if record is None:
+                    break
+                fpos += len(record[2])
+        except:
+            logging.exception("virtual_sdcard cache read")
+            f.close()
+            return None
+        if fpos != file_position:
+            # Not the start of a line
+            reader.close()
+            return None
+        return reader
 
 class VirtualSD:
 
     def __init__(self, config):
         printer = config.get_printer()
         printer.register_event_handler("klippy:shutdown", self.handle_shutdown)
+        self.is_fileinput = (
+            printer.get_start_args().get('debuginput') is not None)
         # sdcard state
         sd = config.get('path')
         self.sdcard_dirname = os.path.normpath(os.path.expanduser(sd))
         self.current_file = None
         self.file_position = self.file_size = 0
+        # Pre-parsed g-code cache
+        self.use_cache = config.getboolean('gcode_cache', False)
+        cache_path = config.get('gcode_cache_path',
+                                os.path.join(sd, '.gcode_cache'))
+        self.cache_dirname = os.path.normpath(os.path.expanduser(cache_path))
+        if self.cache_dirname == self.sdcard_dirname:
+            raise config.error(
+                "virtual_sdcard gcode_cache_path must not be the sdcard path")
+        self.cache = None
         # Work timer
         self.reactor = printer.get_reactor()
         self.must_pause_work = False
         self.work_timer = None
+        # Work statistics
+        self.stats_lines = 0
+        self.stats_time = 0.
+        self.max_batch_time = 0.
         # Register commands
         self.gcode = printer.lookup_object('gcode')
         self.gcode.register_command('M21', None)
@@ -41,9 +303,16 @@ class VirtualSD:
                          readpos, repr(data[:readcount]),
                          self.file_position, repr(data[readcount:]))
     def stats(self, eventtime):
+        lines, self.stats_lines = self.stats_lines, 0
+        stats_time, self.stats_time = self.stats_time, eventtime
+        max_batch_time, self.max_batch_time = self.max_batch_time, 0.
         if self.work_timer is None:
             return False, ""
-        return True, "sd_pos=%d" % (self.file_position,)
+        lines_per_sec = 0.
+        if stats_time and eventtime > stats_time:
+            lines_per_sec = lines / (eventtime - stats_time)
+        return True, "sd_pos=%d sd_lines_per_sec=%.0f sd_max_batch=%.3f" % (
+            self.file_position, lines_per_sec, max_batch_time)
     def get_file_list(self):
         dname = self.sdcard_dirname
         try:
@@ -55,6 +324,20 @@ class VirtualSD:
         except:
             logging.exception("virtual_sdcard get_file_list")
             raise self.gcode.error("Unable to get file list")
+    def remove_stale_caches(self, files):
+        # Remove the caches of files that are no longer in the sdcard
+        # directory
+        cache_names = set([fname + ".cache" for fname, fsize in files])
+        try:
+            if not os.path.isdir(self.cache_dirname):
+                return
+            for cname in os.listdir(self.cache_dirname):
+                if not cname.endswith(".cache") or cname in cache_names:
+                    continue
+                logging.info("Removing stale g-code cache %s", cname)
+                os.unlink(os.path.join(self.cache_dirname, cname))
+        except:
+            logging.exception("virtual_sdcard remove_stale_caches")
     def get_status(self, eventtime):
         progress = 0.
         if self.work_timer is not None and self.file_size:
@@ -86,6 +369,9 @@ class VirtualSD:
             self.current_file.close()
             self.current_file = None
             self.file_position = self.file_size = 0
+        if self.cache is not None:
+            self.cache.cancel()
+            self.cache = None
         try:
             orig = params['#original']
             filename = orig[orig.find("M23") + 4:].split()[0].strip()
@@ -112,11 +398,22 @@ class VirtualSD:
         self.current_file = f
         self.file_position = 0
         self.file_size = fsize
+        if self.use_cache:
+            self.remove_stale_caches(files)
+            self.cache = GCodeCache(self.reactor, self.gcode, fname,
+                                    self.cache_dirname)
+            self.reactor.register_callback(self.cache.build)
     def cmd_M24(self, params):
         # Start/resume SD print
         if self.work_timer is not None:
             raise self.gcode.error("SD busy")
         self.must_pause_work = False
+        if self.is_fileinput:
+            self._run_debug_input_print()
+            return
+        if self.cache is not None and not self.cache.is_ready:
+            # Don't compete with the print for cpu time
+            self.cache.cancel()
         self.work_timer = self.reactor.register_timer(
             self.work_handler, self.reactor.NOW)
     def cmd_M25(self, params):
@@ -135,58 +432,113 @@ class VirtualSD:
             return
         self.gcode.respond("SD printing byte %d/%d" % (
             self.file_position, self.file_size))
+    def _run_debug_input_print(self):
+        # Debug input (klippy -i) is read and run without waiting for
+        # background work, so a print (or cache build) started in the
+        # background would only run after all of the input was read.
+        # Instead, build the cache and run the print to completion now
+        # (using the gcode mutex that the M24 command already holds).
+        cache = self.cache
+        if cache is not None and not cache.is_ready:
+            cache.cancel()
+            self.cache = cache = GCodeCache(
+                self.reactor, self.gcode, cache.filename, self.cache_dirname)
+            cache.build(self.reactor.monotonic())
+        self.work_timer = self.reactor.register_timer(self.work_handler)
+        self.work_handler(self.reactor.monotonic(), have_mutex=True)
     # Background work timer
-    def work_handler(self, eventtime):
+    def work_handler(self, eventtime, have_mutex=False):
         logging.info("Starting SD card print (position %d)", self.file_position)
         self.reactor.unregister_timer(self.work_timer)
+        cache_reader = None
         try:
             self.current_file.seek(self.file_position)
+            reader = GCodeFileReader(self.current_file)
+            if self.cache is not None:
+                cache_reader = self.cache.open(self.file_position)
+                if cache_reader is not None:
+                    logging.info("Using g-code cache %s",
+                                 self.cache.cache_filename)
+                    reader = cache_reader
         except:
             logging.exception("virtual_sdcard seek")
             self.gcode.respond_error("Unable to seek file")
             self.work_timer = None
             return self.reactor.NEVER
         gcode_mutex = self.gcode.get_mutex()
-        partial_input = ""
-        lines = []
+        res = True
+        while not self.must_pause_work:
+            if have_mutex:
+                res = self._run_batch(reader)
+            else:
+                # Pause if any other request is pending in the gcode class
+                if gcode_mutex.test():
+                    self.reactor.pause(self.reactor.monotonic() + 0.100)
+                    continue
+                # Dispatch a batch of commands
+                with gcode_mutex:
+                    res = self._run_batch(reader)
+            if res is None:
+                # End of file
+                self.current_file.close()
+                self.current_file = None
+                logging.info("Finished SD card print")
+                self.gcode.respond("Done printing file")
+                break
+            if not res:
+                break
+            self.reactor.pause(self.reactor.NOW)
+        if cache_reader is not None:
+            if res:
+                # After an error the reader is past the failed record
+                self.cache.resume_position = (self.file_position,
+                                              cache_reader.tell())
+            cache_reader.close()
+        logging.info("Exiting SD card print (position %d)", self.file_position)
+        self.work_timer = None
+        return self.reactor.NEVER
+    def _run_batch(self, reader):
+        # Run commands until the end of the file or until the time
+        # budget is used.  The gcode mutex must be held.  Returns
+        # False on an error and None at the end of the file.
+        start_time = self.reactor.monotonic()
+        end_time = start_time + BATCH_TIME
+        run_script_lines = self.gcode.run_script_lines
+        run_parsed_move = self.gcode.run_parsed_move
+        lines = 0
+        res = True
         while not self.must_pause_work:
-            if not lines:
-                # Read more data
-                try:
-                    data = self.current_file.read(8192)
-                except:
-                    logging.exception("virtual_sdcard read")
-                    self.gcode.respond_error("Error on virtual sdcard read")
-                    break
-                if not data:
-                    # End of file
-                    self.current_file.close()
-                    self.current_file = None
-                    logging.info("Finished SD card print")
-                    self.gcode.respond("Done printing file")
-                    break
-                lines = data.split('\n')
-                lines[0] = partial_input + lines[0]
-                partial_input = lines.pop()
-                lines.reverse()
-                self.reactor.pause(self.reactor.NOW)
-                continue
-            # Pause if any other request is pending in the gcode class
-            if gcode_mutex.test():
-                self.reactor.pause(self.reactor.monotonic() + 0.100)
-                continue
-            # Dispatch command
             try:
-                self.gcode.run_script(lines[-1])
+                record = reader.read_record()
+            except:
+                logging.exception("virtual_sdcard read")
+                self.gcode.respond_error("Error on virtual sdcard read")
+                res = False
+                break
+            if record is None:
+                res = None
+                break
+            cmd, coords, line = record
+            try:
+                if cmd is None:
+                    run_script_lines((line,))
+                else:
+                    run_parsed_move(cmd, coords, line)
             except self.gcode.error as e:
+                res = False
                 break
             except:
                 logging.exception("virtual_sdcard dispatch")
+                res = False
                 break
-            self.file_position += len(lines.pop()) + 1
-        logging.info("Exiting SD card print (position %d)", self.file_position)
-        self.work_timer = None
-        return self.reactor.NEVER
+            self.file_position += len(line)
+            lines += 1
+            if self.reactor.monotonic() >= end_time:
+                break
+        batch_time = self.reactor.monotonic() - start_time
+        self.stats_lines += lines
+        self.max_batch_time = max(self.max_batch_time, batch_time)
+        return res
 
 def load_config(config):
     return VirtualSD(config)
@@ -4,7 +4,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import os, re, logging, collections, shlex
-import homing, kinematics.extruder
+import homing, kinematics.extruder, tracelog
 
 # Parse and handle G-Code commands
 class GCodeParser:
@@ -43,6 +43,7 @@ class GCodeParser:
             self.register_command(cmd, func, wnr, desc)
             for a in getattr(self, 'cmd_' + cmd + '_aliases', []):
                 self.register_command(a, func, wnr)
+        self.move_handler = self.ready_gcode_handlers['G1']
         # G-Code coordinate manipulation
         self.absolute_coord = self.absolute_extrude = True
         self.base_position = [0.0, 0.0, 0.0, 0.0]
@@ -198,43 +199,73 @@ class GCodeParser:
         logging.info("\n".join(out))
     # Parse input into commands
     args_r = re.compile('([A-Z_]+|[A-Z*/])')
+    # Plain G0/G1 moves (as generated by slicers) are handled directly
+    move_r = re.compile(
+        r'(G[01])(?:\s*F([-+]?[0-9.]+))?(?:\s*X([-+]?[0-9.]+))?'
+        r'(?:\s*Y([-+]?[0-9.]+))?(?:\s*Z([-+]?[0-9.]+))?'
+        r'(?:\s*E([-+]?[0-9.]+))?(?:\s*F([-+]?[0-9.]+))?\s*(?:;.*)?$')
+    def parse_move(self, line):
+        # Returns (cmd, [x, y, z, e, f]) for a plain move or None
+        m = self.move_r.match(line)
+        if m is None:
+            return None
+        cmd, f1, x, y, z, e, f = m.groups()
+        if f is None:
+            f = f1
+        elif f1 is not None:
+            return None
+        try:
+            return cmd, [None if v is None else float(v)
+                         for v in (x, y, z, e, f)]
+        except ValueError:
+            # Let the generic code report the error
+            return None
     def _process_commands(self, commands, need_ack=True):
         for line in commands:
             # Ignore comments and leading/trailing spaces
             line = origline = line.strip()
-            cpos = line.find(';')
-            if cpos >= 0:
-                line = line[:cpos]
-            # Break command into parts
-            parts = self.args_r.split(line.upper())[1:]
-            params = { parts[i]: parts[i+1].strip()
-                       for i in range(0, len(parts), 2) }
-            params['#original'] = origline
-            if parts and parts[0] == 'N':
-                # Skip line number at start of command
-                del parts[:2]
-            if not parts:
-                # Treat empty line as empty command
-                parts = ['', '']
-            params['#command'] = cmd = parts[0] + parts[1].strip()
-            # Invoke handler for command
-            self.need_ack = need_ack
-            handler = self.gcode_handlers.get(cmd, self.cmd_default)
-            try:
-                handler(params)
-            except self.error as e:
-                self.respond_error(str(e))
-                self.reset_last_position()
-                if not need_ack:
-                    raise
-            except:
-                msg = 'Internal error on command:"%s"' % (cmd,)
-                logging.exception(msg)
-                self.printer.invoke_shutdown(msg)
-                self.respond_error(msg)
-                if not need_ack:
-                    raise
-            self.ack()
+            move = self.parse_move(line)
+            if (move is not None
+                and self.gcode_handlers.get(move[0]) is self.move_handler):
+                cmd, coords = move
+                handler = self._process_move
+                params = (coords, origline)
+            else:
+                cpos = line.find(';')
+                if cpos >= 0:
+                    line = line[:cpos]
+                # Break command into parts
+                parts = self.args_r.split(line.upper())[1:]
+                params = { parts[i]: parts[i+1].strip()
+                           for i in range(0, len(parts), 2) }
+                params['#original'] = origline
+                if parts and parts[0] == 'N':
+                    # Skip line number at start of command
+                    del parts[:2]
+                if not parts:
+                    # Treat empty line as empty command
+                    parts = ['', '']
+                params['#command'] = cmd = parts[0] + parts[1].strip()
+                handler = self.gcode_handlers.get(cmd, self.cmd_default)
+            self._run_command(cmd, handler, params, need_ack)
+    def _run_command(self, cmd, handler, params, need_ack):
+        # Invoke handler for command
+        self.need_ack = need_ack
+        try:
+            handler(params)
+        except self.error as e:
+            self.respond_error(str(e))
+            self.reset_last_position()
+            if not need_ack:
+                raise
+        except:
+            msg = 'Internal error on command:"%s"' % (cmd,)
+            logging.exception(msg)
+            self.printer.invoke_shutdown(msg)
+            self.respond_error(msg)
+            if not need_ack:
+                raise
+        self.ack()
     m112_r = re.compile('^(?:[nN][0-9]+)?\s*[mM]112(?:\s|$)')
     def _process_data(self, eventtime):
         # Read input, separate by newline, and add to pending_commands
@@ -290,6 +321,20 @@ class GCodeParser:
     def run_script(self, script):
         with self.mutex:
             self._process_commands(script.split('\n'), need_ack=False)
+    def run_script_lines(self, lines):
+        # Like run_script(), but the caller must hold the gcode mutex
+        self._process_commands(lines, need_ack=False)
+    def run_parsed_move(self, cmd, coords, line):
+        # Run a move that parse_move() returned for the given line (the
+        # gcode mutex must be held)
+        speed = coords[4]
+        if (self.gcode_handlers.get(cmd) is not self.move_handler
+            or (speed is not None and speed <= 0.)):
+            # Use the regular command processing
+            self._process_commands([line], need_ack=False)
+            return
+        self._run_command(cmd, self._process_move, (coords, line.strip()),
+                          False)
     def get_mutex(self):
         return self.mutex
     # Response handling
@@ -477,40 +522,56 @@ class GCodeParser:
         'SET_GCODE_OFFSET', 'M206', 'SAVE_GCODE_STATE', 'RESTORE_GCODE_STATE',
         'M105', 'M104', 'M109', 'M140', 'M190', 'M106', 'M107',
         'M112', 'M115', 'IGNORE', 'GET_POSITION',
-        'RESTART', 'FIRMWARE_RESTART', 'ECHO', 'STATUS', 'HELP']
+        'RESTART', 'FIRMWARE_RESTART', 'ECHO', 'STATUS', 'TRACE', 'HELP']
     # G-Code movement commands
     cmd_G1_aliases = ['G0']
     def cmd_G1(self, params):
         # Move
         try:
-            for axis in 'XYZ':
-                if axis in params:
-                    v = float(params[axis])
-                    pos = self.axis2pos[axis]
-                    if not self.absolute_coord:
-                        # value relative to position of last move
-                        self.last_position[pos] += v
-                    else:
-                        # value relative to base coordinate position
-                        self.last_position[pos] = v + self.base_position[pos]
-            if 'E' in params:
-                v = float(params['E']) * self.extrude_factor
-                if not self.absolute_coord or not self.absolute_extrude:
-                    # value relative to position of last move
-                    self.last_position[3] += v
-                else:
-                    # value relative to base coordinate position
-                    self.last_position[3] = v + self.base_position[3]
-            if 'F' in params:
-                gcode_speed = float(params['F'])
-                if gcode_speed <= 0.:
-                    raise self.error("Invalid speed in '%s'" % (
-                        params['#original'],))
-                self.speed = gcode_speed * self.speed_factor
+            coords = [float(params[axis]) if axis in params else None
+                      for axis in 'XYZEF']
         except ValueError as e:
             raise self.error("Unable to parse move '%s'" % (
                 params['#original'],))
+        self._process_move((coords, params['#original']))
+    def _process_move(self, move):
+        self._update_position(move)
         self.move_with_transform(self.last_position, self.speed)
+    def process_path_move(self, coords, origline, path_func):
+        # Move along a path made of linear segments (eg, an arc).  The
+        # path_func(start_pos, end_pos) callback returns the intermediate
+        # toolhead positions of the path.
+        start_pos = list(self.last_position)
+        self._update_position((coords, origline))
+        end_pos = self.last_position
+        for pos in path_func(start_pos, end_pos):
+            self.move_with_transform(pos, self.speed)
+        self.move_with_transform(end_pos, self.speed)
+    def _update_position(self, move):
+        coords, origline = move
+        for pos in range(3):
+            v = coords[pos]
+            if v is not None:
+                if not self.absolute_coord:
+                    # value relative to position of last move
+                    self.last_position[pos] += v
+                else:
+                    # value relative to base coordinate position
+                    self.last_position[pos] = v + self.base_position[pos]
+        v = coords[3]
+        if v is not None:
+            v *= self.extrude_factor
+            if not self.absolute_coord or not self.absolute_extrude:
+                # value relative to position of last move
+                self.last_position[3] += v
+            else:
+                # value relative to base coordinate position
+                self.last_position[3] = v + self.base_position[3]
+        gcode_speed = coords[4]
+        if gcode_speed is not None:
+            if gcode_speed <= 0.:
+                raise self.error("Invalid speed in '%s'" % (origline,))
+            self.speed = gcode_speed * self.speed_factor
     def cmd_G4(self, params):
         # Dwell
         if 'S' in params:
@@ -748,6 +809,21 @@ class GCodeParser:
         msg = self.printer.get_state_message()
         msg = msg.rstrip() + "\nKlipper state: Not ready"
         self.respond_error(msg)
+    cmd_TRACE_when_not_ready = True
+    cmd_TRACE_help = "Enable or disable host trace logging categories"
+    def cmd_TRACE(self, params):
+        if 'CATEGORY' in params:
+            try:
+                names = tracelog.parse_categories(params['CATEGORY'])
+            except tracelog.error as e:
+                raise self.error(str(e))
+            enable = self.get_int('ENABLE', params, 1, minval=0, maxval=1)
+            tracelog.set_enabled(names, enable)
+            # Retain the trace setting across a host restart
+            self.printer.get_start_args()['trace'] = tracelog.get_enabled()
+        enabled = tracelog.get_enabled()
+        self.respond_info("Trace categories enabled: %s (available: %s)" % (
+            ", ".join(enabled) or "none", ", ".join(tracelog.CATEGORIES)))
     cmd_HELP_when_not_ready = True
     def cmd_HELP(self, params):
         cmdhelp = []
@@ -289,7 +289,4 @@ class PrinterHeaters:
         self.turn_off_all_heaters(print_time)
 
 def add_printer_objects(config):
-    logging.info("====================== add_printer_objects-(heater.py) START =======================")
     config.get_printer().add_object('heater', PrinterHeaters(config))
-    logging.info("====================== add_printer_objects-(heater.py) END =======================")
-    
@@ -5,7 +5,7 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import sys, os, optparse, logging, time, threading, collections, importlib
-import util, reactor, queuelogger, msgproto, homing
+import util, reactor, queuelogger, msgproto, homing, tracelog
 import gcode, configfile, pins, heater, mcu, toolhead
 
 message_ready = "Printer is ready"
@@ -45,13 +45,44 @@ config, and restart the host software.
 Printer is shutdown
 """
 
+_trace = tracelog.get_tracer('config')
+
+# Index of the modules in the extras directory.  The index is kept for
+# the life of the process (it is only rebuilt if the directory changes).
+class ExtrasIndex:
+    def __init__(self):
+        self.path = os.path.join(os.path.dirname(__file__), 'extras')
+        self.mtime = None
+        self.modules = {}
+    def refresh(self):
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self.mtime:
+            return
+        self.mtime = mtime
+        self.modules = {}
+        for fname in os.listdir(self.path):
+            if fname.endswith('.py') and fname != '__init__.py':
+                name = fname[:-3]
+            elif os.path.exists(os.path.join(self.path, fname,
+                                             '__init__.py')):
+                name = fname
+            else:
+                continue
+            self.modules[name] = 'extras.' + name
+    def have_module(self, name):
+        return name in self.modules
+    def import_module(self, name):
+        return importlib.import_module(self.modules[name])
+
+extras_index = ExtrasIndex()
+
 class Printer:
     config_error = configfile.error
     command_error = homing.CommandError
     def __init__(self, input_fd, bglogger, start_args):
-        logging.info("=================== klippy.Printer.__init__ START ====================") 
         self.bglogger = bglogger
-        self.start_args = start_args      
+        self.start_args = start_args
+        tracelog.set_categories(start_args.get('trace', []))
         self.reactor = reactor.Reactor()
         self.reactor.register_callback(self._connect)
         self.state_message = message_startup
@@ -60,8 +91,9 @@ class Printer:
         self.event_handlers = {}
         gc = gcode.GCodeParser(self, input_fd)
         self.objects = collections.OrderedDict({'gcode': gc})
-        logging.info("==================== klippy.Printer.__init__ END ====================")
-        logging.info("")
+        # Module load profile (section, import time, load_config time)
+        self.load_profile = []
+        self.load_child_times = []
     def get_start_args(self):
         return self.start_args
     def get_reactor(self):
@@ -100,95 +132,71 @@ class Printer:
         if self.bglogger is not None:
             self.bglogger.set_rollover_info(name, info)
     def try_load_module(self, config, section):
-        logging.info("====================== try_load_module-[Printer] START =======================")
-        logging.info("self.objects is: ")
-        logging.info(self.objects)
-
         if section in self.objects:
-            logging.info("Returns the position of 11111111111111111111111111111")
-            logging.info("====================== try_load_module-[Printer] END =======================")
-            logging.info("  ") 
             return self.objects[section]
         module_parts = section.split()
-        logging.info("module_parts is: ")
-        logging.info(module_parts)
-
         module_name = module_parts[0]
-        py_name = os.path.join(os.path.dirname(__file__),
-                               'extras', module_name + '.py')
-        logging.info("py_name is: ")
-        logging.info(py_name)
-        py_dirname = os.path.join(os.path.dirname(__file__),
-                                  'extras', module_name, '__init__.py')
-        logging.info("py_dirname is: ")
-        logging.info(py_dirname)
-        if not os.path.exists(py_name) and not os.path.exists(py_dirname):
-            logging.info("Returns the position of 22222222222222222222222222222")
-            logging.info("====================== try_load_module-[Printer] END =======================")
-            logging.info("  ") 
+        if not extras_index.have_module(module_name):
             return None
-
-        mod = importlib.import_module('extras.' + module_name)
+        _trace.log("loading module '%s' for section '%s'",
+                   module_name, section)
+        start_time = time.time()
+        mod = extras_index.import_module(module_name)
+        import_time = time.time() - start_time
         init_func = 'load_config'
         if len(module_parts) > 1:
             init_func = 'load_config_prefix'
         init_func = getattr(mod, init_func, None)
-        if init_func is not None:
+        if init_func is None:
+            return None
+        # Time spent loading other modules is not charged to this one
+        self.load_child_times.append(0.)
+        start_time = time.time()
+        try:
             self.objects[section] = init_func(config.getsection(section))
-            logging.info("Returns the position of 3333333333333333333333333333")
-            logging.info("====================== try_load_module-[Printer] END =======================")
-            logging.info("  ") 
-            return self.objects[section]
-        logging.info("====================== try_load_module-[Printer] END =======================")
-        logging.info("  ") 
+        finally:
+            load_time = time.time() - start_time
+            child_time = self.load_child_times.pop()
+        if self.load_child_times:
+            self.load_child_times[-1] += import_time + load_time
+        self.load_profile.append((section, import_time,
+                                  load_time - child_time))
+        return self.objects[section]
+    def _log_load_profile(self):
+        profile = sorted(self.load_profile, key=(lambda p: -p[1] - p[2]))
+        import_time = sum([p[1] for p in profile])
+        load_time = sum([p[2] for p in profile])
+        msgs = ["Loaded %d modules (import=%.3f load_config=%.3f)" % (
+            len(profile), import_time, load_time)]
+        msgs += ["  %s: import=%.3f load_config=%.3f" % p for p in profile]
+        logging.info("\n".join(msgs))
     def _read_config(self):
-        logging.info("==================== printer._read_config-[Printer] START =====================")
+        extras_index.refresh()
         self.objects['configfile'] = pconfig = configfile.PrinterConfig(self)
         config = pconfig.read_main_config()
         if self.bglogger is not None:
             pconfig.log_config(config)
         # Create printer components
         for m in [pins, heater, mcu]:
-            logging.info("[pins, heater, mcu] -> m: ")
-            logging.info(m)
             m.add_printer_objects(config)
-            logging.info("  ") 
-        
         for section_config in config.get_prefix_sections(''):
-            logging.info("config.get_prefix_sections('') -> section_config: ") 
-            logging.info(section_config) 
-            logging.info("section_config.get_name(): ") 
-            logging.info(section_config.get_name())
-            logging.info("  ") 
             self.try_load_module(config, section_config.get_name())
-            
         for m in [toolhead]:
-            logging.info("  ") 
             m.add_printer_objects(config)
+        self._log_load_profile()
         # Validate that there are no undefined parameters in the config file
         pconfig.check_unused_options(config)
-        logging.info("==================== printer._read_config-[Printer] END =====================")
+        _trace.log("loaded %d printer objects", len(self.objects))
     def _connect(self, eventtime):
-        logging.info("==================== printer._connect-[Printer] START =====================")
         try:
             self._read_config()
-            logging.info("  ")
-            logging.info("self.event_handlers :")
-            logging.info(self.event_handlers)
-            logging.info("  ")
-            for cb in self.event_handlers.get("klippy:connect", []):  
+            for cb in self.event_handlers.get("klippy:connect", []):
                 if self.state_message is not message_startup:
                     return
-                logging.info("function cb() name is: "+cb.__name__)
-                logging.info("function cb() is: ")
-                logging.info(cb)
-                logging.info("============================= call "+cb.__name__+" =============================")
                 cb()
-                logging.info("-----------------------cb() for cycle-------------------------")
-                             
         except (self.config_error, pins.error) as e:
             logging.exception("Config error")
-            self._set_state("%s%s" % (str(e), message_restart)) 
+            self._set_state("%s%s" % (str(e), message_restart))
             return
         except msgproto.error as e:
             logging.exception("Protocol error")
@@ -213,16 +221,11 @@ class Printer:
             logging.exception("Unhandled exception during ready callback")
             self.invoke_shutdown("Internal error during ready callback: %s" % (
                 str(e),))
-        logging.info("==================== printer._connect-[Printer] END =====================")
     def run(self):
-        logging.info("  ")
-        logging.info("===================================== printer.run()-[Printer] START ========================================")
         systime = time.time()
         monotime = self.reactor.monotonic()
         logging.info("Start printer at %s (%.1f %.1f)",
                      time.asctime(time.localtime(systime)), systime, monotime)
-        
-        logging.info("  ")
         # Enter main reactor loop
         try:
             self.reactor.run()
@@ -238,7 +241,6 @@ class Printer:
             self.send_event("klippy:disconnect")
         except:
             logging.exception("Unhandled exception during post run")
-        logging.info("====================================== printer.run()-[Printer] END =========================================")
         return run_result
     def invoke_shutdown(self, msg):
         if self.is_shutdown:
@@ -293,18 +295,23 @@ def main():
     opts.add_option("-d", "--dictionary", dest="dictionary", type="string",
                     action="callback", callback=arg_dictionary,
                     help="file to read for mcu protocol dictionary")
+    opts.add_option("-t", "--trace", dest="trace", default="",
+                    help="comma separated list of trace categories to log"
+                    " (%s or all)" % (", ".join(tracelog.CATEGORIES),))
     options, args = opts.parse_args()
-    
     if len(args) != 1:
         opts.error("Incorrect number of arguments")
     start_args = {'config_file': args[0], 'start_reason': 'startup'}
+    try:
+        start_args['trace'] = tracelog.parse_categories(options.trace)
+    except tracelog.error as e:
+        opts.error(str(e))
 
     input_fd = bglogger = None
 
     debuglevel = logging.INFO
     if options.verbose:
         debuglevel = logging.DEBUG
-    
     if options.logfile:
         bglogger = queuelogger.setup_bg_logging(options.logfile, debuglevel)
     else:
@@ -314,14 +321,12 @@ def main():
         start_args['debuginput'] = options.debuginput
         debuginput = open(options.debuginput, 'rb')
         input_fd = debuginput.fileno()
-        logging.info("???????????????????create pty??????????????????????")
     else:
-        logging.info("options.debuginput is false in main(), ======create pty======")
         input_fd = util.create_pty(options.inputtty)
     if options.debugoutput:
         start_args['debugoutput'] = options.debugoutput
         start_args.update(options.dictionary)
-    
+
     logging.info("Starting Klippy...")
     start_args['software_version'] = util.get_git_version()
     if bglogger is not None:
@@ -330,11 +335,7 @@ def main():
             "Git version: %s" % (repr(start_args['software_version']),),
             "CPU: %s" % (util.get_cpu_info(),),
             "Python: %s" % (repr(sys.version),)])
-        logging.info("")
-        logging.info("==================== printer parameter: ======================")
         logging.info(versions)
-        logging.info("==============================================================")
-        logging.info("")
     elif not options.debugoutput:
         logging.warning("No log file specified!"
                         " Severe timing issues may result!")
@@ -343,7 +344,7 @@ def main():
     while 1:
         if bglogger is not None:
             bglogger.clear_rollover_info()
-            bglogger.set_rollover_info('versions', versions)   
+            bglogger.set_rollover_info('versions', versions)
         printer = Printer(input_fd, bglogger, start_args)
         res = printer.run()
         if res in ['exit', 'error_exit']:
@@ -351,7 +352,6 @@ def main():
         time.sleep(1.)
         logging.info("Restarting printer")
         start_args['start_reason'] = res
-        logging.info("start_reason res: "+res)
     if bglogger is not None:
         bglogger.stop()
 
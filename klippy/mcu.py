@@ -4,11 +4,115 @@
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
 import sys, os, zlib, logging, math
-import serialhdl, pins, chelper, clocksync
+import serialhdl, pins, chelper, clocksync, tracelog
+
+_trace = tracelog.get_tracer('mcu')
 
 class error(Exception):
     pass
 
+# Op codes for stepbatch_run() (see chelper/stepbatch.h)
+SB_MOVE_FILL, SB_EXTRUDER_MOVE_FILL = 0, 1
+SB_GEN_STEPS, SB_STEPPERSYNC_FLUSH = 2, 3
+
+# Batched step generation.  When step generation threads are enabled,
+# the step generation requests (and the step queue flushes that follow
+# them) made while a batch is open are recorded and then run with a
+# single call into the C helper code, which generates the steps of
+# each stepper in parallel.  Without threads, move_fill() and the other
+# step generation functions are the C helper functions themselves, so
+# they add no overhead.  As callers may keep a reference to these
+# functions, set_threads() must be called before they are looked up.
+class StepBatch:
+    def __init__(self, config):
+        self._ffi_main, self._ffi_lib = chelper.get_ffi()
+        self._null = self._ffi_main.NULL
+        self._pool = self._null
+        self._depth = 0
+        self._ops = []
+        self._params = []
+        self._iterative_solver = config.getchoice(
+            'step_solver', {'analytic': False, 'iterative': True}, 'analytic')
+        self.set_threads(0)
+    def setup_stepper_kinematics(self, sk):
+        # Cartesian and extruder steppers use the analytic step time
+        # solver unless the iterative solver was requested
+        if self._iterative_solver:
+            self._ffi_lib.itersolve_set_iterative(sk)
+    def set_threads(self, num_threads):
+        # Generate the steps of each stepper in parallel using the given
+        # number of additional worker threads (zero disables)
+        self.run()
+        ffi_main, ffi_lib = self._ffi_main, self._ffi_lib
+        self._pool = self._null
+        if not num_threads:
+            self.move_fill = ffi_lib.move_fill
+            self.extruder_move_fill = ffi_lib.extruder_move_fill
+            self.itersolve_gen_steps = ffi_lib.itersolve_gen_steps
+            self.steppersync_flush = ffi_lib.steppersync_flush
+            return
+        pool = ffi_lib.stepbatch_pool_alloc(num_threads)
+        if pool == self._null:
+            raise error("Unable to create step generation threads")
+        self._pool = ffi_main.gc(pool, ffi_lib.stepbatch_pool_free)
+        self.move_fill = self._record_move_fill
+        self.extruder_move_fill = self._record_extruder_move_fill
+        self.itersolve_gen_steps = self._record_gen_steps
+        self.steppersync_flush = self._record_steppersync_flush
+    def begin(self):
+        self._depth += 1
+    def finish(self, report_errors=True):
+        # Set report_errors to False when the batch is closed due to
+        # another exception (so that exception is not masked)
+        self._depth -= 1
+        if self._depth:
+            return
+        try:
+            self.run()
+        except error as e:
+            if report_errors:
+                raise
+            logging.exception("Error generating batched steps")
+    def run(self):
+        ops = self._ops
+        if not ops:
+            return
+        ffi_main = self._ffi_main
+        cops = ffi_main.new('struct stepbatch_op[]', ops)
+        cparams = ffi_main.new('double[]', self._params)
+        self._ops = []
+        self._params = []
+        ret = self._ffi_lib.stepbatch_run(self._pool, cops, len(ops), cparams)
+        if ret:
+            raise error("Internal error in stepcompress")
+    # Wrappers (used with threads) for the C helper functions that
+    # record the call while a batch is open
+    def _record_move_fill(self, cmove, *params):
+        if not self._depth:
+            self._ffi_lib.move_fill(cmove, *params)
+            return
+        self._ops.append((SB_MOVE_FILL, len(self._params),
+                          cmove, self._null, 0))
+        self._params.extend(params)
+    def _record_extruder_move_fill(self, cmove, *params):
+        if not self._depth:
+            self._ffi_lib.extruder_move_fill(cmove, *params)
+            return
+        self._ops.append((SB_EXTRUDER_MOVE_FILL, len(self._params),
+                          cmove, self._null, 0))
+        self._params.extend(params)
+    def _record_gen_steps(self, sk, cmove):
+        if not self._depth:
+            return self._ffi_lib.itersolve_gen_steps(sk, cmove)
+        self._ops.append((SB_GEN_STEPS, 0, sk, cmove, 0))
+        return 0
+    def _record_steppersync_flush(self, steppersync, clock):
+        if not self._depth:
+            return self._ffi_lib.steppersync_flush(steppersync, clock)
+        self._ops.append((SB_STEPPERSYNC_FLUSH, 0,
+                          steppersync, self._null, clock))
+        return 0
+
 class MCU_stepper:
     def __init__(self, mcu, pin_params):
         self._mcu = mcu
@@ -25,7 +129,9 @@ class MCU_stepper:
         self._stepqueue = ffi_main.gc(self._ffi_lib.stepcompress_alloc(oid),
                                       self._ffi_lib.stepcompress_free)
         self._mcu.register_stepqueue(self._stepqueue)
+        self._step_batch = mcu.get_step_batch()
         self._stepper_kinematics = self._itersolve_gen_steps = None
+        self._ignore_move = False
         self.set_ignore_move(False)
     def get_mcu(self):
         return self._mcu
@@ -76,6 +182,8 @@ class MCU_stepper:
     def set_position(self, coord):
         self.set_commanded_position(self.calc_position_from_coord(coord))
     def get_commanded_position(self):
+        # Any batched steps must be generated before reading the position
+        self._step_batch.run()
         return self._ffi_lib.itersolve_get_commanded_pos(
             self._stepper_kinematics)
     def set_commanded_position(self, pos):
@@ -93,16 +201,18 @@ class MCU_stepper:
         if sk is not None:
             self._ffi_lib.itersolve_set_stepcompress(
                 sk, self._stepqueue, self._step_dist)
+            self._step_batch.setup_stepper_kinematics(sk)
         return old_sk
     def set_ignore_move(self, ignore_move):
-        was_ignore = (self._itersolve_gen_steps
-                      is not self._ffi_lib.itersolve_gen_steps)
+        was_ignore = self._ignore_move
+        self._ignore_move = ignore_move
         if ignore_move:
             self._itersolve_gen_steps = (lambda *args: 0)
         else:
-            self._itersolve_gen_steps = self._ffi_lib.itersolve_gen_steps
+            self._itersolve_gen_steps = self._step_batch.itersolve_gen_steps
         return was_ignore
     def note_homing_end(self, did_trigger=False):
+        self._step_batch.run()
         ret = self._ffi_lib.stepcompress_reset(self._stepqueue, 0)
         if ret:
             raise error("Internal error in stepcompress")
@@ -430,9 +540,23 @@ class CommandWrapper:
         self._clocksync = clocksync
         self._cmd = cmd
         self._cmd_queue = cmd_queue
+        # Commands with only integer parameters are encoded by the C
+        # helper code from a reusable parameter array
+        self._cmd_data = None
+        self._cmd_count = len(cmd.param_types) + 1
+        if not [t for t in cmd.param_types if not t.is_int]:
+            ffi_main, ffi_lib = chelper.get_ffi()
+            self._cmd_data = ffi_main.new('uint32_t[]', self._cmd_count)
+            self._cmd_data[0] = cmd.msgid
     def send(self, data=(), minclock=0, reqclock=0):
-        cmd = self._cmd.encode(data)
-        self._serial.raw_send(cmd, minclock, reqclock, self._cmd_queue)
+        cmd_data = self._cmd_data
+        if cmd_data is None:
+            cmd = self._cmd.encode(data)
+            self._serial.raw_send(cmd, minclock, reqclock, self._cmd_queue)
+            return
+        cmd_data[1:self._cmd_count] = [v & 0xffffffff for v in data]
+        self._serial.encode_and_send(cmd_data, self._cmd_count,
+                                     minclock, reqclock, self._cmd_queue)
     def send_with_response(self, data=(), response=None, response_oid=None,
                            minclock=0):
         minsystime = 0.
@@ -446,18 +570,20 @@ class CommandWrapper:
         except serialhdl.error as e:
             raise error(str(e))
 
+# The encoded config and init commands of each mcu from the last
+# connect (kept across a RESTART so unchanged commands need not be
+# encoded again)
+_encoded_commands = {}
+
 class MCU:
     error = error
     def __init__(self, config, clocksync):
-        logging.info("  ")
-        logging.info("======================== MCU.__init__ START =========================")
         self._printer = config.get_printer()
         self._clocksync = clocksync
         self._reactor = self._printer.get_reactor()
         self._name = config.get_name()
         if self._name.startswith('mcu '):
             self._name = self._name[4:]
-        self._printer.register_event_handler("klippy:connect", self._connect)
         self._printer.register_event_handler("klippy:shutdown", self._shutdown)
         self._printer.register_event_handler("klippy:disconnect",
                                              self._disconnect)
@@ -467,8 +593,18 @@ class MCU:
         if not (self._serialport.startswith("/dev/rpmsg_")
                 or self._serialport.startswith("/tmp/klipper_host_")):
             baud = config.getint('baud', 250000, minval=2400)
+        # Optional on-disk cache of the mcu data dictionary
+        self._cache_path = config.get('cache_path', None)
+        if self._cache_path is not None:
+            self._cache_path = os.path.expanduser(self._cache_path)
+            try:
+                if not os.path.isdir(self._cache_path):
+                    os.makedirs(self._cache_path)
+            except os.error as e:
+                raise config.error("Unable to create mcu cache '%s': %s" % (
+                    self._cache_path, str(e)))
         self._serial = serialhdl.SerialReader(
-            self._reactor, self._serialport, baud)
+            self._reactor, self._serialport, baud, self._cache_path)
         # Restarts
         self._restart_method = 'command'
         if baud:
@@ -495,13 +631,12 @@ class MCU:
         self._move_count = 0
         self._stepqueues = []
         self._steppersync = None
+        self._step_batch = self._printer.lookup_object('step_batch')
         # Stats
         self._stats_sumsq_base = 0.
         self._mcu_tick_avg = 0.
         self._mcu_tick_stddev = 0.
         self._mcu_tick_awake = 0.
-        logging.info("========================= MCU.__init__ END ==========================")
-        logging.info("  ")
     # Serial callbacks
     def _handle_mcu_stats(self, params):
         count = params['count']
@@ -535,7 +670,6 @@ class MCU:
         self._reactor.pause(self._reactor.monotonic() + 2.000)
         raise error("Attempt MCU '%s' restart failed" % (self._name,))
     def _connect_file(self, pace=False):
-        logging.info("======================= _connect_file()-[MCU] START ========================")
         # In a debugging mode.  Open debug output file and read data dictionary
         start_args = self._printer.get_start_args()
         if self._name == 'mcu':
@@ -555,7 +689,6 @@ class MCU:
             def dummy_estimated_print_time(eventtime):
                 return 0.
             self.estimated_print_time = dummy_estimated_print_time
-        logging.info("======================== _connect_file()-[MCU] END ==========================")
     def _add_custom(self):
         for line in self._custom.split('\n'):
             line = line.strip()
@@ -565,6 +698,27 @@ class MCU:
             if not line:
                 continue
             self.add_config_cmd(line)
+    def _encode_commands(self, kind, cmds):
+        # Returns the encoded commands (stored back to back) and the
+        # length of each.  The result of the previous connect is reused
+        # if neither the commands nor the data dictionary have changed.
+        msgparser = self._serial.get_msgparser()
+        text = '\n'.join(cmds)
+        key = (self._name, kind)
+        cached = _encoded_commands.get(key)
+        if (cached is not None and cached[0] == text
+            and cached[1] == msgparser.raw_identify_data):
+            return cached[2]
+        data = []
+        lens = []
+        for c in cmds:
+            cmd = msgparser.create_command(c)
+            if cmd:
+                data.extend(cmd)
+                lens.append(len(cmd))
+        _encoded_commands[key] = (text, msgparser.raw_identify_data,
+                                  (data, lens))
+        return data, lens
     def _send_config(self, prev_crc):
         # Build config commands
         for cb in self._config_callbacks:
@@ -589,14 +743,16 @@ class MCU:
         if prev_crc is None:
             logging.info("Sending MCU '%s' printer configuration...",
                          self._name)
-            for c in self._config_cmds:
-                self._serial.send(c)
+            self._serial.send_multi(
+                *self._encode_commands('config', self._config_cmds))
         elif config_crc != prev_crc:
             self._check_restart("CRC mismatch")
             raise error("MCU '%s' CRC does not match config" % (self._name,))
         # Transmit init messages
-        for c in self._init_cmds:
-            self._serial.send(c)
+        _trace.log("MCU '%s' sending %d init commands",
+                   self._name, len(self._init_cmds))
+        self._serial.send_multi(
+            *self._encode_commands('init', self._init_cmds))
     def _send_get_config(self):
         get_config_cmd = self.lookup_command("get_config")
         if self.is_fileoutput():
@@ -634,23 +790,29 @@ class MCU:
             self._move_count)
         self._ffi_lib.steppersync_set_time(
             self._steppersync, 0., self._mcu_freq)
-    def _connect(self):
-        logging.info("  ")
-        logging.info("======================= _connect()-[MCU] START ========================")
+    # Connection is done in three phases (see MCUConnect below)
+    def _connect_serial(self):
+        _trace.log("connecting MCU '%s'", self._name)
         if self.is_fileoutput():
-            logging.info("****************** _connect_file() ******************")
             self._connect_file()
-        else:
-            if (self._restart_method == 'rpi_usb'
-                and not os.path.exists(self._serialport)):
-                # Try toggling usb power
-                self._check_restart("enable power")
-            try: 
-                logging.info("************* self._serial.connect() ************")
-                self._serial.connect()
-                self._clocksync.connect(self._serial)
-            except serialhdl.error as e:
-                raise error(str(e))
+            return
+        if (self._restart_method == 'rpi_usb'
+            and not os.path.exists(self._serialport)):
+            # Try toggling usb power
+            self._check_restart("enable power")
+        try:
+            self._serial.connect()
+        except serialhdl.error as e:
+            raise error(str(e))
+        _trace.log("MCU '%s' identified", self._name)
+    def _connect_clock(self):
+        if self.is_fileoutput():
+            return
+        try:
+            self._clocksync.connect(self._serial)
+        except serialhdl.error as e:
+            raise error(str(e))
+    def _connect_config(self):
         msgparser = self._serial.get_msgparser()
         name = self._name
         log_info = [
@@ -684,8 +846,6 @@ class MCU:
         logging.info(move_msg)
         log_info.append(move_msg)
         self._printer.set_rollover_info(name, "\n".join(log_info), log=False)
-        logging.info("========================= _connect()-[MCU] END ==========================")
-        logging.info("  ")
     # Config creation helpers
     def setup_pin(self, pin_type, pin_params):
         pcs = {'stepper': MCU_stepper, 'endstop': MCU_endstop,
@@ -707,6 +867,8 @@ class MCU:
         slot = self.seconds_to_clock(oid * .01)
         t = int(self.estimated_print_time(self._reactor.monotonic()) + 1.5)
         return self.print_time_to_clock(t) + slot
+    def get_step_batch(self):
+        return self._step_batch
     def register_stepqueue(self, stepqueue):
         self._stepqueues.append(stepqueue)
     def seconds_to_clock(self, time):
@@ -808,7 +970,7 @@ class MCU:
         clock = self.print_time_to_clock(print_time)
         if clock < 0:
             return
-        ret = self._ffi_lib.steppersync_flush(self._steppersync, clock)
+        ret = self._step_batch.steppersync_flush(self._steppersync, clock)
         if ret:
             raise error("Internal error in MCU '%s' stepcompress" % (
                 self._name,))
@@ -857,20 +1019,108 @@ def error_help(msg):
                 return help_msg
     return ""
 
+# Connect to all the micro-controllers in parallel.  Each mcu is
+# connected from its own reactor greenlet - only the clock
+# synchronization of the secondary mcus has to wait for the main mcu.
+# After an error the other mcus stop at their next connect phase and
+# the first error (in mcu order) is raised once all of them are done.
+class MCUConnect:
+    def __init__(self, printer, mcus):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.mcus = mcus
+        self.main_clock = None
+        self.aborted = False
+        self.results = {}
+        self.wake = None
+        printer.register_event_handler("klippy:connect", self._connect)
+    def _run(self, mcu, profile):
+        # Returns False if the connect was aborted due to another error
+        reactor = self.reactor
+        main_clock = self.main_clock
+        start_time = reactor.monotonic()
+        mcu._connect_serial()
+        serial_time = reactor.monotonic()
+        identify_time = min(mcu._serial.identify_time, serial_time - start_time)
+        profile['open'] = serial_time - start_time - identify_time
+        profile['identify'] = identify_time
+        if mcu is not self.mcus[0]:
+            if not main_clock.wait():
+                return False
+            serial_time = reactor.monotonic()
+        if self.aborted:
+            return False
+        mcu._connect_clock()
+        clock_time = reactor.monotonic()
+        profile['clocksync'] = clock_time - serial_time
+        if mcu is self.mcus[0]:
+            main_clock.complete(True)
+        if self.aborted:
+            return False
+        mcu._connect_config()
+        end_time = reactor.monotonic()
+        profile['config'] = end_time - clock_time
+        profile['total'] = end_time - start_time
+        return True
+    def _connect_mcu(self, mcu):
+        def connect_mcu(eventtime):
+            profile = {}
+            try:
+                if not self._run(mcu, profile):
+                    profile = None
+            except:
+                profile = sys.exc_info()
+                self.aborted = True
+            if mcu is self.mcus[0] and not self.main_clock.test():
+                self.main_clock.complete(False)
+            self.results[mcu] = profile
+            if self.wake is not None:
+                self.wake.complete(None)
+        return connect_mcu
+    def _connect(self):
+        reactor = self.reactor
+        start_time = reactor.monotonic()
+        self.main_clock = reactor.completion()
+        self.aborted = False
+        self.results = {}
+        for mcu in self.mcus:
+            reactor.register_callback(self._connect_mcu(mcu))
+        # Wait for all mcus (the remaining mcus stop at their next
+        # connect phase after an error)
+        while len(self.results) < len(self.mcus):
+            self.wake = reactor.completion()
+            self.wake.wait()
+            self.wake = None
+        errors = [(mcu, self.results[mcu]) for mcu in self.mcus
+                  if type(self.results[mcu]) is tuple]
+        if errors:
+            for mcu, exc_info in errors[1:]:
+                logging.error("Additional error connecting MCU '%s'",
+                              mcu.get_name(), exc_info=exc_info)
+            exc_info = errors[0][1]
+            raise exc_info[0], exc_info[1], exc_info[2]
+        # Log startup profile
+        msgs = ["MCU '%s' startup: %s" % (mcu.get_name(), " ".join(
+            ["%s=%.3f" % (phase, self.results[mcu][phase])
+             for phase in ['open', 'identify', 'clocksync', 'config',
+                           'total']]))
+                for mcu in self.mcus]
+        msgs.append("Connected %d MCUs in %.3f seconds" % (
+            len(self.mcus), reactor.monotonic() - start_time))
+        logging.info("\n".join(msgs))
+
 def add_printer_objects(config):
-    logging.info("  ")
-    logging.info("====================== add_printer_objects-(mcu.py) START =======================")
     printer = config.get_printer()
-    reactor = printer.get_reactor()   
-    mainsync = clocksync.ClockSync(reactor)   #mainsync
-    printer.add_object('mcu', MCU(config.getsection('mcu'), mainsync))
-
+    reactor = printer.get_reactor()
+    mainsync = clocksync.ClockSync(reactor)
+    printer.add_object('step_batch', StepBatch(config.getsection('printer')))
+    mcus = [MCU(config.getsection('mcu'), mainsync)]
+    printer.add_object('mcu', mcus[0])
     for s in config.get_prefix_sections('mcu '):
-        printer.add_object(s.section, MCU(
-            s, clocksync.SecondarySync(reactor, mainsync)))
- 
-    logging.info("====================== add_printer_objects-(mcu.py) END =======================")
-    logging.info("  ")
+        mcus.append(MCU(s, clocksync.SecondarySync(reactor, mainsync)))
+        printer.add_object(s.section, mcus[-1])
+    MCUConnect(printer, mcus)
+
 def get_printer_mcu(printer, name):
     if name == 'mcu':
         return printer.lookup_object(name)
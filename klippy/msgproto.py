@@ -128,6 +128,50 @@ def lookup_params(msgformat, enumerations={}):
         out.append((name, pt))
     return out
 
+# Generate a parser for a list of message parameters.  The generated
+# code decodes each parameter inline (avoiding a method call per
+# parameter) and builds the params dictionary in one step.
+def build_parser(param_names):
+    code = ["def parse(s, pos):", "    pos += 1"]
+    env = {}
+    for i, (name, t) in enumerate(param_names):
+        pt = t
+        if isinstance(t, Enumeration):
+            pt = t.pt
+        if pt.is_dynamic_string:
+            code += ["    l = s[pos]",
+                     "    p%d = str(bytearray(s[pos+1:pos+l+1]))" % (i,),
+                     "    pos += l + 1"]
+            continue
+        # Values below 0x60 are encoded in a single byte
+        code += ["    c = s[pos]",
+                 "    pos += 1",
+                 "    if c < 0x60:",
+                 "        p%d = c" % (i,),
+                 "    else:",
+                 "        v = c & 0x7f",
+                 "        if (c & 0x60) == 0x60:",
+                 "            v |= -0x20",
+                 "        while c & 0x80:",
+                 "            c = s[pos]",
+                 "            pos += 1",
+                 "            v = (v<<7) | (c & 0x7f)"]
+        if pt.signed:
+            code.append("        p%d = v" % (i,))
+        else:
+            code.append("        p%d = int(v & 0xffffffff)" % (i,))
+        if pt is not t:
+            env['enums%d' % (i,)] = t.reverse_enums
+            code += ["    v = enums%d.get(p%d)" % (i, i),
+                     "    if v is None:",
+                     "        v = \"?%%d\" %% (p%d,)" % (i,),
+                     "    p%d = v" % (i,)]
+    code.append("    return {%s}, pos" % (", ".join([
+        "%s: p%d" % (repr(name), i)
+        for i, (name, t) in enumerate(param_names)]),))
+    exec "\n".join(code) in env
+    return env['parse']
+
 # Update the message format to be compatible with python's % operator
 def convert_msg_format(msgformat):
     for c in ['%u', '%i', '%hu', '%hi', '%c', '%.*s', '%*s']:
@@ -143,6 +187,7 @@ class MessageFormat:
         self.param_names = lookup_params(msgformat, enumerations)
         self.param_types = [t for name, t in self.param_names]
         self.name_to_type = dict(self.param_names)
+        self.parse = build_parser(self.param_names)
     def encode(self, params):
         out = []
         out.append(self.msgid)
@@ -155,7 +200,8 @@ class MessageFormat:
         for name, t in self.param_names:
             t.encode(out, params[name])
         return out
-    def parse(self, s, pos):
+    def parse_generic(self, s, pos):
+        # Reference implementation of parse() (which is generated)
         pos += 1
         out = {}
         for name, t in self.param_names:
@@ -361,12 +407,16 @@ class MessageParser:
             msg = MessageFormat(msgid, msgformat, self.enumerations)
             self.messages_by_id[msgid] = msg
             self.messages_by_name[msg.name] = msg
-    def process_identify(self, data, decompress=True):
+    def process_identify(self, data, decompress=True, parsed=None):
+        # Returns the parsed data dictionary.  A previously parsed copy
+        # of the same dictionary may be supplied in 'parsed'.
         try:
             if decompress:
                 data = zlib.decompress(data)
             self.raw_identify_data = data
-            data = json.loads(data)
+            if parsed is None:
+                parsed = json.loads(data)
+            data = parsed
             self._fill_enumerations(data.get('enumerations', {}))
             commands = data.get('commands')
             responses = data.get('responses')
@@ -384,6 +434,7 @@ class MessageParser:
         except Exception as e:
             logging.exception("process_identify error")
             raise error("Error during identify: %s" % (str(e),))
+        return parsed
     def get_enumerations(self):
         return dict(self.enumerations)
     def get_constants(self):
@@ -270,6 +270,4 @@ class PrinterPins:
         self.pin_resolvers[chip_name] = PinResolver()
 
 def add_printer_objects(config):
-    logging.info("====================== add_printer_objects-(pins.py) START =======================")
     config.get_printer().add_object('pins', PrinterPins())
-    logging.info("====================== add_printer_objects-(pins.py) END =======================")
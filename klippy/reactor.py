@@ -3,25 +3,23 @@
 # Copyright (C) 2016-2019  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import os, select, math, time, Queue, logging
+import os, select, math, time, Queue, logging, heapq
 import greenlet
-import chelper, util 
+import chelper, util, tracelog
+
+_trace = tracelog.get_tracer('reactor')
 
 _NOW = 0.
 _NEVER = 9999999999999999.
 
 class ReactorTimer:
     def __init__(self, callback, waketime):
-        logging.info("  ")
-        logging.info("==================== reactor.ReactorTimer.__init__ =====================")
         self.callback = callback
         self.waketime = waketime
-        self.name = callback.__name__
-        
-        logging.info("callback name is: "+self.name)
-        logging.info("callback is: "+str(callback))
-        logging.info("================== reactor.ReactorTimer.__init__ END ===================")
-        logging.info("  ")
+        # Sequence number of the valid timer heap entry (None if the
+        # timer is not registered)
+        self.heap_seq = None
+
 class ReactorCompletion:
     class sentinel: pass
     def __init__(self, reactor):
@@ -37,7 +35,6 @@ class ReactorCompletion:
     def wait(self, waketime=_NEVER, waketime_result=None):
         if self.result is self.sentinel:
             self.waiting = greenlet.getcurrent()
-            logging.info("======================= wait-[ReactorCompletion] call reactor.pause() =======================")
             self.reactor.pause(waketime)
             self.waiting = None
             if self.result is self.sentinel:
@@ -46,22 +43,14 @@ class ReactorCompletion:
 
 class ReactorCallback:
     def __init__(self, reactor, callback, waketime):
-        logging.info("")
-        logging.info("============= reactor.ReactorCallback.__init__ START ================")
         self.reactor = reactor
         self.timer = reactor.register_timer(self.invoke, waketime)
         self.callback = callback
-        logging.info("self.callback[ReactorCallback] name is: "+callback.__name__+"()")
-        #logging.info(callback.__name__)
         self.completion = ReactorCompletion(reactor)
-        logging.info("============= reactor.ReactorCallback.__init__ END ================")
-        logging.info("")
     def invoke(self, eventtime):
-        logging.info("================= invoke()-[ReactorCallback] START ================")
         self.reactor.unregister_timer(self.timer)
         res = self.callback(eventtime)
         self.completion.complete(res)
-        logging.info("================== invoke()-[ReactorCallback] END =================")
         return self.reactor.NEVER
 
 class ReactorFileHandler:
@@ -109,12 +98,13 @@ class SelectReactor:
     NOW = _NOW
     NEVER = _NEVER
     def __init__(self):
-        logging.info("=============== reactor.SelectReactor.__init__ ================")
         # Main code
         self._process = False
         self.monotonic = chelper.get_ffi()[1].get_monotonic
-        # Timers
-        self._timers = []
+        # Timers (min-heap of (waketime, seq, timer) with lazy deletion)
+        self._timer_heap = []
+        self._timer_seq = 0
+        self._timer_count = 0
         self._next_timer = self.NEVER
         # Callbacks
         self._pipe_fds = None
@@ -124,99 +114,102 @@ class SelectReactor:
         # Greenlets
         self._g_dispatch = None
         self._greenlets = []
-        logging.info("============== reactor.SelectReactor.__init__ END ==============")
     # Timers
-    def update_timer(self, timer_handler, waketime):
+    def _schedule_timer(self, timer_handler, waketime):
+        # Add a heap entry for the timer - any older entry becomes stale
         timer_handler.waketime = waketime
+        self._timer_seq = seq = self._timer_seq + 1
+        timer_handler.heap_seq = seq
+        if waketime >= self.NEVER:
+            return
+        heap = self._timer_heap
+        heapq.heappush(heap, (waketime, seq, timer_handler))
+        if len(heap) > 2 * self._timer_count + 64:
+            self._compact_timers()
+    def _compact_timers(self):
+        # Drop stale heap entries (lazily deleted by update/unregister)
+        heap = [e for e in self._timer_heap if e[2].heap_seq == e[1]]
+        heapq.heapify(heap)
+        self._timer_heap = heap
+    def update_timer(self, timer_handler, waketime):
+        if timer_handler.heap_seq is None:
+            timer_handler.waketime = waketime
+            return
+        self._schedule_timer(timer_handler, waketime)
         self._next_timer = min(self._next_timer, waketime)
     def register_timer(self, callback, waketime=NEVER):
-        logging.info("  ")
-        logging.info("============= reactor.register_timer()-[SelectReactor] START =============")
-        logging.info("callback is: "+str(callback))
-        logging.info("callback name is: "+callback.__name__+"()")
-          
-        timer_handler = ReactorTimer(callback, waketime) 
-        
-        logging.info("self._timers is: ")
-        logging.info(self._timers)
-
-        timers = list(self._timers)
-        timers.append(timer_handler)
-        self._timers = timers
+        if _trace.enabled:
+            _trace.log("register_timer %s waketime=%.6f (%d timers)",
+                       callback.__name__, waketime, self._timer_count + 1)
+        timer_handler = ReactorTimer(callback, waketime)
+        self._timer_count += 1
+        self._schedule_timer(timer_handler, waketime)
         self._next_timer = min(self._next_timer, waketime)
-
-        logging.info("self._timers is: ")
-        logging.info(self._timers)
-
-        logging.info("=========== reactor.register_timer()-[SelectReactor] END ===========")
-        logging.info("  ")
         return timer_handler
     def unregister_timer(self, timer_handler):
+        if _trace.enabled:
+            _trace.log("unregister_timer %s", timer_handler.callback.__name__)
+        if timer_handler.heap_seq is None:
+            raise ValueError("Timer not registered")
         timer_handler.waketime = self.NEVER
-        timers = list(self._timers)
-        timers.pop(timers.index(timer_handler))
-        self._timers = timers
+        timer_handler.heap_seq = None
+        self._timer_count -= 1
+    def _restore_timers(self, entries):
+        # Return heap entries set aside during a dispatch pass
+        heap = self._timer_heap
+        for entry in entries:
+            heapq.heappush(heap, entry)
+        if entries:
+            self._next_timer = min(self._next_timer, heap[0][0])
     def _check_timers(self, eventtime):
-        logging.info("")
-        logging.info("================= _check_timers()-[SelectReactor] START =================")
         if eventtime < self._next_timer:
-            logging.info("eee+111111111111111111")
             return min(1., max(.001, self._next_timer - eventtime))
-        
-        self._next_timer = self.NEVER
         g_dispatch = self._g_dispatch
-        logging.info("  ")
-        logging.info("self._g_dispatch: "+str(self._g_dispatch))
-        logging.info("  ")
-        aaa = 0
-        logging.info("&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&& _check_timers() FOR LOOP START &&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&")
-        for t in self._timers:    
-            aaa = aaa + 1       
-            logging.info("for loop count is: "+str(aaa))
-            logging.info("self._timers is: ")
-            logging.info(self._timers)
-            logging.info("t is: "+str(t))
-            #logging.info(t)
-            logging.info("  ")
-            waketime = t.waketime
-            logging.info("eventtime is: "+str(eventtime))
-            #logging.info(eventtime)
-            logging.info("waketime is: "+str(waketime))
-            #logging.info(waketime)
-
-
-            logging.info("  ")
-            if eventtime >= waketime:
-                t.waketime = self.NEVER               
-                logging.info("============================= _check_timers() call "+t.callback.__name__+"(eventtime) =============================")
-                logging.info("  ")
-                t.waketime = waketime = t.callback(eventtime)
-                logging.info("adadadadadadadadadadadadadaaaaaaaaaaaaaaaaaaaaaaaaaaa")
-                #logging.info("t.waketime is: ")
-                #logging.info(t.waketime)
-                if g_dispatch is not self._g_dispatch:
-                    self._next_timer = min(self._next_timer, waketime)
-                    self._end_greenlet(g_dispatch)
-                    logging.info("================ _check_timers()-[SelectReactor] END 02================")
-                    return 0.
-            self._next_timer = min(self._next_timer, waketime)
-        logging.info("&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&& FOR LOOP END &&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&&")
-        
+        heap = self._timer_heap
+        # Timers rescheduled during this pass are not run until the next
+        # pass (entries with a sequence number at or above start_seq).
+        # They are set aside so that every other due timer still runs.
+        start_seq = self._timer_seq + 1
+        deferred = []
+        while heap:
+            waketime, seq, t = heap[0]
+            if t.heap_seq != seq:
+                heapq.heappop(heap)
+                continue
+            if eventtime < waketime:
+                break
+            if seq >= start_seq:
+                deferred.append(heapq.heappop(heap))
+                continue
+            heapq.heappop(heap)
+            if _trace.enabled:
+                _trace.log("timer %s eventtime=%.6f waketime=%.6f",
+                           t.callback.__name__, eventtime, waketime)
+            t.waketime = self.NEVER
+            waketime = t.callback(eventtime)
+            if t.heap_seq is not None:
+                self._schedule_timer(t, waketime)
+            if g_dispatch is not self._g_dispatch:
+                self._restore_timers(deferred)
+                self._next_timer = min(self._next_timer, waketime)
+                self._end_greenlet(g_dispatch)
+                return 0.
+            # The heap may have been compacted during the callback
+            heap = self._timer_heap
+        self._restore_timers(deferred)
+        heap = self._timer_heap
+        self._next_timer = heap[0][0] if heap else self.NEVER
         if eventtime >= self._next_timer:
-            logging.info("================ _check_timers()-[SelectReactor] END 00================")
             return 0.
-        logging.info("================= _check_timers()-[SelectReactor] END =================")
         return min(1., max(.001, self._next_timer - self.monotonic()))
     # Callbacks and Completions
     def completion(self):
         return ReactorCompletion(self)
     def register_callback(self, callback, waketime=NOW):
-        logging.info("============== register_callback()-[SelectReactor] START ==============")
         rcb = ReactorCallback(self, callback, waketime)
-        logging.info("=============== register_callback()-[SelectReactor] END ===============")
         return rcb.completion
     # Asynchronous (from another thread) callbacks and completions
-    def register_async_callback(self, callback, waketime=NOW):      
+    def register_async_callback(self, callback, waketime=NOW):
         self._async_queue.put_nowait(
             (ReactorCallback, (self, callback, waketime)))
         try:
@@ -241,16 +234,10 @@ class SelectReactor:
                 break
             func(*args)
     def _setup_async_callbacks(self):
-        logging.info("========== _setup_async_callbacks()-[SelectReactor] START ============")
         self._pipe_fds = os.pipe()
-        logging.info("self._pipe_fds: ")
-        logging.info(self._pipe_fds)
-        
         util.set_nonblock(self._pipe_fds[0])
         util.set_nonblock(self._pipe_fds[1])
         self.register_fd(self._pipe_fds[0], self._got_pipe_signal)
-        logging.info("============ _setup_async_callbacks()-[SelectReactor] END =============")
-        logging.info("  ")
     def __del__(self):
         if self._pipe_fds is not None:
             os.close(self._pipe_fds[0])
@@ -264,38 +251,25 @@ class SelectReactor:
             time.sleep(delay)
         return self.monotonic()
     def pause(self, waketime):
-        logging.info("  ")
-        logging.info("====================== reactor.pause()-[SelectReactor] START ======================")
         g = greenlet.getcurrent()
-        logging.info("g :") 
-        logging.info(g) 
-        logging.info("self._g_dispatch :") 
-        logging.info(self._g_dispatch) 
-        
         if g is not self._g_dispatch:
-            logging.info("================ (g is not self._g_dispatch) is true ============== ") 
             if self._g_dispatch is None:
-                logging.info("======================= reactor.pause()-[SelectReactor] END 00 =======================")
                 return self._sys_pause(waketime)
             # Switch to _check_timers (via g.timer.callback return)
-            logging.info("  ")
-            logging.info("self._g_dispatch.switch will call :"+str(self._g_dispatch))
-            logging.info("======================= reactor.pause()-[SelectReactor] END 11 =======================")
             return self._g_dispatch.switch(waketime)
         # Pausing the dispatch greenlet - prepare a new greenlet to do dispatch
         if self._greenlets:
-            logging.info("================ self._greenlets is true ============== 00") 
             g_next = self._greenlets.pop()
         else:
-            logging.info("================ self._greenlets is false ============== 11") 
             g_next = ReactorGreenlet(run=self._dispatch_loop)
+        if _trace.enabled:
+            _trace.log("pause dispatch greenlet until %.6f (%d cached)",
+                       waketime, len(self._greenlets))
         g_next.parent = g.parent
         g.timer = self.register_timer(g.switch, waketime)
         self._next_timer = self.NOW
-        logging.info("=========================== call switch():self._dispatch_loop =============================")
         # Switch to _dispatch_loop (via _end_greenlet or direct)
         eventtime = g_next.switch()
-        logging.info("======================= reactor.pause()-[SelectReactor] END =======================")
         # This greenlet activated from g.timer.callback (via _check_timers)
         return eventtime
     def _end_greenlet(self, g_old):
@@ -319,7 +293,6 @@ class SelectReactor:
         self._fds.pop(self._fds.index(file_handler))
     # Main loop
     def _dispatch_loop(self):
-        logging.info("================ _dispatch_loop()-[SelectReactor] START =================")
         self._g_dispatch = g_dispatch = greenlet.getcurrent()
         eventtime = self.monotonic()
         while self._process:
@@ -333,30 +306,20 @@ class SelectReactor:
                     eventtime = self.monotonic()
                     break
         self._g_dispatch = None
-        logging.info("================ _dispatch_loop()-[SelectReactor] END =================")
     def run(self):
-        logging.info("================ reactor.run()-[SelectReactor] START =================")
         if self._pipe_fds is None:
             self._setup_async_callbacks()
         self._process = True
         g_next = ReactorGreenlet(run=self._dispatch_loop)
-        logging.info("ReactorGreenlet(run=self._dispatch_loop), g_next.run: ")
-        logging.info(g_next.run)
-        logging.info("========================= call switch() ============================")
-        logging.info("")
         g_next.switch()
-        
-        logging.info("================= reactor.run()-[SelectReactor] END ==================")
     def end(self):
         self._process = False
 
 class PollReactor(SelectReactor):
     def __init__(self):
-        logging.info("================= reactor.PollReactor.__init__ =================")
         SelectReactor.__init__(self)
         self._poll = select.poll()
         self._fds = {}
-        logging.info("=============== reactor.PollReactor.__init__ END ===============")
     # File descriptors
     def register_fd(self, fd, callback):
         file_handler = ReactorFileHandler(fd, callback)
@@ -372,33 +335,20 @@ class PollReactor(SelectReactor):
         self._fds = fds
     # Main loop
     def _dispatch_loop(self):
-        logging.info("============== reactor.PollReactor._dispatch_loop START ===============")
         self._g_dispatch = g_dispatch = greenlet.getcurrent()
         eventtime = self.monotonic()
-        #logging.info("eventtime:", eventtime)
-        conut = 0
         while self._process:
-            conut = conut+1
-            logging.info("  ")
-            logging.info("********************** PollReactor._dispatch_loop loop conut is :"+str(conut)+" **************************")
             timeout = self._check_timers(eventtime)
             res = self._poll.poll(int(math.ceil(timeout * 1000.)))
-            logging.info(" In reactor.PollReactor._dispatch_loop loop.............")
             eventtime = self.monotonic()
-            logging.info("eventtime is :")
-            logging.info(eventtime)
-
             for fd, event in res:
                 self._fds[fd](eventtime)
                 if g_dispatch is not self._g_dispatch:
-                    logging.info("=============_end_greenlet?============")
-                    logging.info(g_dispatch)
-                    logging.info(g_dispatch.__name__)
                     self._end_greenlet(g_dispatch)
                     eventtime = self.monotonic()
                     break
         self._g_dispatch = None
-        logging.info("====================== reactor.PollReactor._dispatch_loop END ======================")
+
 class EPollReactor(SelectReactor):
     def __init__(self):
         SelectReactor.__init__(self)
@@ -419,7 +369,6 @@ class EPollReactor(SelectReactor):
         self._fds = fds
     # Main loop
     def _dispatch_loop(self):
-        logging.info("================ _dispatch_loop()-[EPollReactor] START =================")
         self._g_dispatch = g_dispatch = greenlet.getcurrent()
         eventtime = self.monotonic()
         while self._process:
@@ -433,12 +382,10 @@ class EPollReactor(SelectReactor):
                     eventtime = self.monotonic()
                     break
         self._g_dispatch = None
-        logging.info("================= _dispatch_loop()-[EPollReactor] END ==================")
+
 # Use the poll based reactor if it is available
 try:
     select.poll
-    logging.info("----------------this is PollReactor-----------------")
     Reactor = PollReactor
 except:
-    logging.info("----------------this is SelectReactor-----------------")
     Reactor = SelectReactor
@@ -3,23 +3,27 @@
 # Copyright (C) 2016-2019  Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, threading, time
+import sys, os, logging, threading, time, hashlib, marshal
 import serial
 
-import msgproto, chelper, util
+import msgproto, chelper, util, tracelog
+
+_trace = tracelog.get_tracer('serial')
 
 class error(Exception):
     pass
 
 class SerialReader:
     BITS_PER_BYTE = 10.
-    def __init__(self, reactor, serialport, baud):
+    def __init__(self, reactor, serialport, baud, cache_path=None):
         self.reactor = reactor
         self.serialport = serialport
         self.baud = baud
+        self.cache_path = cache_path
         # Serial port
         self.ser = None
         self.msgparser = msgproto.MessageParser()
+        self.identify_time = 0.
         # C interface
         self.ffi_main, self.ffi_lib = chelper.get_ffi()
         self.serialqueue = None
@@ -49,40 +53,85 @@ class SerialReader:
                     hdl(params)
             except:
                 logging.exception("Exception in serial callback")
-    def _get_identify_data(self, timeout):
-        # Query the "data dictionary" from the micro-controller
-        identify_data = ""
-        count = 0
+    def _get_identify_chunk(self, offset, timeout):
+        # Request as much of the data dictionary as fits in a response
+        out = []
+        msgproto.PT_uint32().encode(out, offset)
+        count = msgproto.MESSAGE_PAYLOAD_MAX - len(out) - 2
+        msg = "identify offset=%d count=%d" % (offset, count)
         while 1:
-            count = count +1
-            logging.info("+++++++++++++++++++++++++++++++++++ _get_identify_data loop start +++++++++++++++++++++++++++++++++++")
-            logging.info("_get_identify_data loop count is :"+str(count))
-            msg = "identify offset=%d count=%d" % (len(identify_data), 40)
             params = self.send_with_response(msg, 'identify_response')
-            logging.info("params is: ")
-            logging.info(params)
-            if params['offset'] == len(identify_data):
-                logging.info("+++++++++++++++++++++++++++++++++++ get params +++++++++++++++++++++++++++++++++++")
+            if params['offset'] == offset:
                 msgdata = params['data']
-                logging.info("params['data'] is: ")
-                logging.info(msgdata)
-                if not msgdata:
-                    # Done
-                    logging.info("+++++++++++++++++++++++++++++++++++ _get_identify_data loop end +++++++++++++++++++++++++++++++++++")
-                    return identify_data
-                identify_data += msgdata
+                if _trace.enabled:
+                    _trace.log("identify offset=%d got %d bytes",
+                               offset, len(msgdata))
+                return msgdata
             if self.reactor.monotonic() > timeout:
-                logging.info("----------------------------- self.reactor.monotonic() > timeout: --------------------------------------")
                 raise error("Timeout during identify")
-                logging.info("----------------------------- self.reactor.monotonic() > timeout: .error back--------------------------------------")
+    def _get_cache_fname(self, first_chunk):
+        if self.cache_path is None or not first_chunk:
+            return None
+        key = hashlib.sha1("%s\0%s" % (sys.version, first_chunk)).hexdigest()
+        return os.path.join(self.cache_path, key + ".dict")
+    def _load_cached_identify(self, fname, first_chunk, timeout):
+        # Load a data dictionary with the same start from the cache and
+        # verify that its end matches the dictionary of the mcu (the
+        # end of the compressed data contains a checksum of the content)
+        try:
+            f = open(fname, 'rb')
+            try:
+                identify_data, raw_data, parsed = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, ValueError, TypeError) as e:
+            return None
+        size = len(identify_data)
+        if not identify_data.startswith(first_chunk):
+            return None
+        offset = max(0, size - 16)
+        last_chunk = self._get_identify_chunk(offset, timeout)
+        if (identify_data[offset:offset+len(last_chunk)] != last_chunk
+            or offset + len(last_chunk) != size
+            or self._get_identify_chunk(size, timeout)):
+            logging.info("Cached data dictionary %s does not match", fname)
+            return None
+        logging.info("Loaded data dictionary from %s", fname)
+        return identify_data, raw_data, parsed
+    def _save_cached_identify(self, fname, identify_data, raw_data, parsed):
+        # Store the compressed data (used to verify the dictionary) along
+        # with the uncompressed and parsed forms
+        tmpname = "%s.%d.tmp" % (fname, os.getpid())
+        try:
+            f = open(tmpname, 'wb')
+            try:
+                marshal.dump((identify_data, raw_data, parsed), f)
+            finally:
+                f.close()
+            os.rename(tmpname, fname)
+        except (IOError, os.error, ValueError) as e:
+            logging.warning("Unable to write data dictionary cache '%s': %s",
+                            fname, str(e))
+    def _get_identify_data(self, timeout):
+        # Query the "data dictionary" from the micro-controller
+        identify_data = self._get_identify_chunk(0, timeout)
+        fname = self._get_cache_fname(identify_data)
+        if fname is not None:
+            cached = self._load_cached_identify(fname, identify_data, timeout)
+            if cached is not None:
+                identify_data, raw_data, parsed = cached
+                return identify_data, (raw_data, parsed), None
+        msgdata = identify_data
+        while msgdata:
+            msgdata = self._get_identify_chunk(len(identify_data), timeout)
+            identify_data += msgdata
+        return identify_data, None, fname
     def connect(self):
         # Initial connection
-        logging.info("  ")
-        logging.info("===================== connect()-[SerialReader] START ======================")
+        logging.info("Starting serial connect")
         start_time = self.reactor.monotonic()
         while 1:
             connect_time = self.reactor.monotonic()
-            
             if connect_time > start_time + 150.:
                 raise error("Unable to connect")
             try:
@@ -95,36 +144,39 @@ class SerialReader:
                 logging.warn("Unable to open port: %s", e)
                 self.reactor.pause(connect_time + 5.)
                 continue
-            logging.info("================this is serialhdl.connect==============00 ") 
+            _trace.log("opened %s (baud=%d)", self.serialport, self.baud)
             if self.baud:
-                logging.info("================this is serialhdl.connect==============11 ")
-                stk500v2_leave(self.ser, self.reactor)            
-            logging.info("================this is serialhdl.connect==============22 ")
+                stk500v2_leave(self.ser, self.reactor)
             self.serialqueue = self.ffi_lib.serialqueue_alloc(
                 self.ser.fileno(), 0)
-            logging.info("================this is serialhdl.connect==============33 ")
             self.background_thread = threading.Thread(target=self._bg_thread)
-            logging.info("================this is serialhdl.connect==============44 ")
             self.background_thread.start()
-            logging.info("================this is serialhdl.connect==============55 ")
-            logging.info("")
             # Obtain and load the data dictionary from the firmware
+            identify_time = self.reactor.monotonic()
             try:
-                identify_data = self._get_identify_data(connect_time + 5.)
+                identify_data, cached, cache_fname = self._get_identify_data(
+                    connect_time + 5.)
             except error as e:
                 logging.exception("Timeout on serial connect")
                 self.disconnect()
                 continue
+            self.identify_time = self.reactor.monotonic() - identify_time
             break
-        logging.info("   ")
-        logging.info("================================ Message Parser START ==================================")
+        _trace.log("identify complete (%d bytes)", len(identify_data))
         msgparser = msgproto.MessageParser()
-        msgparser.process_identify(identify_data)
+        if cached is not None:
+            raw_data, parsed = cached
+            msgparser.process_identify(raw_data, decompress=False,
+                                       parsed=parsed)
+        else:
+            parsed = msgparser.process_identify(identify_data)
+            if cache_fname is not None:
+                self._save_cached_identify(cache_fname, identify_data,
+                                           msgparser.raw_identify_data, parsed)
         self.msgparser = msgparser
         self.register_response(self.handle_unknown, '#unknown')
         # Setup baud adjust
         mcu_baud = msgparser.get_constant_float('SERIAL_BAUD', None)
-        
         if mcu_baud is not None:
             baud_adjust = self.BITS_PER_BYTE / mcu_baud
             self.ffi_lib.serialqueue_set_baud_adjust(
@@ -133,8 +185,6 @@ class SerialReader:
         if receive_window is not None:
             self.ffi_lib.serialqueue_set_receive_window(
                 self.serialqueue, receive_window)
-        logging.info("===================== connect()-[SerialReader] END ======================")
-        logging.info("  ")
     def connect_file(self, debugoutput, dictionary, pace=False):
         self.ser = debugoutput
         self.msgparser.process_identify(dictionary, decompress=False)
@@ -173,6 +223,22 @@ class SerialReader:
     def raw_send(self, cmd, minclock, reqclock, cmd_queue):
         self.ffi_lib.serialqueue_send(
             self.serialqueue, cmd_queue, cmd, len(cmd), minclock, reqclock)
+    def encode_and_send(self, data, count, minclock, reqclock, cmd_queue):
+        # 'data' is a uint32_t array holding the message id and the
+        # (integer) parameters of a command
+        self.ffi_lib.serialqueue_encode_and_send(
+            self.serialqueue, cmd_queue, data, count, minclock, reqclock)
+    def send_multi(self, data, lens, minclock=0, reqclock=0, cmd_queue=None):
+        # Queue several encoded commands (stored back to back in 'data')
+        # with a single call so that they are packed into full message
+        # blocks
+        if not lens:
+            return
+        if cmd_queue is None:
+            cmd_queue = self.default_cmd_queue
+        self.ffi_lib.serialqueue_send_multi(
+            self.serialqueue, cmd_queue, data, lens, len(lens),
+            minclock, reqclock)
     def send(self, msg, minclock=0, reqclock=0):
         cmd = self.msgparser.create_command(msg)
         self.raw_send(cmd, minclock, reqclock, self.default_cmd_queue)
@@ -238,52 +304,38 @@ class SerialRetryCommand:
             self.serial.reactor.async_complete(self.completion, params)
     def get_response(self, cmds, cmd_queue, minclock=0, minsystime=0.):
         first_query_time = query_time = max(self.min_query_time, minsystime)
-        count = 0
-        while 1:           
-            logging.info("===================== this loop is get_response()-[SerialRetryCommand] START =======================")
-            count = count +1
-            logging.info("get_response() loop count is: "+str(count))
+        while 1:
             for cmd in cmds:
-                logging.info("cmd is: "+str(cmd))
                 self.serial.raw_send(cmd, minclock, minclock, cmd_queue)
-            logging.info("send cmd over ..........................")          
             params = self.completion.wait(query_time + self.RETRY_TIME)
-            logging.info("*********&&&&&&&&&&&&&&&&")
-            time1 = time.time()
-            logging.info("The current time: %s ",
-                     time.asctime(time.localtime(time1)))
             if params is not None:
                 self.serial.register_response(None, self.name, self.oid)
-                logging.info("===================== this loop is get_response()-[SerialRetryCommand] END 00=======================")
                 return params
-            
             query_time = self.serial.reactor.monotonic()
+            if _trace.enabled:
+                _trace.log("retry query for '%s' response", self.name)
             if query_time > first_query_time + self.TIMEOUT_TIME:
                 self.serial.register_response(None, self.name, self.oid)
                 raise error("Timeout on wait for '%s' response" % (self.name,))
-        logging.info("===================== this loop is get_response()-[SerialRetryCommand] END =======================")
+
 # Attempt to place an AVR stk500v2 style programmer into normal mode
 def stk500v2_leave(ser, reactor):
-    logging.info("======================= stk500v2_leave()- START ========================")
     logging.debug("Starting stk500v2 leave programmer sequence")
     util.clear_hupcl(ser.fileno())
-    
     origbaud = ser.baudrate
     # Request a dummy speed first as this seems to help reset the port
     ser.baudrate = 2400
     ser.read(1)
-    
     # Send stk500v2 leave programmer sequence
     ser.baudrate = 115200
     reactor.pause(reactor.monotonic() + 0.100)
     ser.read(4096)
     ser.write('\x1b\x01\x00\x01\x0e\x11\x04')
     reactor.pause(reactor.monotonic() + 0.050)
-    logging.info("fan hui stk500v2_leave ==============================>>>>>>>>>>>>>>>")
     res = ser.read(4096)
     logging.debug("Got %s from stk500v2", repr(res))
     ser.baudrate = origbaud
-    logging.info("======================== stk500v2_leave() END =========================")
+
 # Attempt an arduino style reset on a serial port
 def arduino_reset(serialport, reactor):
     # First try opening the port at a different baud
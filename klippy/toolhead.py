@@ -10,9 +10,20 @@ import mcu, homing, chelper, kinematics.extruder
 #   mm/second), _v2 is velocity squared (mm^2/s^2), _t is time (in
 #   seconds), _r is ratio (scalar between 0.0 and 1.0)
 
-# Class to track each move request
-class Move:
+# Class to track each move request.  Move objects are recycled via
+# the MovePool, so all state must be (re)initialized in setup().
+class Move(object):
+    __slots__ = (
+        'toolhead', 'start_pos', 'end_pos', 'accel', 'cmove',
+        'is_kinematic_move', 'axes_d', 'move_d', 'min_move_t',
+        'max_start_v2', 'max_cruise_v2', 'delta_v2',
+        'max_smoothed_v2', 'smooth_delta_v2',
+        'accel_r', 'decel_r', 'cruise_r', 'start_v', 'cruise_v', 'end_v',
+        'accel_t', 'cruise_t', 'decel_t',
+        'extrude_r', 'extrude_max_corner_v')
     def __init__(self, toolhead, start_pos, end_pos, speed):
+        self.setup(toolhead, start_pos, end_pos, speed)
+    def setup(self, toolhead, start_pos, end_pos, speed):
         self.toolhead = toolhead
         self.start_pos = tuple(start_pos)
         self.end_pos = tuple(end_pos)
@@ -20,7 +31,9 @@ class Move:
         velocity = min(speed, toolhead.max_velocity)
         self.cmove = toolhead.cmove
         self.is_kinematic_move = True
-        self.axes_d = axes_d = [end_pos[i] - start_pos[i] for i in (0, 1, 2, 3)]
+        self.axes_d = axes_d = [
+            end_pos[0] - start_pos[0], end_pos[1] - start_pos[1],
+            end_pos[2] - start_pos[2], end_pos[3] - start_pos[3]]
         self.move_d = move_d = math.sqrt(sum([d*d for d in axes_d[:3]]))
         if move_d < .000000001:
             # Extrude only move
@@ -109,17 +122,47 @@ class Move:
         self.toolhead.update_move_time(
             self.accel_t + self.cruise_t + self.decel_t)
 
+MOVE_POOL_SIZE = 4096
+
+# Free list of Move objects.  Moves are returned to the pool once they
+# have been removed from the MoveQueue, which avoids allocator and
+# garbage collector churn at high move rates.
+class MovePool:
+    def __init__(self, toolhead):
+        self.toolhead = toolhead
+        self.free_moves = []
+        self.alloc_count = self.reuse_count = 0
+    def get_move(self, start_pos, end_pos, speed):
+        free_moves = self.free_moves
+        if free_moves:
+            self.reuse_count += 1
+            move = free_moves.pop()
+            move.setup(self.toolhead, start_pos, end_pos, speed)
+            return move
+        self.alloc_count += 1
+        return Move(self.toolhead, start_pos, end_pos, speed)
+    def release(self, move):
+        if len(self.free_moves) < MOVE_POOL_SIZE:
+            self.free_moves.append(move)
+    def release_moves(self, moves):
+        free_moves = self.free_moves
+        free_moves.extend(moves)
+        del free_moves[MOVE_POOL_SIZE:]
+
 LOOKAHEAD_FLUSH_TIME = 0.250
 
 # Class to track a list of pending move requests and to facilitate
 # "look-ahead" across moves to reduce acceleration between moves.
 class MoveQueue:
-    def __init__(self):
+    def __init__(self, move_pool, step_batch):
+        self.move_pool = move_pool
+        self.step_batch = step_batch
         self.extruder_lookahead = None
         self.queue = []
         self.leftover = 0
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
     def reset(self):
+        self.move_pool.release_moves(self.queue)
         del self.queue[:]
         self.leftover = 0
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
@@ -129,6 +172,30 @@ class MoveQueue:
         self.extruder_lookahead = extruder.lookahead
     def flush(self, lazy=False):
         self.junction_flush = LOOKAHEAD_FLUSH_TIME
+        flush_count = self._calc_junctions(lazy)
+        if flush_count is None:
+            return
+        queue = self.queue
+        # Allow extruder to do its lookahead
+        move_count = self.extruder_lookahead(queue, flush_count, lazy)
+        # Generate step times for all moves ready to be flushed
+        step_batch = self.step_batch
+        step_batch.begin()
+        try:
+            for move in queue[:move_count]:
+                move.move()
+        except:
+            step_batch.finish(report_errors=False)
+            raise
+        step_batch.finish()
+        # Remove processed moves from the queue
+        self.leftover = flush_count - move_count
+        self._remove_moves(move_count)
+    def _remove_moves(self, count):
+        queue = self.queue
+        self.move_pool.release_moves(queue[:count])
+        del queue[:count]
+    def _calc_junctions(self, lazy):
         update_flush_count = lazy
         queue = self.queue
         flush_count = len(queue)
@@ -174,15 +241,8 @@ class MoveQueue:
             next_end_v2 = start_v2
             next_smoothed_v2 = smoothed_v2
         if update_flush_count:
-            return
-        # Allow extruder to do its lookahead
-        move_count = self.extruder_lookahead(queue, flush_count, lazy)
-        # Generate step times for all moves ready to be flushed
-        for move in queue[:move_count]:
-            move.move()
-        # Remove processed moves from the queue
-        self.leftover = flush_count - move_count
-        del queue[:move_count]
+            return None
+        return flush_count
     def add_move(self, move):
         self.queue.append(move)
         if len(self.queue) == 1:
@@ -193,6 +253,62 @@ class MoveQueue:
             # Enough moves have been queued to reach the target flush time.
             self.flush(lazy=True)
 
+# Move queue that performs the lookahead junction calculations in the
+# C helper code.  The results are identical to the python MoveQueue.
+class CMoveQueue(MoveQueue):
+    def __init__(self, move_pool, step_batch):
+        MoveQueue.__init__(self, move_pool, step_batch)
+        self.ffi_main, ffi_lib = chelper.get_ffi()
+        self.lookahead = self.ffi_main.gc(ffi_lib.lookahead_alloc(),
+                                          ffi_lib.lookahead_free)
+        self.lookahead_add = ffi_lib.lookahead_add
+        self.lookahead_flush = ffi_lib.lookahead_flush
+        self.lookahead_remove = ffi_lib.lookahead_remove
+        self.lookahead_reset = ffi_lib.lookahead_reset
+        self.junctions_size = 1024
+        self.junctions = self.ffi_main.new('double[]', 3 * self.junctions_size)
+    def reset(self):
+        MoveQueue.reset(self)
+        self.lookahead_reset(self.lookahead)
+    def _remove_moves(self, count):
+        MoveQueue._remove_moves(self, count)
+        self.lookahead_remove(self.lookahead, count)
+    def _calc_junctions(self, lazy):
+        queue = self.queue
+        if len(queue) > self.junctions_size:
+            self.junctions_size = max(len(queue), 2 * self.junctions_size)
+            self.junctions = self.ffi_main.new(
+                'double[]', 3 * self.junctions_size)
+        leftover = self.leftover
+        flush_count = self.lookahead_flush(
+            self.lookahead, leftover, lazy, self.junctions)
+        if flush_count < 0:
+            return None
+        junctions = self.ffi_main.unpack(self.junctions + 3 * leftover,
+                                         3 * (flush_count - leftover))
+        for i, move in enumerate(queue[leftover:flush_count]):
+            cruise_v2 = junctions[3*i + 1]
+            if cruise_v2 >= 0.:
+                move.set_junction(junctions[3*i], cruise_v2,
+                                  junctions[3*i + 2])
+        return flush_count
+    def add_move(self, move):
+        queue = self.queue
+        queue.append(move)
+        if len(queue) > 1:
+            move.calc_junction(queue[-2])
+        self.lookahead_add(self.lookahead, move.max_start_v2, move.delta_v2,
+                           move.max_smoothed_v2, move.smooth_delta_v2,
+                           move.max_cruise_v2)
+        if len(queue) == 1:
+            return
+        self.junction_flush -= move.min_move_t
+        if self.junction_flush <= 0.:
+            # Enough moves have been queued to reach the target flush time.
+            self.flush(lazy=True)
+
+LOOKAHEAD_ENGINES = {'python': MoveQueue, 'c': CMoveQueue}
+
 STALL_TIME = 0.100
 
 DRIP_SEGMENT_TIME = 0.050
@@ -208,7 +324,11 @@ class ToolHead:
         self.all_mcus = [
             m for n, m in self.printer.lookup_objects(module='mcu')]
         self.mcu = self.all_mcus[0]
-        self.move_queue = MoveQueue()
+        move_queue_class = config.getchoice(
+            'lookahead_engine', LOOKAHEAD_ENGINES, 'python')
+        self.move_pool = MovePool(self)
+        self.step_batch = self.printer.lookup_object('step_batch')
+        self.move_queue = move_queue_class(self.move_pool, self.step_batch)
         self.commanded_pos = [0., 0., 0., 0.]
         self.printer.register_event_handler("gcode:request_restart",
                                             self._handle_request_restart)
@@ -236,6 +356,8 @@ class ToolHead:
             'buffer_time_start', 0.250, above=0.)
         self.move_flush_time = config.getfloat(
             'move_flush_time', 0.050, above=0.)
+        self.step_batch.set_threads(config.getint(
+            'step_generation_threads', 0, minval=0))
         self.print_time = 0.
         self.special_queuing_state = "Flushed"
         self.need_check_stall = -1.
@@ -245,10 +367,12 @@ class ToolHead:
         self.idle_flush_print_time = 0.
         self.print_stall = 0
         self.drip_completion = None
+        self.last_stats_time = 0.
+        self.last_stats_alloc = self.last_stats_reuse = 0
         # Setup iterative solver
         ffi_main, ffi_lib = chelper.get_ffi()
         self.cmove = ffi_main.gc(ffi_lib.move_alloc(), ffi_lib.free)
-        self.move_fill = ffi_lib.move_fill
+        self.move_fill = self.step_batch.move_fill
         # Create kinematics class
         self.extruder = kinematics.extruder.DummyExtruder()
         self.move_queue.set_extruder(self.extruder)
@@ -301,6 +425,8 @@ class ToolHead:
                 wait_time = self.print_time - est_print_time - DRIP_TIME
                 if wait_time <= 0. or self.mcu.is_fileoutput():
                     return self.print_time
+                # Send any batched steps before waiting
+                self.step_batch.run()
                 self.drip_completion.wait(curtime + wait_time)
         # Transition from "Flushed"/"Priming" state to main state
         self.special_queuing_state = ""
@@ -378,13 +504,18 @@ class ToolHead:
         self.commanded_pos[:] = newpos
         self.kin.set_position(newpos, homing_axes)
     def move(self, newpos, speed):
-        move = Move(self, self.commanded_pos, newpos, speed)
+        move = self.move_pool.get_move(self.commanded_pos, newpos, speed)
         if not move.move_d:
+            self.move_pool.release(move)
             return
-        if move.is_kinematic_move:
-            self.kin.check_move(move)
-        if move.axes_d[3]:
-            self.extruder.check_move(move)
+        try:
+            if move.is_kinematic_move:
+                self.kin.check_move(move)
+            if move.axes_d[3]:
+                self.extruder.check_move(move)
+        except:
+            self.move_pool.release(move)
+            raise
         self.commanded_pos[:] = move.end_pos
         self.move_queue.add_move(move)
         if self.print_time > self.need_check_stall:
@@ -421,14 +552,20 @@ class ToolHead:
         return self.extruder
     def drip_move(self, newpos, speed):
         # Validate move
-        move = Move(self, self.commanded_pos, newpos, speed)
+        move = self.move_pool.get_move(self.commanded_pos, newpos, speed)
         if move.axes_d[3]:
             raise homing.CommandError("Invalid drip move")
         if not move.move_d or not move.is_kinematic_move:
+            self.move_pool.release(move)
             return
         self.kin.check_move(move)
         speed = math.sqrt(move.max_cruise_v2)
         move_accel = move.accel
+        min_move_t = move.min_move_t
+        axes_d = move.axes_d
+        start_pos = move.start_pos
+        end_pos = move.end_pos
+        self.move_pool.release(move)
         # Transition to "Flushed" state and then to "Drip" state
         self._full_flush()
         self.special_queuing_state = "Drip"
@@ -436,19 +573,20 @@ class ToolHead:
         self.reactor.update_timer(self.flush_timer, self.reactor.NEVER)
         self.drip_completion = self.reactor.completion()
         # Split move into many tiny moves and queue them
-        num_moves = max(1, int(math.ceil(move.min_move_t / DRIP_SEGMENT_TIME)))
+        num_moves = max(1, int(math.ceil(min_move_t / DRIP_SEGMENT_TIME)))
         inv_num_moves = 1. / float(num_moves)
-        submove_d = [d * inv_num_moves for d in move.axes_d]
-        prev_pos = move.start_pos
+        submove_d = [d * inv_num_moves for d in axes_d]
+        prev_pos = start_pos
         self._calc_print_time()
+        get_move = self.move_pool.get_move
         try:
             for i in range(num_moves-1):
                 next_pos = [p + d for p, d in zip(prev_pos, submove_d)]
-                smove = Move(self, prev_pos, next_pos, speed)
+                smove = get_move(prev_pos, next_pos, speed)
                 smove.limit_speed(speed, move_accel)
                 self.move_queue.add_move(smove)
                 prev_pos = next_pos
-            smove = Move(self, prev_pos, move.end_pos, speed)
+            smove = get_move(prev_pos, end_pos, speed)
             smove.limit_speed(speed, move_accel)
             self.move_queue.add_move(smove)
             self.move_queue.flush()
@@ -464,8 +602,20 @@ class ToolHead:
             m.check_active(self.print_time, eventtime)
         buffer_time = self.print_time - self.mcu.estimated_print_time(eventtime)
         is_active = buffer_time > -60. or not self.special_queuing_state
-        return is_active, "print_time=%.3f buffer_time=%.3f print_stall=%d" % (
-            self.print_time, max(buffer_time, 0.), self.print_stall)
+        # Report Move object allocations (and pool reuses) per second
+        alloc_count = self.move_pool.alloc_count
+        reuse_count = self.move_pool.reuse_count
+        inv_elapsed = 1. / max(eventtime - self.last_stats_time, .001)
+        alloc_rate = (alloc_count - self.last_stats_alloc) * inv_elapsed
+        reuse_rate = (reuse_count - self.last_stats_reuse) * inv_elapsed
+        self.last_stats_time = eventtime
+        self.last_stats_alloc = alloc_count
+        self.last_stats_reuse = reuse_count
+        return is_active, (
+            "print_time=%.3f buffer_time=%.3f print_stall=%d"
+            " move_alloc=%.0f move_reuse=%.0f" % (
+                self.print_time, max(buffer_time, 0.), self.print_stall,
+                alloc_rate, reuse_rate))
     def check_busy(self, eventtime):
         est_print_time = self.mcu.estimated_print_time(eventtime)
         lookahead_empty = not self.move_queue.queue
@@ -0,0 +1,53 @@
+# Named trace categories for optional host debug logging
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import logging
+
+CATEGORIES = ['reactor', 'serial', 'mcu', 'config']
+
+class error(Exception):
+    pass
+
+# Per-category trace logger.  Trace points in hot code paths must be
+# guarded with "if tracer.enabled:" so that a disabled category costs
+# only an attribute lookup (no argument building or string formatting).
+class Tracer:
+    def __init__(self, name):
+        self.name = name
+        self.enabled = False
+        self.prefix = "trace %s: " % (name,)
+    def log(self, msg, *args):
+        if self.enabled:
+            logging.info(self.prefix + msg, *args)
+
+_tracers = { name: Tracer(name) for name in CATEGORIES }
+
+def get_tracer(name):
+    return _tracers[name]
+
+def parse_categories(names):
+    if not names:
+        return []
+    out = []
+    for name in names.split(','):
+        name = name.strip().lower()
+        if name == 'all':
+            out.extend(CATEGORIES)
+        elif name in _tracers:
+            out.append(name)
+        elif name:
+            raise error("Unknown trace category '%s' (valid: %s)" % (
+                name, ", ".join(['all'] + CATEGORIES)))
+    return out
+
+def set_enabled(names, enable=True):
+    for name in names:
+        _tracers[name].enabled = enable
+
+def set_categories(names):
+    enabled = set(names)
+    for name, tracer in _tracers.items():
+        tracer.enabled = name in enabled
+
+def get_enabled():
+    return [name for name in CATEGORIES if _tracers[name].enabled]
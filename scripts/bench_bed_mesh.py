@@ -0,0 +1,137 @@
+#!/usr/bin/env python2
+# Benchmark of the bed_mesh move splitting code
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, math, random, re, collections
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy/extras'))
+import bed_mesh
+
+# Minimal config object - just enough to create a MoveSplitter
+class BenchConfig:
+    def __init__(self, options):
+        self.options = options
+    def getfloat(self, option, default, minval=None):
+        return self.options.get(option, default)
+    def getchoice(self, option, choices, default):
+        return choices[self.options.get(option, default)]
+
+def create_mesh(count, pps, seed):
+    params = collections.OrderedDict([
+        ('min_x', 10.), ('max_x', 290.), ('min_y', 10.), ('max_y', 290.),
+        ('x_offset', 0.), ('y_offset', 0.), ('x_count', count),
+        ('y_count', count), ('mesh_x_pps', pps), ('mesh_y_pps', pps),
+        ('algo', 'bicubic'), ('tension', .2)])
+    mesh = bed_mesh.ZMesh(params)
+    # A warped bed with some probing noise
+    rnd = random.Random(seed)
+    z_table = []
+    for j in range(count):
+        y = 10. + 280. * j / (count - 1)
+        z_table.append([.15 * math.sin(x / 60.) + .1 * math.cos(y / 45.)
+                        + rnd.uniform(-.02, .02)
+                        for x in [10. + 280. * i / (count - 1)
+                                  for i in range(count)]])
+    mesh.build_mesh(z_table)
+    return mesh
+
+# Generate the XY moves of a print (perimeters made of short segments
+# and long infill lines)
+def generate_moves(layers):
+    moves = []
+    for layer in range(layers):
+        for radius in [100., 99.6, 99.2]:
+            for i in range(360):
+                a = math.radians(i)
+                moves.append((150. + radius * math.cos(a),
+                              150. + radius * math.sin(a)))
+        for i in range(70):
+            y = 80. + 2. * i
+            w = math.sqrt(max(0., 98.**2 - (y - 150.)**2))
+            if i % 2:
+                moves.append((150. - w, y))
+                moves.append((150. + w, y))
+            else:
+                moves.append((150. + w, y))
+                moves.append((150. - w, y))
+    return moves
+
+# Read the XY moves of a g-code file (absolute coordinates only)
+def read_moves(fname):
+    move_r = re.compile(r'^\s*G[01]\s', re.IGNORECASE)
+    axis_r = re.compile(r'([XY])\s*([-+]?[0-9.]+)', re.IGNORECASE)
+    moves = []
+    pos = [0., 0.]
+    f = open(fname, 'rb')
+    for line in f:
+        line = line.split(';')[0]
+        if not move_r.match(line):
+            continue
+        for axis, value in axis_r.findall(line):
+            pos["XY".index(axis.upper())] = float(value)
+        moves.append(tuple(pos))
+    f.close()
+    return moves
+
+# Largest difference between the mesh and the emitted segments
+def max_error(mesh, segments):
+    err = 0.
+    for (x0, y0, z0), (x1, y1, z1) in zip(segments[:-1], segments[1:]):
+        for i in range(1, 8):
+            t = i / 8.
+            x, y = x0 + (x1 - x0) * t, y0 + (y1 - y0) * t
+            z = z0 + (z1 - z0) * t
+            err = max(err, abs(z - mesh.calc_z(x, y)))
+    return err
+
+def run_splitter(mesh, moves, mode, options):
+    splitter = bed_mesh.MoveSplitter(BenchConfig({
+        'split_mode': mode, 'split_delta_z': options.split_delta_z,
+        'move_check_distance': options.move_check_distance}), None)
+    splitter.initialize(mesh)
+    # The moves are at z=0 so the toolhead z is the mesh adjustment
+    x, y = moves[0]
+    out = [(x, y, mesh.calc_z(x, y), 0.)]
+    prev = [x, y, 0., 0.]
+    start = time.time()
+    for x, y in moves[1:]:
+        pos = [x, y, 0., 0.]
+        splitter.build_move(prev, pos, 1.)
+        while not splitter.traverse_complete:
+            out.append(splitter.split())
+        prev = pos
+    elapsed = time.time() - start
+    err = max_error(mesh, [(x, y, z) for x, y, z, e in out])
+    return len(out) - 1, elapsed, err
+
+def main():
+    usage = "%prog [options] [g-code file]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--count", dest="count", type="int", default=7,
+                    help="number of probe points per axis")
+    opts.add_option("-p", "--pps", dest="pps", type="int", default=2,
+                    help="mesh points per segment")
+    opts.add_option("-l", "--layers", dest="layers", type="int", default=20,
+                    help="number of layers of generated moves")
+    opts.add_option("-z", "--split-delta-z", dest="split_delta_z",
+                    type="float", default=.025, help="split_delta_z")
+    opts.add_option("-d", "--move-check-distance", dest="move_check_distance",
+                    type="float", default=5., help="move_check_distance")
+    options, args = opts.parse_args()
+    if len(args) > 1:
+        opts.error("Incorrect number of arguments")
+    if args:
+        moves = read_moves(args[0])
+    else:
+        moves = generate_moves(options.layers)
+    mesh = create_mesh(options.count, options.pps, 0)
+    print "%-9s %8s %9s %8s %12s %10s" % (
+        "mode", "moves", "segments", "time", "us/move", "max error")
+    for mode in ["distance", "cell"]:
+        segments, elapsed, err = run_splitter(mesh, moves, mode, options)
+        print "%-9s %8d %9d %7.3fs %12.2f %10.4f" % (
+            mode, len(moves) - 1, segments, elapsed,
+            elapsed * 1000000. / (len(moves) - 1), err)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python2
+# Benchmark of the host g-code parsing code
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, random
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import gcode, reactor
+
+# Minimal printer object - just enough to create a GCodeParser
+class BenchPrinter:
+    def __init__(self):
+        self.reactor = reactor.SelectReactor()
+    def register_event_handler(self, event, callback):
+        pass
+    def get_reactor(self):
+        return self.reactor
+    def get_start_args(self):
+        return {'debuginput': True}
+
+# Parser that only uses the generic tokenizer (for comparison)
+class GenericGCodeParser(gcode.GCodeParser):
+    def parse_move(self, line):
+        return None
+
+def create_parser(parser_class):
+    gp = parser_class(BenchPrinter(), None)
+    gp.is_printer_ready = True
+    gp.gcode_handlers = gp.ready_gcode_handlers
+    gp.move_with_transform = (lambda newpos, speed: None)
+    gp.toolhead = None
+    return gp
+
+# Generate g-code similar to the output of a slicer
+def generate_gcode(count, seed):
+    rnd = random.Random(seed)
+    out = ["G90", "M82", "G92 E0"]
+    e = z = 0.
+    while len(out) < count:
+        z += .2
+        out.append("G0 F9000 X%.3f Y%.3f Z%.3f" % (
+            rnd.uniform(0., 200.), rnd.uniform(0., 200.), z))
+        out.append(";TYPE:WALL-OUTER")
+        out.append("G1 F1500 E%.5f" % (e,))
+        for i in range(rnd.randrange(200, 2000)):
+            e += rnd.uniform(.01, .5)
+            if not rnd.randrange(20):
+                out.append("G1 F%d X%.3f Y%.3f E%.5f" % (
+                    rnd.choice([1200, 1800, 2400]), rnd.uniform(0., 200.),
+                    rnd.uniform(0., 200.), e))
+            else:
+                out.append("G1 X%.3f Y%.3f E%.5f" % (
+                    rnd.uniform(0., 200.), rnd.uniform(0., 200.), e))
+        out.append("M106 S%d" % (rnd.randrange(256),))
+    return out[:count]
+
+def main():
+    usage = "%prog [options] [g-code file]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-n", "--count", dest="count", type="int",
+                    default=1000000, help="number of lines to generate")
+    opts.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                    help="number of timing runs (best is reported)")
+    options, args = opts.parse_args()
+    if len(args) > 1:
+        opts.error("Incorrect number of arguments")
+    if args:
+        f = open(args[0], 'rb')
+        lines = f.read().split('\n')
+        f.close()
+    else:
+        lines = generate_gcode(options.count, 0)
+    print "%-10s %10s %10s %12s" % ("parser", "lines", "time", "lines/second")
+    for name, parser_class in [("generic", GenericGCodeParser),
+                               ("fast", gcode.GCodeParser)]:
+        best = None
+        for i in range(options.repeat):
+            gp = create_parser(parser_class)
+            start = time.time()
+            gp._process_commands(lines, need_ack=False)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        print "%-10s %10d %9.3fs %12.0f" % (
+            name, len(lines), best, len(lines) / best)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python2
+# Benchmark host move processing by replaying g-code in file output mode
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, subprocess, tempfile, re
+
+KLIPPY = os.path.join(os.path.dirname(__file__), '../klippy/klippy.py')
+DEFAULT_CONFIG = os.path.join(os.path.dirname(__file__),
+                              '../config/example.cfg')
+DEFAULT_GCODE = os.path.join(os.path.dirname(__file__),
+                             '../test/klippy/move.gcode')
+
+def count_moves(gcode):
+    move_re = re.compile(r'^\s*G[0-3](\s|$)', re.IGNORECASE)
+    return len([l for l in gcode.split('\n') if move_re.match(l)])
+
+def run_klippy(config, dictionary, gcode, logname):
+    f = tempfile.NamedTemporaryFile(suffix='.gcode', delete=False)
+    try:
+        f.write(gcode)
+        f.close()
+        args = [sys.executable, KLIPPY, config, '-i', f.name,
+                '-o', os.devnull, '-d', dictionary, '-l', logname]
+        start = time.time()
+        res = subprocess.call(args)
+        elapsed = time.time() - start
+    finally:
+        os.unlink(f.name)
+    if res:
+        sys.stderr.write("klippy failed - see %s\n" % (logname,))
+        sys.exit(-1)
+    return elapsed
+
+def main():
+    usage = "%prog [options] <dictionary>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--config", dest="config", default=DEFAULT_CONFIG,
+                    help="printer config file")
+    opts.add_option("-g", "--gcode", dest="gcode", default=DEFAULT_GCODE,
+                    help="g-code file to replay")
+    opts.add_option("-r", "--repeat", dest="repeat", type="int", default=500,
+                    help="number of times to replay the g-code file")
+    opts.add_option("-l", "--logfile", dest="logfile",
+                    default="/tmp/bench_moves.log", help="klippy log file")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    dictionary = args[0]
+    f = open(options.gcode, 'rb')
+    gcode = f.read()
+    f.close()
+    # Measure klippy startup (and shutdown) time so that it can be
+    # removed from the results
+    startup = run_klippy(options.config, dictionary, "", options.logfile)
+    # Only home once (homing moves would otherwise dominate the
+    # results) and restore the g-code state before each replay
+    home_re = re.compile(r'^\s*G28', re.IGNORECASE | re.MULTILINE)
+    body = home_re.sub(';', gcode)
+    gcode = "G28\nSAVE_GCODE_STATE NAME=bench_moves\n" + (
+        "RESTORE_GCODE_STATE NAME=bench_moves MOVE=1\n" + body
+        + "\n") * options.repeat
+    total = run_klippy(options.config, dictionary, gcode, options.logfile)
+    moves = count_moves(gcode)
+    elapsed = max(total - startup, .000001)
+    print "moves=%d total=%.3fs startup=%.3fs moves/second=%.0f" % (
+        moves, total, startup, moves / elapsed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python2
+# Benchmark of the host message decoding code
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, random
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import msgproto
+
+# Typical mix of messages received from a micro-controller
+DEFAULT_MIX = [
+    ('analog_in_state', 40), ('clock', 20), ('stats', 5),
+    ('endstop_state', 30), ('uptime', 5)]
+
+# Generate message blocks with random parameters
+def generate_stream(mp, count, seed):
+    rnd = random.Random(seed)
+    mix = [(mp.messages_by_name[name], weight)
+           for name, weight in DEFAULT_MIX if name in mp.messages_by_name]
+    if not mix:
+        raise msgproto.error("Dictionary has no known response messages")
+    choices = [mf for mf, weight in mix for i in range(weight)]
+    out = []
+    for i in range(count):
+        mf = rnd.choice(choices)
+        params = []
+        for name, t in mf.param_names:
+            if isinstance(t, msgproto.Enumeration):
+                params.append(rnd.choice(t.enums.keys()))
+            elif t.is_dynamic_string:
+                params.append(bytearray(rnd.randrange(256)
+                                        for j in range(rnd.randrange(8))))
+            else:
+                bits = {2: 8, 3: 16}.get(t.max_length, 32)
+                v = rnd.getrandbits(rnd.randint(1, bits))
+                if t.signed:
+                    v >>= 1
+                    if rnd.randrange(2):
+                        v = -v - 1
+                params.append(v)
+        out.append(mp.encode(i, str(bytearray(mf.encode(params)))))
+    return out
+
+# Split a captured serial stream (eg, from "klippy.py -o") into blocks
+def read_capture(mp, fname, count):
+    f = open(fname, 'rb')
+    data = f.read()
+    f.close()
+    blocks = []
+    while data:
+        l = mp.check_packet(data)
+        if l <= 0:
+            raise msgproto.error("Invalid data in %s" % (fname,))
+        blocks.append(data[:l])
+        data = data[l:]
+    if not blocks:
+        raise msgproto.error("No messages in %s" % (fname,))
+    return [blocks[i % len(blocks)] for i in range(count)]
+
+def decode(mp, blocks, generic):
+    msgs = 0
+    end = -msgproto.MESSAGE_TRAILER_SIZE
+    for block in blocks:
+        s = bytearray(block)
+        l = len(s) + end
+        pos = msgproto.MESSAGE_HEADER_SIZE
+        while pos < l:
+            mid = mp.messages_by_id.get(s[pos], mp.unknown)
+            if generic and isinstance(mid, msgproto.MessageFormat):
+                params, pos = mid.parse_generic(s, pos)
+            else:
+                params, pos = mid.parse(s, pos)
+            params['#name'] = mid.name
+            msgs += 1
+    return msgs
+
+def main():
+    usage = "%prog [options] <dictionary>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--capture", dest="capture",
+                    help="captured serial data to decode")
+    opts.add_option("-n", "--count", dest="count", type="int",
+                    default=1000000, help="number of message blocks")
+    opts.add_option("-r", "--repeat", dest="repeat", type="int", default=3,
+                    help="number of timing runs (best is reported)")
+    options, args = opts.parse_args()
+    if len(args) != 1:
+        opts.error("Incorrect number of arguments")
+    f = open(args[0], 'rb')
+    mp = msgproto.MessageParser()
+    mp.process_identify(f.read(), decompress=False)
+    f.close()
+    if options.capture:
+        blocks = read_capture(mp, options.capture, options.count)
+    else:
+        blocks = generate_stream(mp, options.count, 0)
+    print "%-10s %10s %10s %12s" % (
+        "decoder", "messages", "time", "msgs/second")
+    for name, generic in [("generic", True), ("generated", False)]:
+        best = None
+        for i in range(options.repeat):
+            start = time.time()
+            msgs = decode(mp, blocks, generic)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        print "%-10s %10d %9.3fs %12.0f" % (name, msgs, best, msgs / best)
+
+if __name__ == '__main__':
+    main()
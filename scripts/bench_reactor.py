@@ -0,0 +1,132 @@
+#!/usr/bin/env python2
+# Microbenchmark of the reactor timer dispatch code
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, time, random
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import reactor
+
+# Reactor using the previous linear scan of all timers (for comparison)
+class ListTimerReactor(reactor.SelectReactor):
+    def __init__(self):
+        reactor.SelectReactor.__init__(self)
+        self._timers = []
+    def update_timer(self, timer_handler, waketime):
+        timer_handler.waketime = waketime
+        self._next_timer = min(self._next_timer, waketime)
+    def register_timer(self, callback, waketime=reactor._NEVER):
+        timer_handler = reactor.ReactorTimer(callback, waketime)
+        self._timers = self._timers + [timer_handler]
+        self._next_timer = min(self._next_timer, waketime)
+        return timer_handler
+    def unregister_timer(self, timer_handler):
+        timer_handler.waketime = self.NEVER
+        timers = list(self._timers)
+        timers.pop(timers.index(timer_handler))
+        self._timers = timers
+    def _check_timers(self, eventtime):
+        if eventtime < self._next_timer:
+            return min(1., max(.001, self._next_timer - eventtime))
+        self._next_timer = self.NEVER
+        for t in self._timers:
+            waketime = t.waketime
+            if eventtime >= waketime:
+                t.waketime = self.NEVER
+                t.waketime = waketime = t.callback(eventtime)
+            self._next_timer = min(self._next_timer, waketime)
+        if eventtime >= self._next_timer:
+            return 0.
+        return min(1., max(.001, self._next_timer - eventtime))
+
+# Periodic timer with a fixed interval (like heater/fan/stats timers)
+class PeriodicTimer:
+    def __init__(self, interval):
+        self.interval = interval
+        self.calls = 0
+        self.waketime = 0.
+    def callback(self, eventtime):
+        self.calls += 1
+        self.waketime = eventtime + self.interval
+        return self.waketime
+
+def run_bench(reactor_class, count, duration, step):
+    r = reactor_class()
+    rnd = random.Random(count)
+    timers = []
+    for i in range(count):
+        pt = PeriodicTimer(rnd.uniform(.010, 1.))
+        pt.waketime = rnd.uniform(0., pt.interval)
+        r.register_timer(pt.callback, pt.waketime)
+        timers.append(pt)
+    # Simulate the dispatch loop with a fixed event time increment
+    eventtime = 0.
+    passes = 0
+    start = time.time()
+    while eventtime < duration:
+        r._check_timers(eventtime)
+        eventtime += step
+        passes += 1
+    cpu = time.time() - start
+    calls = sum([pt.calls for pt in timers])
+    return cpu, passes, calls
+
+# Check that a timer that always reschedules itself to NOW (like a
+# greenlet calling reactor.pause(reactor.NOW)) does not starve the
+# other timers that are due
+def check_fairness(reactor_class, duration, step):
+    r = reactor_class()
+    busy_calls = [0]
+    def busy_callback(eventtime):
+        busy_calls[0] += 1
+        return r.NOW
+    r.register_timer(busy_callback, r.NOW)
+    timers = [PeriodicTimer(interval) for interval in [.010, .100, .250]]
+    for pt in timers:
+        r.register_timer(pt.callback, pt.waketime)
+    eventtime = 0.
+    while eventtime < duration:
+        r._check_timers(eventtime)
+        eventtime += step
+    # A timer may run up to one pass after its waketime
+    expected = [int(duration / (pt.interval + step)) for pt in timers]
+    calls = [pt.calls for pt in timers]
+    ok = not [1 for c, e in zip(calls, expected) if c < e]
+    return ok, busy_calls[0], calls, expected
+
+def main():
+    usage = "%prog [options]"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-c", "--counts", dest="counts", default="10,100,1000",
+                    help="comma separated list of timer counts")
+    opts.add_option("-d", "--duration", dest="duration", type="float",
+                    default=20., help="simulated run time in seconds")
+    opts.add_option("-s", "--step", dest="step", type="float", default=.001,
+                    help="simulated time between dispatch passes")
+    options, args = opts.parse_args()
+    if args:
+        opts.error("Incorrect number of arguments")
+    counts = [int(c) for c in options.counts.split(',')]
+    print "%-8s %-6s %10s %10s %12s %12s" % (
+        "reactor", "timers", "passes", "callbacks", "us/pass", "us/callback")
+    for count in counts:
+        for name, rclass in [("list", ListTimerReactor),
+                             ("heap", reactor.SelectReactor)]:
+            cpu, passes, calls = run_bench(
+                rclass, count, options.duration, options.step)
+            print "%-8s %-6d %10d %10d %12.3f %12.3f" % (
+                name, count, passes, calls, cpu * 1000000. / passes,
+                cpu * 1000000. / max(1, calls))
+    print "\nFairness with a timer rescheduled to NOW on every call:"
+    failed = False
+    for name, rclass in [("list", ListTimerReactor),
+                         ("heap", reactor.SelectReactor)]:
+        ok, busy, calls, expected = check_fairness(
+            rclass, options.duration, options.step)
+        print "%-8s busy=%d periodic calls=%s (expected %s) %s" % (
+            name, busy, calls, expected, "ok" if ok else "FAIL")
+        failed |= not ok
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
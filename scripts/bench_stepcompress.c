@@ -0,0 +1,166 @@
+// Benchmark of the host step compression code
+//
+// This file may be distributed under the terms of the GNU GPLv3 license.
+//
+// The step times are read from a recorded session - for example:
+//   ./klippy/klippy.py config.cfg -i test.gcode -o out.serial -d out.dict
+//   ./klippy/parsedump.py out.dict out.serial > steps.txt
+// To build and run:
+//   gcc -Wall -O2 -o bench_stepcompress scripts/bench_stepcompress.c
+//     klippy/chelper/pyhelper.c klippy/chelper/serialqueue.c -lpthread -lm
+//   ./bench_stepcompress steps.txt
+
+#include <getopt.h> // getopt
+#include "../klippy/chelper/stepcompress.c" // compress_bisect_add
+
+#define MAX_OIDS 256
+#define DIR_EVENT (1ULL << 63)
+#define BENCH_QUEUE_STEP_MSGID 1
+#define BENCH_SET_NEXT_STEP_DIR_MSGID 2
+
+// Recorded step times (and direction changes) for a stepper
+struct bench_stepper {
+    uint64_t *events, last_clock;
+    int count, alloc, msgs;
+};
+
+static void
+bench_add_event(struct bench_stepper *bs, uint64_t event)
+{
+    if (bs->count >= bs->alloc) {
+        bs->alloc = bs->alloc ? bs->alloc * 2 : QUEUE_START_SIZE;
+        bs->events = realloc(bs->events, bs->alloc * sizeof(*bs->events));
+    }
+    bs->events[bs->count++] = event;
+}
+
+// Reconstruct the step times from the queue_step commands in a file
+static int
+bench_read(const char *filename, struct bench_stepper *steppers)
+{
+    FILE *f = fopen(filename, "r");
+    if (!f) {
+        perror(filename);
+        return -1;
+    }
+    char line[256];
+    while (fgets(line, sizeof(line), f)) {
+        uint32_t oid, interval, count, clock, dir;
+        int32_t add;
+        if (sscanf(line, "queue_step oid=%u interval=%u count=%u add=%d"
+                   , &oid, &interval, &count, &add) == 4) {
+            if (oid >= MAX_OIDS)
+                continue;
+            struct bench_stepper *bs = &steppers[oid];
+            while (count--) {
+                bs->last_clock += interval;
+                interval += add;
+                bench_add_event(bs, bs->last_clock);
+            }
+            bs->msgs++;
+        } else if (sscanf(line, "set_next_step_dir oid=%u dir=%u"
+                          , &oid, &dir) == 2) {
+            if (oid < MAX_OIDS)
+                bench_add_event(&steppers[oid], DIR_EVENT | dir);
+        } else if (sscanf(line, "reset_step_clock oid=%u clock=%u"
+                          , &oid, &clock) == 2) {
+            if (oid < MAX_OIDS)
+                steppers[oid].last_clock = clock;
+        }
+    }
+    fclose(f);
+    return 0;
+}
+
+// Compress the step times of a stepper and return the number of
+// queue_step messages generated
+static int
+bench_compress(struct bench_stepper *bs, int oid, uint32_t max_error)
+{
+    struct stepcompress *sc = stepcompress_alloc(oid);
+    stepcompress_fill(sc, max_error, 0, BENCH_QUEUE_STEP_MSGID
+                      , BENCH_SET_NEXT_STEP_DIR_MSGID);
+    stepcompress_set_time(sc, 0., 1.);
+    struct queue_append qa = queue_append_start(sc, 0., .5);
+    int i, ret = 0;
+    for (i = 0; i < bs->count && !ret; i++) {
+        uint64_t event = bs->events[i];
+        if (event & DIR_EVENT)
+            ret = queue_append_set_next_step_dir(&qa, event & 1);
+        else
+            ret = queue_append(&qa, event);
+    }
+    queue_append_finish(qa);
+    if (!ret)
+        ret = stepcompress_flush(sc, UINT64_MAX);
+    int msgs = 0;
+    struct queue_message *qm;
+    list_for_each_entry(qm, &sc->msg_queue, node) {
+        if (qm->msg[0] == BENCH_QUEUE_STEP_MSGID)
+            msgs++;
+    }
+    stepcompress_free(sc);
+    return ret ? -1 : msgs;
+}
+
+static void
+usage(const char *prog)
+{
+    fprintf(stderr, "Usage: %s [-e max_error] [-r repeat] <steps file>\n"
+            , prog);
+}
+
+int
+main(int argc, char **argv)
+{
+    uint32_t max_error = 400;
+    int repeat = 10, opt;
+    while ((opt = getopt(argc, argv, "e:r:")) != -1) {
+        switch (opt) {
+        case 'e':
+            max_error = atoi(optarg);
+            break;
+        case 'r':
+            repeat = atoi(optarg);
+            break;
+        default:
+            usage(argv[0]);
+            return -1;
+        }
+    }
+    if (optind + 1 != argc || repeat < 1) {
+        usage(argv[0]);
+        return -1;
+    }
+    static struct bench_stepper steppers[MAX_OIDS];
+    if (bench_read(argv[optind], steppers))
+        return -1;
+
+    long steps = 0, msgs = 0, recorded_msgs = 0;
+    double start = get_monotonic();
+    int r, oid;
+    for (r = 0; r < repeat; r++) {
+        for (oid = 0; oid < MAX_OIDS; oid++) {
+            struct bench_stepper *bs = &steppers[oid];
+            if (!bs->count)
+                continue;
+            int ret = bench_compress(bs, oid, max_error);
+            if (ret < 0) {
+                fprintf(stderr, "Error compressing oid %d\n", oid);
+                return -1;
+            }
+            if (!r) {
+                msgs += ret;
+                recorded_msgs += bs->msgs;
+                for (ret = 0; ret < bs->count; ret++)
+                    if (!(bs->events[ret] & DIR_EVENT))
+                        steps++;
+            }
+        }
+    }
+    double elapsed = get_monotonic() - start;
+    printf("steps=%ld queue_step=%ld (recorded %ld) time=%.3fs"
+           " steps/second=%.0f\n", steps, msgs, recorded_msgs, elapsed
+           , steps * repeat / elapsed);
+    return 0;
+}
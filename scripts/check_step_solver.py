@@ -0,0 +1,147 @@
+#!/usr/bin/env python2
+# Compare the step times of the analytic and iterative step solvers
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import sys, os, optparse, logging, subprocess
+sys.path.append(os.path.join(os.path.dirname(__file__), '../klippy'))
+import msgproto
+import test_klippy
+
+TEMP_CONFIG_FILE = "_test_solver.cfg"
+
+# Run each test twice (once with each step solver) and verify that the
+# resulting step times differ by less than the maximum stepper error
+class SolverTestCase(test_klippy.TestCase):
+    def __init__(self, fname, dictdir, tempdir, max_error):
+        test_klippy.TestCase.__init__(self, fname, dictdir, tempdir,
+                                      False, False)
+        self.max_error = max_error
+    def launch_test(self, config_fname, dict_fnames, gcode_fname, gcode,
+                    should_fail):
+        if should_fail:
+            return
+        if gcode_fname is None:
+            gcode_fname = self.relpath(test_klippy.TEMP_GCODE_FILE, 'temp')
+            f = open(gcode_fname, 'wb')
+            f.write('\n'.join(gcode + ['']))
+            f.close()
+        sys.stderr.write("    Comparing %s (%s)\n" % (
+            self.fname, os.path.basename(config_fname)))
+        analytic = self.run_klippy(config_fname, dict_fnames, gcode_fname)
+        iter_config = self.relpath(TEMP_CONFIG_FILE, 'temp')
+        f = open(iter_config, 'wb')
+        f.write("[include %s]\n[printer]\nstep_solver: iterative\n" % (
+            os.path.abspath(config_fname),))
+        f.close()
+        iterative = self.run_klippy(iter_config, dict_fnames, gcode_fname)
+        os.unlink(iter_config)
+        if gcode:
+            os.unlink(gcode_fname)
+        for mcu_name, (freq, steps) in analytic.items():
+            max_diff = self.max_error * freq
+            iter_steps = iterative[mcu_name][1]
+            for oid in sorted(set(steps) | set(iter_steps)):
+                compare_steps(steps.get(oid, []), iter_steps.get(oid, []),
+                              max_diff, "mcu '%s' oid %d" % (mcu_name, oid))
+    def run_klippy(self, config_fname, dict_fnames, gcode_fname):
+        output = self.relpath(test_klippy.TEMP_OUTPUT_FILE, 'temp')
+        log = self.relpath(test_klippy.TEMP_LOG_FILE, 'temp')
+        args = [ sys.executable, './klippy/klippy.py', config_fname,
+                 '-i', gcode_fname, '-o', output, '-v', '-l', log ]
+        for df in dict_fnames:
+            args += ['-d', df]
+        res = subprocess.call(args)
+        if res:
+            self.show_log()
+            raise test_klippy.error("Error during test")
+        os.unlink(log)
+        # Decode the step times sent to each mcu
+        out = {}
+        for df in dict_fnames:
+            mcu_name, fname, dict_fname = 'mcu', output, df
+            if '=' in df:
+                mcu_name, dict_fname = df.split('=', 1)
+                fname = output + '-' + mcu_name
+            out[mcu_name] = read_steps(dict_fname, fname)
+            os.unlink(fname)
+        return out
+    def show_log(self):
+        f = open(self.relpath(test_klippy.TEMP_LOG_FILE, 'temp'), 'rb')
+        data = f.read()
+        f.close()
+        sys.stdout.write(data)
+
+# Return the mcu frequency and the step times of each stepper (by oid)
+def read_steps(dict_fname, fname):
+    f = open(dict_fname, 'rb')
+    mp = msgproto.MessageParser()
+    mp.process_identify(f.read(), decompress=False)
+    f.close()
+    f = open(fname, 'rb')
+    data = f.read()
+    f.close()
+    steps = {}
+    clocks = {}
+    while data:
+        l = mp.check_packet(data)
+        if l <= 0:
+            raise test_klippy.error("Invalid data in %s" % (fname,))
+        s = bytearray(data[:l])
+        data = data[l:]
+        pos = msgproto.MESSAGE_HEADER_SIZE
+        while pos < l - msgproto.MESSAGE_TRAILER_SIZE:
+            mid = mp.messages_by_id.get(s[pos], mp.unknown)
+            params, pos = mid.parse(s, pos)
+            name = mid.name
+            if name == 'reset_step_clock':
+                clocks[params['oid']] = params['clock']
+            elif name == 'set_next_step_dir':
+                steps.setdefault(params['oid'], []).append(
+                    ('dir', params['dir']))
+            elif name == 'queue_step':
+                oid = params['oid']
+                clock = clocks.get(oid, 0)
+                interval, add = params['interval'], params['add']
+                oid_steps = steps.setdefault(oid, [])
+                for i in range(params['count']):
+                    clock += interval
+                    interval += add
+                    oid_steps.append(('step', clock))
+                clocks[oid] = clock
+    return mp.get_constant_float('CLOCK_FREQ'), steps
+
+def compare_steps(steps, iter_steps, max_diff, desc):
+    if len(steps) != len(iter_steps):
+        raise test_klippy.error("%s: %d events vs %d with iterative solver" % (
+            desc, len(steps), len(iter_steps)))
+    for (etype, val), (iter_etype, iter_val) in zip(steps, iter_steps):
+        if etype != iter_etype or (etype == 'dir' and val != iter_val):
+            raise test_klippy.error("%s: step direction mismatch" % (desc,))
+        if abs(val - iter_val) > max_diff:
+            raise test_klippy.error("%s: step time %d vs %d" % (
+                desc, val, iter_val))
+
+def main():
+    usage = "%prog [options] <test cases>"
+    opts = optparse.OptionParser(usage)
+    opts.add_option("-d", "--dictdir", dest="dictdir", default=".",
+                    help="directory for dictionary files")
+    opts.add_option("-t", "--tempdir", dest="tempdir", default=".",
+                    help="directory for temporary files")
+    opts.add_option("-e", "--max-error", dest="max_error", type="float",
+                    default=.000025, help="maximum step time difference")
+    options, args = opts.parse_args()
+    if len(args) < 1:
+        opts.error("Incorrect number of arguments")
+    logging.basicConfig(level=logging.DEBUG)
+    for fname in args:
+        tc = SolverTestCase(fname, options.dictdir, options.tempdir,
+                            options.max_error)
+        res = tc.run()
+        if res != 'success':
+            sys.stderr.write("\n\nTest case %s FAILED (%s)!\n\n" % (fname, res))
+            sys.exit(-1)
+    sys.stderr.write("\n    All %d test cases match\n" % (len(args),))
+
+if __name__ == '__main__':
+    main()
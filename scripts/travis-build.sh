@@ -70,3 +70,7 @@ mkdir -p ${HOSTDIR}
 start_test klippy "Test invoke klippy"
 $PYTHON scripts/test_klippy.py -d ${DICTDIR} test/klippy/*.test
 finish_test klippy "Test invoke klippy"
+
+start_test step_solver "Compare step solvers"
+$PYTHON scripts/check_step_solver.py -d ${DICTDIR} -t ${HOSTDIR} test/klippy/commands.test test/klippy/gcode_arcs.test test/klippy/dual_carriage.test test/klippy/multi_z.test
+finish_test step_solver "Compare step solvers"
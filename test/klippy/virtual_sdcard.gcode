@@ -0,0 +1,9 @@
+; Virtual sdcard pause and resume test
+
+G28
+G90
+G1 X20 Y20 Z5 F6000
+G1 X40 E1
+M25
+G1 Y40 E2
+G1 X20 Y20 E3